@@ -14,6 +14,8 @@
 #  DB 12   ; a decimal byte
 #  DB 0b0001 ; a binary byte
 
+import io
+import os
 import sys
 import re
 
@@ -63,10 +65,81 @@ REGEX = r"(?:(\w+?):)?\s*(?:(\w+)\s*(?:(\w+)(?:\s*,\s*(\w+))?)?)?"
 REGEX_DS = r"(?:(\w+?):)?\s*DS\s*(.+)"  # insensitive
 REGEX_DB = r"(?:(\w+?):)?\s*DB\s*(.+)"  # insensitive
 
+# Compiled once, rather than on every line
+LINE_RE = re.compile(REGEX)
+DS_RE = re.compile(REGEX_DS, re.IGNORECASE)
+DB_RE = re.compile(REGEX_DB, re.IGNORECASE)
+REGISTER_RE = re.compile(r"R([0-7])")
+
+# Opcode name -> machine code byte
+OPCODE_BYTES = {name: int(info["code"], 2) for name, info in OPCODES.items()}
+
+# Opcode type -> instruction size in bytes
+TYPE_SIZES = {0: 1, 1: 2, 2: 3, 8: 3}
+
+# Label lines in pass1 output
+LABEL_LINE_RE = re.compile(r"# (\w+) \(address \d+\):")
+
+# Instructions, other than LDI, that overwrite their first register
+WRITES_REGISTER = {
+    "ADD", "AND", "DEC", "DIV", "INC", "LD", "MOD", "MUL", "NOT", "OR",
+    "POP", "SHL", "SHR", "SUB", "XOR",
+}
+
+# Conditional jumps
+BRANCHES = {"JEQ", "JGE", "JGT", "JLE", "JLT", "JNE"}
+
+# Instructions that never fall through to the next one
+UNCONDITIONAL = {"HLT", "IRET", "JMP", "RET"}
+
+# Registers the peephole pass never assumes anything about: R6 (IS) is set
+# by devices at any time, and R7 (SP) moves with every push and pop
+VOLATILE = {"R6", "R7"}
+
+
+class AssemblerError(Exception):
+    """
+    An error in the assembly source. `line_num` is the 1-based source line,
+    or None for errors that don't belong to a single line.
+    """
+
+    def __init__(self, message, line_num=None):
+        super().__init__(message)
+        self.message = message
+        self.line_num = line_num
+
+    def __str__(self):
+        if self.line_num is None:
+            return self.message
+        return f"line {self.line_num}: {self.message}"
+
+
+class ParseError(AssemblerError):
+    """A line that can't be parsed at all."""
+
+
+class UnknownOpcodeError(AssemblerError):
+    """An opcode that isn't in OPCODES."""
+
+
+class OperandError(AssemblerError):
+    """Wrong operand count, bad register, or bad immediate/data value."""
+
+
+class UnknownSymbolError(AssemblerError):
+    """A label that is referenced but never defined."""
+
+
+class ProgramTooLargeError(AssemblerError):
+    """The program doesn't fit in the 256 bytes of memory."""
+
 
 def parse_commandline(argv):
     """
-    Usage: asm.py [inputfile] [outputfile]
+    Usage: asm.py [-O] [inputfile] [outputfile]
+
+    An outputfile ending in .ls8b gets the binary image format instead of
+    .ls8 text. -O runs the peephole optimizer between the passes.
     """
 
     if len(argv) == 1:
@@ -82,7 +155,8 @@ def parse_commandline(argv):
         outputfile = argv[2]
 
     else:
-        print("usage: asm.py [infile.asm] [outfile.ls8]", file=sys.stderr)
+        print("usage: asm.py [-O] [infile.asm] [outfile.ls8|outfile.ls8b]",
+              file=sys.stderr)
         sys.exit(1)
 
     return inputfile, outputfile
@@ -101,6 +175,8 @@ def open_files(inputfile, outputfile):
 
     if outputfile == "-":
         outputfile = sys.stdout
+    elif outputfile.endswith(".ls8b"):
+        outputfile = open(outputfile, "wb")
     else:
         outputfile = open(outputfile, "w")
 
@@ -135,6 +211,9 @@ def pass1(inputfile, sym, code):
     * Parse labels, opcodes, and operands
     * Record label offsets
     * Emit machine code
+
+    Raises an AssemblerError subclass on the first error, as `assemble()`
+    does.
     """
 
     # Source line number
@@ -148,13 +227,11 @@ def pass1(inputfile, sym, code):
 
         nonlocal line_num
 
-        m = re.match(r"R([0-7])", op)
+        m = REGISTER_RE.match(op)
 
         if m is None:
             if fatal:
-                print(f"Line {line_num}: unknown register {op}",
-                      file=sys.stderr)
-                sys.exit(1)
+                raise OperandError(f"unknown register {op}", line_num)
             else:
                 return None
 
@@ -201,12 +278,16 @@ def pass1(inputfile, sym, code):
 
         try:
             val_b = int(op_b, 0)
-            out_b = p8(val_b)
 
         except ValueError:
             # If it's not a value, it might be a symbol
             out_b = f"sym:{op_b}"
 
+        else:
+            if not 0 <= val_b <= 0xff:
+                raise OperandError(f"immediate {op_b} out of range", line_num)
+            out_b = p8(val_b)
+
         code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
         code.append(p8(reg_a))
         code.append(out_b)
@@ -220,14 +301,17 @@ def pass1(inputfile, sym, code):
 
         nonlocal addr
 
-        m = re.match(REGEX_DS, line, re.IGNORECASE)
+        m = DS_RE.match(line)
 
         if m is None or m.group(2) is None:
-            print(f"line {line_num}: missing argument to DS", file=sys.stderr)
-            sys.exit(2)
+            raise OperandError("missing argument to DS", line_num)
 
         data = m.group(2)
 
+        if any(ord(c) > 0xff for c in data):
+            raise OperandError("DS string has characters that don't fit "
+                               "in a byte", line_num)
+
         for i in range(len(data)):
             print_char = data[i]
 
@@ -245,11 +329,10 @@ def pass1(inputfile, sym, code):
 
         nonlocal addr
 
-        m = re.match(REGEX_DB, line, re.IGNORECASE)
+        m = DB_RE.match(line)
 
         if m is None or m.group(2) is None:
-            print(f"line {line}: missing argument to DB", file=sys.stderr)
-            sys.exit(2)
+            raise OperandError("missing argument to DB", line_num)
 
         data = m.group(2)
 
@@ -257,9 +340,7 @@ def pass1(inputfile, sym, code):
             val = int(data, 0)
 
         except ValueError:
-            print(f"line {line_num}: invalid integer argument to DB",
-                  file=sys.stderr)
-            sys.exit(2)
+            raise OperandError("invalid integer argument to DB", line_num)
 
         # Force to byte size
         val &= 0xff
@@ -274,18 +355,13 @@ def pass1(inputfile, sym, code):
         def check_ops_count(desired, found):
             # Makes sure we have right operand count
             if found < desired:
-                print(f"Line {line_num}: missing operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
+                raise OperandError(f"missing operand to {opcode}", line_num)
             elif found > desired:
-                print(f"Line {line_num}: unexpected operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
+                raise OperandError(f"unexpected operand to {opcode}", line_num)
 
         # Make sure we know this opcode at all
         if opcode not in OPCODES:
-            print(f"line {line_num}: unknown opcode {opcode}", file=sys.stderr)
-            sys.exit(2)
+            raise UnknownOpcodeError(f"unknown opcode {opcode}", line_num)
 
         op_type = OPCODES[opcode]["type"]
 
@@ -330,7 +406,7 @@ def pass1(inputfile, sym, code):
 
         # print(line)  # debug
 
-        m = re.match(REGEX, line)
+        m = LINE_RE.match(line)
 
         if m is not None:
             label, opcode, op_a, op_b = normalize_line(m.groups())
@@ -357,13 +433,184 @@ def pass1(inputfile, sym, code):
                     handler = type_f[op_info["type"]]
                     handler(opcode, op_a, op_b, op_info["code"])
         else:
-            print(f"No match: {input}", file=sys.stderr)
-            sys.exit(3)
+            raise ParseError(f"no match: {line}", line_num)
+
+
+def structure(code):
+    """
+    Split pass1 output into items: ("label", name), ("op", opcode,
+    operands, lines) with the instruction's lines of machine code, and
+    ("data", line) for DS/DB bytes.
+    """
+
+    items = []
+    i = 0
+
+    while i < len(code):
+        m = LABEL_LINE_RE.match(code[i])
+        if m is not None:
+            items.append(("label", m.group(1)))
+            i += 1
+            continue
+
+        bits, _, comment = code[i].partition(" # ")
+        words = comment.split(None, 1)
+        opcode = words[0] if words else None
+
+        if opcode in OPCODES and OPCODES[opcode]["code"] == bits:
+            size = TYPE_SIZES[OPCODES[opcode]["type"]]
+            operands = words[1].split(",") if len(words) > 1 else []
+            items.append(("op", opcode, operands, code[i:i + size]))
+            i += size
+        else:
+            items.append(("data", code[i]))
+            i += 1
+
+    return items
+
+
+def immediate(op):
+    """LDI operand as a value to compare: a number, or a label name"""
+
+    try:
+        return int(op, 0)
+    except ValueError:
+        return op
+
+
+def peephole(items, stats):
+    """
+    One pass of the rewrites over `items`; returns the rewritten list.
+
+    Register contents are only tracked through straight-line code: a label
+    some LDI refers to (a possible jump target), data, CALL and INT forget
+    them. Labels nothing refers to can only be reached by falling through.
+    """
+
+    referenced = {item[2][1] for item in items
+                  if item[0] == "op" and item[1] == "LDI"
+                  and isinstance(immediate(item[2][1]), str)}
+
+    def labels_at(i):
+        # Labels between items[i - 1] and the next instruction or data
+        names = set()
+        while i < len(items) and items[i][0] == "label":
+            names.add(items[i][1])
+            i += 1
+        return names
+
+    def remove(rewrite, *removed, executed=True):
+        stats[rewrite] += 1
+        stats["bytes"] += sum(len(item[3]) for item in removed)
+        if executed:
+            stats["cycles"] += len(removed)
+
+    out = []
+    known = {}   # register -> value it was loaded with by LDI
+    dead = False
+    i = 0
+
+    while i < len(items):
+        item = items[i]
+        i += 1
+
+        if item[0] != "op":
+            if item[0] == "data" or item[1] in referenced:
+                known = {}
+                dead = False
+            out.append(item)
+            continue
+
+        _, opcode, operands, lines = item
+        reg = operands[0] if operands else None
+
+        # Unreachable: after HLT/JMP/RET/IRET, before any way in
+        if dead:
+            remove("dead code", item, executed=False)
+            continue
+
+        # LDI of the value the register already holds
+        if opcode == "LDI" and reg not in VOLATILE:
+            value = immediate(operands[1])
+            if reg in known and known[reg] == value:
+                remove("redundant LDI", item)
+                continue
+            known[reg] = value
+            out.append(item)
+            continue
+
+        # PUSH Rx; POP Rx
+        if (opcode == "PUSH" and reg not in VOLATILE and i < len(items)
+                and items[i][:3] == ("op", "POP", operands)):
+            remove("PUSH/POP pair", item, items[i])
+            i += 1
+            continue
+
+        # Jump to the instruction right after the jump
+        if (opcode == "JMP" or opcode in BRANCHES) and known.get(reg) in labels_at(i):
+            remove("jump to next", item)
+            continue
+
+        if opcode in WRITES_REGISTER:
+            known.pop(reg, None)
+        if opcode in ("CALL", "INT") or opcode in UNCONDITIONAL:
+            known = {}
+        dead = opcode in UNCONDITIONAL
+        out.append(item)
+
+    return out
+
+
+def optimize(sym, code):
+    """
+    Peephole pass, run between pass1 and pass2 with -O.
+
+    Rewrites pass1's `code` in place, repeating until nothing changes:
+
+    * removes an LDI loading a register with the value it already holds
+    * removes PUSH Rx directly followed by POP Rx
+    * removes a jump (or conditional jump) to the instruction after it
+    * removes instructions after HLT, JMP, RET or IRET up to the next data
+      or label that an LDI refers to
+
+    then recomputes every label address in `sym`. Jumps are assumed to go
+    to labels: code reached through a numeric address may move.
+
+    Returns counts of each rewrite, plus "bytes" saved and "cycles": the
+    removed instructions that could run, one cycle each time the code
+    around them runs.
+    """
+
+    stats = {"bytes": 0, "cycles": 0, "redundant LDI": 0, "PUSH/POP pair": 0,
+             "jump to next": 0, "dead code": 0}
+
+    items = structure(code)
+    while True:
+        size = stats["bytes"]
+        items = peephole(items, stats)
+        if stats["bytes"] == size:
+            break
+
+    code.clear()
+    addr = 0
+    for item in items:
+        if item[0] == "label":
+            sym[item[1]] = addr
+            code.append(f"# {item[1]} (address {addr}):")
+        elif item[0] == "op":
+            code.extend(item[3])
+            addr += len(item[3])
+        else:
+            code.append(item[1])
+            addr += 1
+
+    return stats
 
 
 def pass2(outputfile, sym, code):
     """
-    Output the code, substituting in any symbols.
+    Output the code, substituting in any symbols. Raises an AssemblerError
+    subclass for unknown or out-of-range symbols.
     """
 
     for c in code:
@@ -372,16 +619,141 @@ def pass2(outputfile, sym, code):
             s = c[4:].strip()
 
             if s in sym:
+                if sym[s] > 0xFF:
+                    # code entries carry no source line
+                    raise OperandError(f"label {s} is at address {sym[s]}, "
+                                       "past the end of memory")
                 c = p8(sym[s])
 
             else:
-                print(f"unknown symbol: {s}", file=sys.stderr)
-                sys.exit(2)
+                raise UnknownSymbolError(f"unknown symbol: {s}")
 
         outputfile.write(f"{c}\n")
 
 
+def assemble(source):
+    """
+    Assemble `source` (a string, or an iterable of lines) straight to bytes.
+
+    Returns (image, symbols, source_map): the image as a bytearray, the
+    label addresses, and the 1-based source line of every address where an
+    instruction or data starts. Labels used before they are defined are
+    fixed up once the whole source has been read.
+
+    Raises an AssemblerError subclass on the first error instead of
+    printing and exiting.
+    """
+
+    if isinstance(source, str):
+        source = source.split("\n")
+
+    image = bytearray()
+    sym = {}
+    source_map = {}
+    fixups = []  # (image offset, symbol, line number)
+
+    def get_reg(op, line_num):
+        m = REGISTER_RE.match(op)
+        if m is None:
+            raise OperandError(f"unknown register {op}", line_num)
+        return int(m.group(1))
+
+    for line_num, line in enumerate(source, 1):
+        # Strip comments
+        comment_index = line.find(';')
+        if comment_index != -1:
+            line = line[:comment_index]
+
+        line = line.strip()
+
+        m = LINE_RE.match(line)
+        if m is None:
+            raise ParseError(f"no match: {line}", line_num)
+
+        label, opcode, op_a, op_b = normalize_line(m.groups())
+
+        if label is not None:
+            sym[label] = len(image)
+
+        if opcode is None:
+            continue
+
+        source_map[len(image)] = line_num
+
+        if opcode == 'DS':
+            m = DS_RE.match(line)
+            if m is None or m.group(2) is None:
+                raise OperandError("missing argument to DS", line_num)
+            try:
+                image += m.group(2).encode('latin-1')
+            except UnicodeEncodeError:
+                raise OperandError("DS string has characters that don't fit "
+                                   "in a byte", line_num)
+
+        elif opcode == 'DB':
+            m = DB_RE.match(line)
+            if m is None or m.group(2) is None:
+                raise OperandError("missing argument to DB", line_num)
+            try:
+                val = int(m.group(2), 0)
+            except ValueError:
+                raise OperandError("invalid integer argument to DB", line_num)
+            # Force to byte size
+            image.append(val & 0xff)
+
+        else:
+            if opcode not in OPCODES:
+                raise UnknownOpcodeError(f"unknown opcode {opcode}", line_num)
+
+            op_type = OPCODES[opcode]["type"]
+            desired = 2 if op_type == 8 else op_type
+            found = (op_a is not None) + (op_b is not None)
+            if found < desired:
+                raise OperandError(f"missing operand to {opcode}", line_num)
+            elif found > desired:
+                raise OperandError(f"unexpected operand to {opcode}", line_num)
+
+            image.append(OPCODE_BYTES[opcode])
+
+            if op_type >= 1:
+                image.append(get_reg(op_a, line_num))
+
+            if op_type == 2:
+                image.append(get_reg(op_b, line_num))
+
+            elif op_type == 8:
+                try:
+                    val = int(op_b, 0)
+                except ValueError:
+                    # If it's not a value, it might be a symbol
+                    fixups.append((len(image), op_b, line_num))
+                    val = 0
+                if not 0 <= val <= 0xff:
+                    raise OperandError(f"immediate {op_b} out of range",
+                                       line_num)
+                image.append(val)
+
+    for offset, s, line_num in fixups:
+        if s not in sym:
+            raise UnknownSymbolError(f"unknown symbol: {s}", line_num)
+        if sym[s] > 0xFF:
+            # e.g. a label after the last byte of a full program
+            raise OperandError(f"label {s} is at address {sym[s]}, "
+                               "past the end of memory", line_num)
+        image[offset] = sym[s]
+
+    if len(image) > 256:
+        raise ProgramTooLargeError(
+            f"program is {len(image)} bytes, more than fits in memory")
+
+    return image, sym, source_map
+
+
 def main(argv):
+    # -O can go anywhere on the command line
+    optimize_code = "-O" in argv[1:]
+    argv = [arg for arg in argv if arg != "-O"]
+
     # Parse command line
     inputfile, outputfile = parse_commandline(argv)
 
@@ -394,9 +766,56 @@ def main(argv):
     # Set up the machine code output
     code = []
 
+    binary = 'b' in getattr(outputfile, 'mode', '')
+
+    if binary:
+        # The image format lives with the emulator
+        sys.path.insert(0, os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "..", "ls8"))
+        import ls8b
+
+    if binary and not optimize_code:
+        # Binary image, with the symbol table and source map as sections
+        try:
+            image, sym, source_map = assemble(inputfile.read())
+        except AssemblerError as e:
+            print(e, file=sys.stderr)
+            sys.exit(2)
+
+        ls8b.write(outputfile, image, sym, source_map)
+        return 0
+
     # Assemble
-    pass1(inputfile, sym, code)
-    pass2(outputfile, sym, code)
+    try:
+        pass1(inputfile, sym, code)
+    except AssemblerError as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
+
+    if optimize_code:
+        stats = optimize(sym, code)
+        rewrites = ", ".join(f"{name} {n}" for name, n in stats.items()
+                             if n and name not in ("bytes", "cycles"))
+        print(f"-O: {stats['bytes']} bytes and ~{stats['cycles']} cycles saved"
+              f"{f' ({rewrites})' if rewrites else ''}", file=sys.stderr)
+
+    if binary:
+        # Optimized code has no source lines to map back to
+        text = io.StringIO()
+        try:
+            pass2(text, sym, code)
+        except AssemblerError as e:
+            print(e, file=sys.stderr)
+            sys.exit(2)
+        image, sym, _ = ls8b.from_text(text.getvalue().split("\n"))
+        ls8b.write(outputfile, image, sym)
+        return 0
+
+    try:
+        pass2(outputfile, sym, code)
+    except AssemblerError as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
 
     return 0
 
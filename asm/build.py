@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+"""
+Incremental, parallel build of .asm sources into .ls8 files.
+
+Each source is hashed together with the assembler itself. Sources whose
+hash matches the on-disk cache, and whose output is still the file the
+cache recorded, are skipped; the rest are assembled in a process pool.
+Per-file timings are reported.
+
+Usage: build.py [-j N] [--force] [--out DIR] [source.asm ...]
+
+With no sources, every *.asm next to this script is built into
+../ls8/examples, as buildall used to do.
+"""
+
+import io
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import asm
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OUT = os.path.join(HERE, '..', 'ls8', 'examples')
+CACHE_FILE = '.build-cache.json'
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def assembler_version():
+    """ A hash of the assembler source; a change to it rebuilds everything """
+
+    with open(asm.__file__, 'rb') as f:
+        return sha256(f.read())
+
+
+def source_key(path, version):
+    with open(path, 'rb') as f:
+        return sha256(version.encode() + b'\0' + f.read())
+
+
+def build_one(source, output):
+    """
+    Assemble one file. Runs in a worker process.
+
+    pass1/pass2 write the .ls8 text with its instruction comments, and
+    raise on the first error with its line as `assemble()` would. Returns
+    (source, ok, seconds, output hash or error message).
+    """
+
+    start = time.perf_counter()
+    out = io.StringIO()
+
+    try:
+        with open(source, encoding='utf-8') as f:
+            lines = f.read().split('\n')
+        sym = {}
+        code = []
+        asm.pass1(lines, sym, code)
+        size = sum(1 for c in code if not c.startswith('#'))
+        if size > 256:
+            raise asm.ProgramTooLargeError(
+                f"program is {size} bytes, more than fits in memory")
+        asm.pass2(out, sym, code)
+
+        data = out.getvalue().encode()
+        with open(output, 'wb') as f:
+            f.write(data)
+    except (asm.AssemblerError, OSError, UnicodeDecodeError) as e:
+        return source, False, time.perf_counter() - start, f'{type(e).__name__}: {e}'
+
+    return source, True, time.perf_counter() - start, sha256(data)
+
+
+def outcome(future, source, start):
+    """
+    A worker's result; anything it raised fails that file alone, so the
+    rest of the build and the cache of what was built are kept
+    """
+
+    try:
+        return future.result()
+    except Exception as e:
+        return source, False, time.perf_counter() - start, f'{type(e).__name__}: {e}'
+
+
+def load_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(path, cache):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def output_hash(path):
+    try:
+        with open(path, 'rb') as f:
+            return sha256(f.read())
+    except OSError:
+        return None
+
+
+def build(sources, out_dir, jobs=None, force=False, log=sys.stdout):
+    """ Build `sources` into `out_dir`; returns the number of failures """
+
+    os.makedirs(out_dir, exist_ok=True)
+    cache_path = os.path.join(out_dir, CACHE_FILE)
+    cache = {} if force else load_cache(cache_path)
+    version = assembler_version()
+
+    todo = []
+    keys = {}
+    for source in sources:
+        name = os.path.splitext(os.path.basename(source))[0] + '.ls8'
+        output = os.path.join(out_dir, name)
+        try:
+            key = keys[source] = source_key(source, version)
+        except OSError:
+            # build_one() reports it
+            todo.append((source, output))
+            continue
+        entry = cache.get(name)
+
+        if (entry is not None and entry['key'] == key
+                and entry['output'] == output_hash(output)):
+            print(f"  up to date  {os.path.relpath(source)}", file=log)
+        else:
+            todo.append((source, output))
+
+    start = time.perf_counter()
+    if len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(build_one, source, output) for source, output in todo]
+            results = [outcome(future, source, start)
+                       for future, (source, _) in zip(futures, todo)]
+    else:
+        results = [build_one(source, output) for source, output in todo]
+
+    failures = 0
+    for (source, output), (_, ok, seconds, detail) in zip(todo, results):
+        name = os.path.basename(output)
+        if ok:
+            cache[name] = {'key': keys[source], 'output': detail}
+            print(f"  {seconds * 1000:8.2f} ms  {os.path.relpath(source)}", file=log)
+        else:
+            failures += 1
+            cache.pop(name, None)
+            print(f"  FAILED      {os.path.relpath(source)}: {detail}", file=log)
+
+    save_cache(cache_path, cache)
+
+    print(f"{len(sources)} sources: {len(todo) - failures} built, "
+          f"{len(sources) - len(todo)} up to date, {failures} failed "
+          f"in {time.perf_counter() - start:.3f}s", file=log)
+
+    return failures
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='build.py')
+    parser.add_argument('sources', nargs='*',
+                        help='.asm files to build (default: all in asm/)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: cores)')
+    parser.add_argument('--force', action='store_true',
+                        help='ignore the cache and rebuild everything')
+    parser.add_argument('--out', default=DEFAULT_OUT,
+                        help='output directory (default: ../ls8/examples)')
+    args = parser.parse_args(argv[1:])
+
+    sources = args.sources or sorted(glob.glob(os.path.join(HERE, '*.asm')))
+
+    return 1 if build(sources, args.out, args.jobs, args.force) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,72 @@
+; smpcount.ls8
+;
+; For the SMP mode (ls8/smp.py): every core adds 1 to a shared counter
+; 20 times, holding the hardware lock at 0xF5 around each increment. The
+; last core to finish prints the total. Without the lock, cores running
+; in parallel (or an unlucky schedule) lose increments.
+;
+; Cores start with R0 = core number and R1 = number of cores.
+;
+; Expected output: 20 times the number of cores, e.g. 40 on 2 cores
+
+	LDI R2,20            ; increments left
+
+Next:
+	LDI R4,Lock
+	LDI R3,Counter
+	CALL R4              ; take the lock
+	LD R0,R3
+	INC R0
+	ST R3,R0             ; Counter += 1
+	LDI R4,Unlock
+	CALL R4
+	DEC R2
+	LDI R0,0
+	CMP R2,R0
+	LDI R4,Next
+	JNE R4
+
+	LDI R4,Lock
+	CALL R4
+	LDI R3,Finished
+	LD R0,R3
+	INC R0
+	ST R3,R0             ; Finished += 1
+	LDI R4,Unlock
+	CALL R4
+	CMP R0,R1            ; the last one to finish?
+	LDI R4,Print
+	JEQ R4
+	HLT
+
+Print:
+	LDI R3,Counter
+	LD R0,R3
+	PRN R0
+	HLT
+
+; Subroutine: Lock
+; Spins until the lock at 0xF5 is taken. Uses R0 and R4.
+
+Lock:
+	LDI R4,0xF5
+	LD R0,R4             ; test-and-set: R0 = old value, the lock is now 1
+	LDI R4,0
+	CMP R0,R4
+	LDI R4,Lock
+	JNE R4               ; somebody else holds it: try again
+	RET
+
+; Subroutine: Unlock
+; Releases the lock at 0xF5. Uses R4 and R5.
+
+Unlock:
+	LDI R4,0xF5
+	LDI R5,0
+	ST R4,R5
+	RET
+
+Counter:
+	db 0
+Finished:
+	db 0
@@ -0,0 +1,76 @@
+"""
+The ALU as lookup tables.
+
+Every result is computed once, when this module is imported, into
+immutable `bytes` shared by all CPUs and engines:
+
+* two-register instructions (`ADD R0,R1`): `table[a << 8 | b]`
+* one-register instructions (`INC R0`): `table[a]`
+* `CMP`: the new `FL`, `table[a << 8 | b]`
+* conditional jumps: whether the jump is taken, `table[FL]`
+
+The 8-bit wraparound is in the tables, so an ALU instruction is a single
+index, with no masking or overflow checks. `DIV` and `MOD` by zero hold 0;
+callers must fault before looking them up.
+"""
+
+""" FL bits: 00000LGE, set by CMP """
+FL_EQUAL = 0b001
+FL_GREATER = 0b010
+FL_LESS = 0b100
+
+BYTES = range(256)
+
+
+def binary(operation):
+    """ Table of `operation(a, b) & 0xFF` for every pair of bytes """
+
+    return bytes([operation(a, b) & 0xFF for a in BYTES for b in BYTES])
+
+
+def unary(operation):
+    """ Table of `operation(a) & 0xFF` for every byte """
+
+    return bytes([operation(a) & 0xFF for a in BYTES])
+
+
+def compare(a, b):
+    if a < b:
+        return FL_LESS
+    if a > b:
+        return FL_GREATER
+    return FL_EQUAL
+
+
+def condition(test):
+    """ Table of `test(FL)` for every FL value """
+
+    return bytes([bool(test(fl)) for fl in BYTES])
+
+
+""" Every table, by the mnemonic of the instruction using it """
+TABLES = {
+    'ADD': binary(lambda a, b: a + b),
+    'SUB': binary(lambda a, b: a - b),
+    'MUL': binary(lambda a, b: a * b),
+    'DIV': binary(lambda a, b: a // b if b else 0),
+    'MOD': binary(lambda a, b: a % b if b else 0),
+    'AND': binary(lambda a, b: a & b),
+    'OR': binary(lambda a, b: a | b),
+    'XOR': binary(lambda a, b: a ^ b),
+    'SHL': binary(lambda a, b: a << b if b < 8 else 0),
+    'SHR': binary(lambda a, b: a >> b),
+
+    'INC': unary(lambda a: a + 1),
+    'DEC': unary(lambda a: a - 1),
+    'NOT': unary(lambda a: ~a),
+
+    'CMP': binary(compare),
+
+    'JEQ': condition(lambda fl: fl & FL_EQUAL),
+    'JNE': condition(lambda fl: not fl & FL_EQUAL),
+    'JLT': condition(lambda fl: fl & FL_LESS),
+    'JLE': condition(lambda fl: fl & (FL_LESS | FL_EQUAL)),
+    'JGT': condition(lambda fl: fl & FL_GREATER),
+    'JGE': condition(lambda fl: fl & (FL_GREATER | FL_EQUAL)),
+}
@@ -0,0 +1,416 @@
+"""
+Lockstep batch execution of many LS-8 machines running the same program.
+
+Requires NumPy.
+
+All machines ("lanes") share one program but have their own state:
+
+* `registers`: (N, 8) uint8
+* `memory`: (N, 256) uint8
+* `PC`: (N,) int32, `FL`: (N,) uint8
+* `enabled`, `pending`: (N,) bool, the per-lane interrupt state
+
+There are no devices, but `INT` and `IRET` work: lanes with `pending` set
+are checked for interrupts at the start of the next step, as `CPU.run()`
+checks before its next fetch.
+
+Each `step()` fetches the opcode of every running lane, groups the lanes by
+opcode and executes each group with vectorized operations. Lanes retire
+when they halt, or fault wherever the scalar `CPU` would have raised (the
+state is left exactly as the scalar `CPU` leaves it at the exception), so
+every lane ends bit-for-bit where `CPU.run()` would have.
+"""
+
+import numpy as np
+
+from cpu import *
+
+""" The ALU and jump tables of alu.py, as arrays to index with whole lane vectors """
+BINARY_ARRAYS = {op: np.frombuffer(table, dtype=np.uint8)
+                 for op, table in BINARY_TABLES.items()}
+UNARY_ARRAYS = {op: np.frombuffer(table, dtype=np.uint8)
+                for op, table in UNARY_TABLES.items()}
+BRANCH_ARRAYS = {op: np.frombuffer(table, dtype=bool)
+                 for op, table in BRANCH_TABLES.items()}
+COMPARE_ARRAY = np.frombuffer(COMPARE_TABLE, dtype=np.uint8)
+
+""" Index of the lowest set bit of each byte, for picking the interrupt to service """
+LOWEST_BIT = np.array([(x & -x).bit_length() - 1 for x in range(256)],
+                      dtype=np.intp)
+
+""" Lane status """
+RUNNING = 0
+HALTED = 1
+FAULTED = 2
+
+
+class BatchCPU:
+    """N LS-8 machines executed in lockstep."""
+
+    def __init__(self, n):
+        self.n = n
+        self.registers = np.zeros((n, 8), dtype=np.uint8)
+        self.registers[:, SP] = 0xF4
+        self.memory = np.zeros((n, 256), dtype=np.uint8)
+        self.PC = np.zeros(n, dtype=np.int32)
+        self.FL = np.zeros(n, dtype=np.uint8)
+        self.enabled = np.ones(n, dtype=bool)
+        self.pending = np.zeros(n, dtype=bool)
+
+        self.status = np.zeros(n, dtype=np.uint8)
+        self.instructions = np.zeros(n, dtype=np.int64)
+
+        # Per-lane PRN/PRA output, and the error each faulted lane hit
+        self.output = [[] for _ in range(n)]
+        self.errors = {}
+
+        self.handlers = {
+            LDI: self.op_ldi,
+            PRN: self.op_prn,
+            PRA: self.op_pra,
+            HLT: self.op_hlt,
+            PUSH: self.op_push,
+            POP: self.op_pop,
+            CALL: self.op_call,
+            RET: self.op_ret,
+            JMP: self.op_jmp,
+            CMP: self.op_cmp,
+            ST: self.op_st,
+            LD: self.op_ld,
+            INT: self.op_int,
+            IRET: self.op_iret,
+        }
+        for op in BRANCH_OPS:
+            self.handlers[op] = self.op_branch
+        for op in BINARY_OPS:
+            self.handlers[op] = self.op_alu
+        for op in UNARY_OPS:
+            self.handlers[op] = self.op_alu_unary
+
+    def load(self, program):
+        """ Load a program (lines of an .ls8 file) into every lane """
+
+        cpu = CPU()
+        cpu.load(program)
+        self.memory[:] = np.frombuffer(bytes(cpu.memory), dtype=np.uint8)
+
+    @classmethod
+    def from_snapshot(cls, snapshot, n):
+        """ `n` lanes all continuing from one scalar `CPU.snapshot()` """
+
+        batch = cls(n)
+        batch.restore(snapshot)
+        return batch
+
+    def restore(self, snapshot, lanes=None):
+        """
+        Seed `lanes` (default: all) from a `CPU.snapshot()`. The snapshot's
+        buffers are broadcast into the lane arrays; nothing is pickled.
+        """
+
+        if snapshot.device_writes:
+            raise ValueError("snapshot has device input not yet delivered; "
+                             "batch lanes have no devices")
+
+        lanes = slice(None) if lanes is None else lanes
+        self.registers[lanes] = np.frombuffer(snapshot.registers, dtype=np.uint8)
+        # Raised interrupts not yet moved into IS get there as check_interrupts() would
+        self.registers[lanes, IS] |= snapshot.raised
+        self.memory[lanes] = np.frombuffer(snapshot.memory, dtype=np.uint8)
+        self.PC[lanes] = snapshot.PC
+        self.FL[lanes] = snapshot.FL
+        self.enabled[lanes] = snapshot.interrupts_enabled
+        self.pending[lanes] = snapshot.pending or bool(snapshot.raised)
+        self.status[lanes] = RUNNING
+        self.instructions[lanes] = snapshot.instructions
+        for lane in np.arange(self.n)[lanes].tolist():
+            self.output[lane] = []
+            self.errors.pop(lane, None)
+
+    def snapshot(self, lane):
+        """ The state of one lane as a `CPU.snapshot()`, to continue on a scalar CPU """
+
+        return Snapshot(self.registers[lane].tobytes(), self.memory[lane].tobytes(),
+                        int(self.PC[lane]), int(self.FL[lane]),
+                        bool(self.enabled[lane]), bool(self.pending[lane]), 0,
+                        (), int(self.instructions[lane]))
+
+    def fault(self, lanes, error):
+        self.status[lanes] = FAULTED
+        for lane in lanes.tolist():
+            self.errors[lane] = error
+
+    def split(self, lanes, bad, error):
+        """ Fault the lanes where `bad` is set and return the others """
+
+        if bad.any():
+            self.fault(lanes[bad], error)
+            return lanes[~bad]
+        return lanes
+
+    def operands(self, lanes, size):
+        """
+        Fault lanes whose instruction runs off the end of memory, and return
+        (lanes, a, b) for the rest.
+        """
+
+        pc = self.PC[lanes]
+        lanes = self.split(lanes, pc + size > 256, 'IndexError')
+        pc = self.PC[lanes]
+        a = self.memory[lanes, pc + 1].astype(np.intp)
+        b = self.memory[lanes, np.minimum(pc + 2, 255)].astype(np.intp)
+        return lanes, a, b
+
+    def registers_only(self, lanes, a, b, check_b=False):
+        """ Fault lanes naming a register above R7 in operand a (and b) """
+
+        bad = a >= 8
+        if check_b:
+            bad |= b >= 8
+        if bad.any():
+            self.fault(lanes[bad], 'IndexError')
+            keep = ~bad
+            return lanes[keep], a[keep], b[keep]
+        return lanes, a, b
+
+    """ Handlers: each executes one opcode for a group of lanes """
+
+    def op_ldi(self, lanes):
+        lanes, a, b = self.operands(lanes, 3)
+        lanes, a, b = self.registers_only(lanes, a, b)
+        self.registers[lanes, a] = b
+        self.PC[lanes] += 3
+
+    def op_prn(self, lanes):
+        lanes, a, b = self.operands(lanes, 2)
+        lanes, a, b = self.registers_only(lanes, a, b)
+        for lane, value in zip(lanes.tolist(), self.registers[lanes, a].tolist()):
+            self.output[lane].append(f'{value}\n')
+        self.PC[lanes] += 2
+
+    def op_pra(self, lanes):
+        lanes, a, b = self.operands(lanes, 2)
+        lanes, a, b = self.registers_only(lanes, a, b)
+        for lane, value in zip(lanes.tolist(), self.registers[lanes, a].tolist()):
+            self.output[lane].append(chr(value))
+        self.PC[lanes] += 2
+
+    def op_st(self, lanes):
+        lanes, a, b = self.operands(lanes, 3)
+        lanes, a, b = self.registers_only(lanes, a, b, check_b=True)
+        address = self.registers[lanes, a].astype(np.intp)
+        self.memory[lanes, address] = self.registers[lanes, b]
+        self.PC[lanes] += 3
+
+    def op_ld(self, lanes):
+        lanes, a, b = self.operands(lanes, 3)
+        lanes, a, b = self.registers_only(lanes, a, b, check_b=True)
+        address = self.registers[lanes, b].astype(np.intp)
+        self.registers[lanes, a] = self.memory[lanes, address]
+        self.PC[lanes] += 3
+
+    def op_int(self, lanes):
+        lanes, a, b = self.operands(lanes, 2)
+        lanes, a, b = self.registers_only(lanes, a, b)
+        bit = np.left_shift(1, self.registers[lanes, a] & 7).astype(np.uint8)
+        self.registers[lanes, IS] |= bit
+        self.pending[lanes] = True
+        self.PC[lanes] += 2
+
+    def stack_push(self, lanes, values):
+        """ CPU.stack_push() for a group of lanes; returns the lanes that didn't fault """
+
+        sp = self.registers[lanes, SP].astype(np.intp)
+        ok = sp > 0
+        lanes, sp, values = self.split(lanes, ~ok, 'ValueError'), sp[ok] - 1, values[ok]
+        self.registers[lanes, SP] = sp
+        # SP is already decremented when a value too big for memory faults
+        ok = values <= 255
+        lanes, sp, values = self.split(lanes, ~ok, 'ValueError'), sp[ok], values[ok]
+        self.memory[lanes, sp] = values
+        return lanes
+
+    def stack_pop(self, lanes):
+        """ CPU.stack_pop() for a group of lanes; returns (lanes, values) """
+
+        sp = self.registers[lanes, SP].astype(np.intp)
+        values = self.memory[lanes, sp]
+        ok = sp != 255
+        lanes = self.split(lanes, ~ok, 'ValueError')
+        self.registers[lanes, SP] = sp[ok] + 1
+        return lanes, values[ok]
+
+    def op_iret(self, lanes):
+        for r in range(6, -1, -1):
+            lanes, values = self.stack_pop(lanes)
+            self.registers[lanes, r] = values
+        lanes, values = self.stack_pop(lanes)
+        self.FL[lanes] = values
+        lanes, values = self.stack_pop(lanes)
+        self.PC[lanes] = values
+        self.enabled[lanes] = True
+        self.pending[lanes] = True
+
+    def op_hlt(self, lanes):
+        self.status[lanes] = HALTED
+
+    def op_push(self, lanes):
+        lanes, a, b = self.operands(lanes, 2)
+        lanes, a, b = self.registers_only(lanes, a, b)
+        value = self.registers[lanes, a]
+        sp = self.registers[lanes, SP].astype(np.intp)
+        ok = sp > 0
+        lanes, value, sp = self.split(lanes, ~ok, 'ValueError'), value[ok], sp[ok] - 1
+        self.registers[lanes, SP] = sp
+        self.memory[lanes, sp] = value
+        self.PC[lanes] += 2
+
+    def op_pop(self, lanes):
+        lanes, a, b = self.operands(lanes, 2)
+        lanes, a, b = self.registers_only(lanes, a, b)
+        sp = self.registers[lanes, SP].astype(np.intp)
+        self.registers[lanes, a] = self.memory[lanes, sp]
+        # The register is written before SP is incremented, as in CPU
+        sp = self.registers[lanes, SP].astype(np.intp)
+        lanes, sp = self.split(lanes, sp == 255, 'ValueError'), sp[sp != 255]
+        self.registers[lanes, SP] = sp + 1
+        self.PC[lanes] += 2
+
+    def op_call(self, lanes):
+        # In handle_call()'s order: SP is decremented and the return
+        # address pushed before the operand is read. A CALL at 0xFE or
+        # 0xFF faults on the push (return address past 255), never on the
+        # operand, and leaves SP decremented
+        sp = self.registers[lanes, SP].astype(np.intp)
+        ok = sp > 0
+        lanes, sp = self.split(lanes, ~ok, 'ValueError'), sp[ok] - 1
+        self.registers[lanes, SP] = sp
+        ret = self.PC[lanes] + 2
+        ok = ret <= 255
+        lanes, sp, ret = self.split(lanes, ~ok, 'ValueError'), sp[ok], ret[ok]
+        self.memory[lanes, sp] = ret
+        # CPU reads the operand after the push, which may have overwritten it
+        a = self.memory[lanes, self.PC[lanes] + 1].astype(np.intp)
+        lanes, a, _ = self.registers_only(lanes, a, a)
+        self.PC[lanes] = self.registers[lanes, a]
+
+    def op_ret(self, lanes):
+        sp = self.registers[lanes, SP].astype(np.intp)
+        self.PC[lanes] = self.memory[lanes, sp]
+        lanes, sp = self.split(lanes, sp == 255, 'ValueError'), sp[sp != 255]
+        self.registers[lanes, SP] = sp + 1
+
+    def op_jmp(self, lanes):
+        lanes, a, b = self.operands(lanes, 2)
+        lanes, a, b = self.registers_only(lanes, a, b)
+        self.PC[lanes] = self.registers[lanes, a]
+
+    def branch(self, lanes, taken):
+        """ Jump where `taken`, otherwise step over the instruction """
+
+        self.PC[lanes[~taken]] += 2
+        self.op_jmp(lanes[taken])
+
+    """
+    Handlers shared by several opcodes are called once per opcode, so every
+    lane in `lanes` is running the same instruction.
+    """
+
+    def op_branch(self, lanes):
+        taken = BRANCH_ARRAYS[int(self.memory[lanes[0], self.PC[lanes[0]]])]
+        self.branch(lanes, taken[self.FL[lanes]])
+
+    def op_alu(self, lanes):
+        op = int(self.memory[lanes[0], self.PC[lanes[0]]])
+        lanes, a, b = self.operands(lanes, 3)
+        lanes, a, b = self.registers_only(lanes, a, b, check_b=True)
+        vb = self.registers[lanes, b]
+        if op in DIVISIONS:
+            ok = vb != 0
+            lanes, a, b, vb = (self.split(lanes, ~ok, 'ZeroDivisionError'),
+                               a[ok], b[ok], vb[ok])
+        va = self.registers[lanes, a].astype(np.intp)
+        self.registers[lanes, a] = BINARY_ARRAYS[op][va << 8 | vb]
+        self.PC[lanes] += 3
+
+    def op_alu_unary(self, lanes):
+        op = int(self.memory[lanes[0], self.PC[lanes[0]]])
+        lanes, a, b = self.operands(lanes, 2)
+        lanes, a, b = self.registers_only(lanes, a, b)
+        self.registers[lanes, a] = UNARY_ARRAYS[op][self.registers[lanes, a]]
+        self.PC[lanes] += 2
+
+    def op_cmp(self, lanes):
+        lanes, a, b = self.operands(lanes, 3)
+        lanes, a, b = self.registers_only(lanes, a, b, check_b=True)
+        va = self.registers[lanes, a].astype(np.intp)
+        self.FL[lanes] = COMPARE_ARRAY[va << 8 | self.registers[lanes, b]]
+        self.PC[lanes] += 3
+
+    def check_interrupts(self, lanes):
+        """ CPU.check_interrupts() for the lanes with `pending` set """
+
+        self.pending[lanes] = False
+        masked = self.registers[lanes, IM] & self.registers[lanes, IS]
+        lanes = lanes[self.enabled[lanes] & (masked != 0)]
+        if not len(lanes):
+            return
+
+        masked = self.registers[lanes, IM] & self.registers[lanes, IS]
+        number = LOWEST_BIT[masked]
+        self.enabled[lanes] = False
+        self.registers[lanes, IS] &= ~np.left_shift(1, number).astype(np.uint8)
+
+        vector = I0_VECTOR + number
+        pushing = self.stack_push(lanes, self.PC[lanes])
+        pushing = self.stack_push(pushing, self.FL[pushing].astype(np.int32))
+        for r in range(7):
+            pushing = self.stack_push(pushing,
+                                      self.registers[pushing, r].astype(np.int32))
+
+        # Lanes stay in order, so the survivors' vectors are a masked subset
+        vector = vector[np.isin(lanes, pushing)]
+        self.PC[pushing] = self.memory[pushing, vector]
+
+    def step(self):
+        """ Execute one instruction on every running lane """
+
+        lanes = np.flatnonzero(self.status == RUNNING)
+        waiting = lanes[self.pending[lanes]]
+        if len(waiting):
+            self.check_interrupts(waiting)
+            lanes = np.flatnonzero(self.status == RUNNING)
+        lanes = self.split(lanes, self.PC[lanes] > 255, 'IndexError')
+        if not len(lanes):
+            return 0
+
+        self.instructions[lanes] += 1
+        ops = self.memory[lanes, self.PC[lanes]]
+
+        for op in np.unique(ops).tolist():
+            group = lanes[ops == op]
+            handler = self.handlers.get(op)
+            if handler is None:
+                self.fault(group, 'KeyError')
+            else:
+                handler(group)
+
+        return len(lanes)
+
+    def run(self, max_steps=None):
+        """
+        Step until every lane has halted or faulted, or `max_steps` steps have
+        been taken. Returns the number of steps.
+        """
+
+        steps = 0
+        while max_steps is None or steps < max_steps:
+            if not self.step():
+                break
+            steps += 1
+        return steps
+
+    def lane_output(self, lane):
+        """ What CPU.run() would have printed for this lane """
+
+        return ''.join(self.output[lane])
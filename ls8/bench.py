@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for the emulator engines and the assembler.
+
+Runs the programs in examples/ plus synthetic long-running workloads under
+every engine, and under the interpreter with reverse-execution recording on
+(the `record` rows), reporting instructions/second, wall time and peak
+memory and the decoded engine's superinstruction hits (the `fused` rows),
+and times asm.py's pass1/pass2 on a large generated source. Results can be
+saved as JSON and compared against a stored baseline.
+
+Usage: bench.py [--engines a,b] [--repeat N] [--quick]
+                [--save results.json] [--baseline base.json] [--threshold F]
+"""
+
+import io
+import os
+import sys
+import glob
+import json
+import time
+import platform
+import argparse
+import tempfile
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'asm'))
+
+import asm
+import ls8b
+from ls8 import ENGINES
+from sinks import MemorySink
+from cpu import CPU, DEADLINE, FAULT
+from reverse import Recorder
+from decoded import DecodedCPU
+
+""" Pseudo-engine: the interpreter with a reverse.Recorder attached """
+RECORD = 'record'
+
+""" Seconds before a single program run is abandoned """
+TIMEOUT = 30
+
+""" Examples that wait for device interrupts forever; bench attaches no devices """
+SKIP_EXAMPLES = {'interrupts.ls8', 'keyboard.ls8'}
+
+""" Runs shorter than this are too noisy to count as regressions """
+MIN_COMPARE_SECONDS = 0.001
+
+"""
+Synthetic workloads, as assembly templates. They avoid R5/R6 (interrupt
+mask and status) and loop with ADD/CMP/JNE, so every one halts.
+"""
+WORKLOADS = {
+    'tight_loop': '''
+        LDI R1,1
+        LDI R2,250
+        LDI R4,0
+    Outer:
+        LDI R0,0
+        LDI R3,Inner
+    Inner:
+        ADD R0,R1
+        CMP R0,R2
+        JNE R3
+        ADD R4,R1
+        LDI R0,{outer}
+        CMP R4,R0
+        LDI R3,Outer
+        JNE R3
+        HLT
+    ''',
+
+    'call_recursion': '''
+        LDI R1,1
+        LDI R4,0
+    Again:
+        LDI R0,100
+        LDI R2,Rec
+        CALL R2
+        ADD R4,R1
+        LDI R0,{outer}
+        CMP R4,R0
+        LDI R3,Again
+        JNE R3
+        HLT
+    Rec:
+        LDI R3,0
+        CMP R0,R3
+        LDI R3,Done
+        JEQ R3
+        SUB R0,R1
+        CALL R2
+    Done:
+        RET
+    ''',
+
+    'push_pop': '''
+        LDI R1,1
+        LDI R2,0
+    Outer:
+        LDI R4,0
+    Loop:
+        PUSH R0
+        PUSH R1
+        PUSH R2
+        PUSH R3
+        PUSH R4
+        PUSH R0
+        PUSH R1
+        PUSH R2
+        POP R2
+        POP R1
+        POP R0
+        POP R4
+        POP R3
+        POP R2
+        POP R1
+        POP R0
+        ADD R4,R1
+        LDI R0,250
+        CMP R4,R0
+        LDI R3,Loop
+        JNE R3
+        ADD R2,R1
+        LDI R0,{outer}
+        CMP R2,R0
+        LDI R3,Outer
+        JNE R3
+        HLT
+    ''',
+
+    'mul_loop': '''
+        LDI R1,1
+        LDI R2,0
+    Outer:
+        LDI R4,0
+    Loop:
+        LDI R0,3
+        MUL R0,R1
+        ADD R0,R0
+        SUB R0,R1
+        MUL R0,R1
+        SUB R0,R1
+        MUL R0,R1
+        ADD R4,R1
+        LDI R0,250
+        CMP R4,R0
+        LDI R3,Loop
+        JNE R3
+        ADD R2,R1
+        LDI R0,{outer}
+        CMP R2,R0
+        LDI R3,Outer
+        JNE R3
+        HLT
+    ''',
+}
+
+""" Loop counts: the full suite, and --quick """
+OUTER = {'full': 250, 'quick': 20}
+
+
+def workload_programs(size):
+    """ Assemble the synthetic workloads; returns {name: .ls8 text lines} """
+
+    programs = {}
+    for name, template in WORKLOADS.items():
+        image, symbols, _ = asm.assemble(template.format(outer=OUTER[size]))
+        programs[name] = ls8b.to_text(image, symbols)
+    return programs
+
+
+def example_programs():
+    programs = {}
+    for path in sorted(glob.glob(os.path.join(HERE, 'examples', '*.ls8'))):
+        if os.path.basename(path) in SKIP_EXAMPLES:
+            continue
+        with open(path) as f:
+            programs[os.path.basename(path)] = f.read().split('\n')
+    return programs
+
+
+def run_once(engine, program, measure_memory=False):
+    """
+    Run `program` on a fresh CPU of the given engine.
+
+    Returns (status, instructions, seconds, peak bytes or None).
+    """
+
+    if engine == RECORD:
+        cpu = CPU()
+        recorder = Recorder(cpu)
+    else:
+        cpu = ENGINES[engine]()
+        recorder = None
+    cpu.output = MemorySink()
+    cpu.load(program)
+
+    peak = None
+
+    if measure_memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    try:
+        result = cpu.run(deadline=time.monotonic() + TIMEOUT,
+                         recorder=recorder)
+    finally:
+        seconds = time.perf_counter() - start
+        if measure_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    if result.status == DEADLINE:
+        status = 'timeout'
+    elif result.status == FAULT:
+        status = f'fault: {type(result.error).__name__}'
+    else:
+        status = result.status
+
+    return status, result.instructions, seconds, peak
+
+
+def bench_program(engine, program, repeat):
+    """ Best-of-`repeat` timing, plus one run under tracemalloc for memory """
+
+    best = None
+    for _ in range(repeat):
+        status, instructions, seconds, _ = run_once(engine, program)
+        if best is None or seconds < best[2]:
+            best = (status, instructions, seconds)
+
+    status, instructions, seconds = best
+    peak = run_once(engine, program, measure_memory=True)[3]
+
+    return {
+        'status': status,
+        'instructions': instructions,
+        'seconds': seconds,
+        'ips': instructions / seconds if seconds else 0.0,
+        'peak_bytes': peak,
+    }
+
+
+def fusion_hits(program):
+    """ Hits of each superinstruction in one run of `program`, on the decoded engine """
+
+    cpu = DecodedCPU()
+    cpu.output = MemorySink()
+    cpu.load(program)
+    cpu.run(deadline=time.monotonic() + TIMEOUT)
+    return dict(cpu.fusion_stats)
+
+
+def generate_source(lines):
+    """
+    A large, valid assembly source of about `lines` lines. It doesn't fit
+    in memory, but every label it refers to does.
+    """
+
+    groups = lines // 8
+    # Each group is 18 bytes; labels past the first 256 can't be immediates
+    targets = min(groups, 256 // 18)
+    body = []
+    for i in range(groups):
+        body.append(f'L{i}:')
+        body.append(f'    LDI R{i % 5},{i % 256}')
+        body.append(f'    LDI R3,L{(i + 1) % targets}')
+        body.append('    ADD R0,R1 ; comment')
+        body.append('    CMP R0,R2')
+        body.append('    PUSH R4')
+        body.append('    POP R4')
+        body.append('    JNE R3')
+    return body
+
+
+def bench_assembler(lines, repeat):
+    """ Time pass1 + pass2 on a generated source; returns results by name """
+
+    source = generate_source(lines)
+    best = {'pass1': None, 'pass2': None}
+
+    for _ in range(repeat):
+        sym = {}
+        code = []
+        start = time.perf_counter()
+        asm.pass1(source, sym, code)
+        middle = time.perf_counter()
+        asm.pass2(io.StringIO(), sym, code)
+        end = time.perf_counter()
+
+        for name, seconds in (('pass1', middle - start), ('pass2', end - middle)):
+            if best[name] is None or seconds < best[name]:
+                best[name] = seconds
+
+    return {
+        f'asm/{name}': {
+            'lines': len(source),
+            'seconds': seconds,
+            'lines_per_s': len(source) / seconds if seconds else 0.0,
+        }
+        for name, seconds in best.items()
+    }
+
+
+def recording_overhead(results):
+    """ Total record/ time over total interp/ time for the same programs """
+
+    interp = recorded = 0.0
+    for key, r in results.items():
+        engine, _, name = key.partition('/')
+        if engine == RECORD and f'interp/{name}' in results:
+            recorded += r['seconds']
+            interp += results[f'interp/{name}']['seconds']
+    return recorded / interp if interp else None
+
+
+def throughput(result):
+    return result.get('ips', result.get('lines_per_s', 0.0))
+
+
+def compare(results, baseline, threshold):
+    """ Return (name, old, new) for every benchmark slower than the threshold """
+
+    regressions = []
+    for name, old in baseline['results'].items():
+        new = results['results'].get(name)
+        if (new is None or throughput(old) == 0
+                or old['seconds'] < MIN_COMPARE_SECONDS):
+            continue
+        if throughput(new) < throughput(old) * (1 - threshold):
+            regressions.append((name, throughput(old), throughput(new)))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='bench.py')
+    parser.add_argument('--engines',
+                        default=','.join(sorted(ENGINES) + [RECORD]),
+                        help='comma-separated engines (default: all, and record)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per benchmark; the best is kept')
+    parser.add_argument('--quick', action='store_true',
+                        help='smaller workloads, for a fast sanity check')
+    parser.add_argument('--save', metavar='FILE', help='write results as JSON')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare against results saved earlier')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='slowdown that counts as a regression (default 0.10)')
+    args = parser.parse_args(argv[1:])
+
+    size = 'quick' if args.quick else 'full'
+    programs = example_programs()
+    programs.update(workload_programs(size))
+
+    # Keep the compiled engine's translations out of the user's cache
+    os.environ.setdefault('LS8C_CACHE', tempfile.mkdtemp(prefix='ls8c-bench-'))
+
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'size': size,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': {},
+    }
+
+    print(f"{'benchmark':40} {'status':16} {'instructions':>12} "
+          f"{'seconds':>10} {'ins/s':>12} {'peak KiB':>9}")
+
+    for engine in args.engines.split(','):
+        for name, program in programs.items():
+            r = bench_program(engine, program, args.repeat)
+            key = f'{engine}/{name}'
+            results['results'][key] = r
+            print(f"{key:40} {r['status']:16} {r['instructions']:12} "
+                  f"{r['seconds']:10.6f} {r['ips']:12,.0f} "
+                  f"{r['peak_bytes'] / 1024:9.1f}")
+
+    if 'decoded' in args.engines.split(','):
+        results['fusions'] = {}
+        for name, program in programs.items():
+            hits = fusion_hits(program)
+            results['fusions'][name] = hits
+            fused = ', '.join(f'{fusion} {n}' for fusion, n in hits.items() if n)
+            print(f"{'fused/' + name:40} {fused or '-'}")
+
+    overhead = recording_overhead(results['results'])
+    if overhead is not None:
+        print(f"recording overhead vs interp: {overhead:.2f}x")
+
+    for key, r in bench_assembler(2_000 if args.quick else 20_000,
+                                  args.repeat).items():
+        results['results'][key] = r
+        print(f"{key:40} {'':16} {r['lines']:12} {r['seconds']:10.6f} "
+              f"{r['lines_per_s']:12,.0f} lines/s")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for name, old, new in regressions:
+            print(f"REGRESSION {name}: {old:,.0f} -> {new:,.0f} "
+                  f"({(new / old - 1) * 100:+.1f}%)")
+        if regressions:
+            return 1
+        print(f"no regressions beyond {args.threshold:.0%} against {args.baseline}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
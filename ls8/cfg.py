@@ -0,0 +1,628 @@
+#!/usr/bin/env python3
+
+"""
+Static analysis of LS-8 images.
+
+`analyze()` takes a 256-byte image (and optionally its symbols) and finds
+its structure without running it:
+
+* basic blocks, and the control-flow graph between them, with the targets
+  of asm.py's `LDI Rx,label` + `JMP/CALL Rx` (or a conditional jump)
+  resolved whenever the `LDI` is in the same block
+* interrupt handlers installed with `LDI`/`ST` into the vector table
+* reachability from the entry point and the handlers
+* functions (call targets) with the most stack each one, and the deepest
+  call path below it, can use
+* which bytes are code and which are data
+
+`uses_interrupts()` tells whether a program could notice the devices.
+
+Each instruction is decoded once, so the analysis is linear in the size of
+the image. It is shared by the compiled engines (ls8c's block discovery),
+the profiler, the tracer's disassembly, and ls8.py and ls8d, which ask
+`uses_interrupts()` before deciding how to run a program.
+
+    program = analyze(memory, symbols)
+    program.blocks[0].successors
+    program.functions[0].depth
+
+Usage: cfg.py program.ls8
+"""
+
+import sys
+
+from cpu import *
+import ls8b
+
+""" Instruction sizes in bytes, as executed by `CPU.run()` """
+SIZES = {
+    LDI: 3, PRN: 2, PRA: 2, HLT: 1, PUSH: 2, POP: 2, CALL: 2, RET: 1,
+    JMP: 2, CMP: 3, ST: 3, LD: 3, INT: 2, IRET: 1,
+}
+SIZES.update(dict.fromkeys(BRANCH_OPS, 2))
+SIZES.update(dict.fromkeys(BINARY_OPS, 3))
+SIZES.update(dict.fromkeys(UNARY_OPS, 2))
+
+""" Instructions that end a basic block """
+TERMINATORS = {HLT, CALL, RET, JMP, INT, IRET} | set(BRANCH_OPS)
+
+""" Instructions that overwrite the register in their first operand """
+WRITES_A = {LDI, LD, POP} | set(BINARY_OPS) | set(UNARY_OPS)
+
+""" Edge kinds in the control-flow graph """
+FALLTHROUGH = 'fallthrough'  # next instruction, including a CALL's return site
+JUMP = 'jump'
+BRANCH = 'branch'            # a conditional jump, taken
+CALLS = 'call'
+
+""" Byte classes of `Program.kinds` """
+DATA = 0
+OPCODE = 1
+OPERAND = 2
+
+""" Bytes an interrupt pushes before entering its handler: PC, FL, R0-R6 """
+INTERRUPT_FRAME = 9
+
+
+def decode(memory, address):
+    """ Return (opcode, operand_a, operand_b, size), or None if not translatable """
+
+    op = memory[address]
+    size = SIZES.get(op)
+    if size is None or address + size > 256:
+        return None
+    a = memory[address + 1] if size > 1 else 0
+    b = memory[address + 2] if size > 2 else 0
+    return op, a, b, size
+
+
+def track(known, op, a, b):
+    """
+    Update `known` (register -> constant loaded by LDI) for one
+    instruction. Anything else writing a register, or the stack pointer,
+    forgets it.
+    """
+
+    if op == LDI:
+        known[a] = b
+    elif op in (PUSH, POP):
+        known.pop(SP, None)
+        if op == POP:
+            known.pop(a, None)
+    else:
+        known.pop(a, None)
+
+
+class Block:
+    """
+    A basic block: `instructions` as (address, opcode, a, b, size), and
+    `successors` as (kind, address) edges. `indirect` is set when it ends in
+    a jump or call whose target is not known statically; `invalid` is the
+    address of an instruction that does not decode, if the block ran into one.
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.instructions = []
+        self.successors = []
+        self.predecessors = []
+        self.indirect = False
+        self.invalid = None
+        self.handlers = set()  # interrupt handlers it installs
+
+    @property
+    def end(self):
+        """ Address just past the last instruction """
+
+        if not self.instructions:
+            return self.start
+        address, _, _, _, size = self.instructions[-1]
+        return address + size
+
+    def __repr__(self):
+        return (f'<Block {self.start:02x}-{self.end:02x} '
+                f'-> {[f"{kind}:{target:02x}" for kind, target in self.successors]}>')
+
+
+class Function:
+    """
+    A call target, the entry point or an interrupt handler.
+
+    `blocks` are the block starts reachable from `entry` without following
+    calls. `local` is the most the function itself pushes (return addresses
+    of its calls included), `depth` the most it and everything it calls can
+    push, and `path` the entries along the call path reaching `depth`.
+    Either is None when it cannot be bounded statically: recursion, calls
+    through unknown registers, `SP` changed by other means than
+    `PUSH`/`POP`/`CALL`, or loops that push.
+    """
+
+    def __init__(self, entry, name, kind):
+        self.entry = entry
+        self.name = name
+        self.kind = kind
+        self.blocks = set()
+        self.calls = set()
+        self.call_sites = []  # (depth including the return address, target or None)
+        self.local = None
+        self.depth = None
+        self.path = ()
+
+    def __repr__(self):
+        return f'<Function {self.name} depth={self.depth}>'
+
+
+class Program:
+    """ The result of `analyze()` """
+
+    def __init__(self, memory, symbols, entry):
+        self.memory = memory
+        self.entry = entry
+        self.blocks = {}
+        self.functions = {}
+        self.handlers = set()
+        self.unresolved = set()  # addresses of jumps/calls with unknown targets
+        self.invalid = set()     # reachable addresses that do not decode
+        self.kinds = bytearray(256)
+
+        # Address -> label, for naming
+        self.labels = {}
+        for name, address in (symbols or {}).items():
+            self.labels.setdefault(address, name)
+
+    @property
+    def reachable(self):
+        """ Start addresses of every block reachable from the entry or a handler """
+
+        return set(self.blocks)
+
+    @property
+    def complete(self):
+        """ False if an indirect jump may lead to code the analysis did not see """
+
+        return not self.unresolved
+
+    @property
+    def max_stack_depth(self):
+        """
+        Most bytes the program can push below its initial `SP`: the entry's
+        call tree plus, if handlers are installed, the deepest of them on
+        top of its interrupt frame. None if any of it is unbounded.
+        """
+
+        depth = self.functions[self.entry].depth
+        handlers = [self.functions[h].depth for h in self.handlers]
+        if depth is None or None in handlers:
+            return None
+        # Interrupts are disabled inside handlers, so they never nest
+        return depth + (INTERRUPT_FRAME + max(handlers) if handlers else 0)
+
+    def reachable_from(self, start):
+        """ Block starts reachable from `start` along any edge """
+
+        seen = set()
+        worklist = [start]
+        while worklist:
+            address = worklist.pop()
+            if address in seen or address not in self.blocks:
+                continue
+            seen.add(address)
+            worklist.extend(target for _, target in self.blocks[address].successors)
+        return seen
+
+    def block_at(self, address):
+        """ The block containing the instruction at `address`, or None """
+
+        for block in self.blocks.values():
+            for start, _, _, _, _ in block.instructions:
+                if start == address:
+                    return block
+        return None
+
+    def name(self, address):
+        if address in self.labels:
+            return self.labels[address]
+        return f'sub_{address:02x}'
+
+
+def find_leaders(memory, roots):
+    """
+    Walk every path from `roots`, decoding each instruction once. Returns
+    the block leaders: the roots, jump and call targets, return sites and
+    any address a walk ran into that an earlier one had already decoded.
+    """
+
+    leaders = set(roots)
+    decoded = bytearray(256)
+    worklist = list(roots)
+
+    def add(address):
+        if address not in leaders:
+            leaders.add(address)
+            worklist.append(address)
+
+    while worklist:
+        address = worklist.pop()
+        known = {}
+        while True:
+            if decoded[address]:
+                leaders.add(address)
+                break
+            ins = decode(memory, address)
+            if ins is None:
+                break
+            decoded[address] = 1
+            op, a, b, size = ins
+
+            if op in TERMINATORS:
+                if (op in (JMP, CALL) or op in BRANCH_OPS) and a in known:
+                    add(known[a])
+                if (op in (CALL, INT) or op in BRANCH_OPS) and address + size < 256:
+                    add(address + size)
+                break
+
+            vector = installs_handler(known, op, a, b)
+            if vector is not None:
+                add(vector)
+
+            track(known, op, a, b)
+            address += size
+            if address >= 256:
+                break
+
+    return leaders
+
+
+def installs_handler(known, op, a, b):
+    """ The handler address if this is an `ST` of a constant into the vector table """
+
+    if op == ST and a in known and b in known:
+        if I0_VECTOR <= known[a] < I0_VECTOR + 8:
+            return known[b]
+    return None
+
+
+def build_block(memory, start, leaders, known):
+    """
+    Decode the block at `start`, up to its terminator or the next leader,
+    with `known` the register constants on entry. Returns the block and the
+    constants on exit.
+    """
+
+    block = Block(start)
+    address = start
+
+    while True:
+        ins = decode(memory, address)
+        if ins is None:
+            block.invalid = address
+            break
+        op, a, b, size = ins
+        block.instructions.append((address, op, a, b, size))
+        next_pc = address + size
+
+        if op in TERMINATORS:
+            kind = {JMP: JUMP, CALL: CALLS}.get(op, BRANCH)
+            if op in (JMP, CALL) or op in BRANCH_OPS:
+                if a in known:
+                    block.successors.append((kind, known[a]))
+                else:
+                    block.indirect = True
+            if (op in (CALL, INT) or op in BRANCH_OPS) and next_pc < 256:
+                block.successors.append((FALLTHROUGH, next_pc))
+            break
+
+        vector = installs_handler(known, op, a, b)
+        if vector is not None:
+            block.handlers.add(vector)
+
+        track(known, op, a, b)
+        if next_pc >= 256:
+            break
+        if next_pc in leaders:
+            block.successors.append((FALLTHROUGH, next_pc))
+            break
+        address = next_pc
+
+    return block, known
+
+
+def clobbers(memory, entry):
+    """
+    Registers the code reachable from `entry` may write before returning,
+    found with the same kind of walk as `find_leaders()`; None if it reaches
+    a jump or call it cannot resolve
+    """
+
+    written = {SP}
+    seen = bytearray(256)
+    worklist = [entry]
+
+    while worklist:
+        address = worklist.pop()
+        known = {}
+        while address < 256 and not seen[address]:
+            ins = decode(memory, address)
+            if ins is None:
+                break
+            seen[address] = 1
+            op, a, b, size = ins
+            if op in WRITES_A:
+                written.add(a)
+
+            if op in TERMINATORS:
+                if op in (JMP, CALL) or op in BRANCH_OPS:
+                    if a not in known:
+                        return None
+                    worklist.append(known[a])
+                if op in (CALL, INT) or op in BRANCH_OPS:
+                    worklist.append(address + size)
+                break
+
+            track(known, op, a, b)
+            address += size
+
+    return written
+
+
+def propagate(memory, leaders, entry):
+    """
+    Build the blocks reachable from `entry`, carrying the LDI constants
+    known at the end of each block into its successors: a register keeps its
+    constant only if every edge into a block agrees on it. Each block is
+    rebuilt only when its entry constants shrink, at most once per register.
+    """
+
+    states = {entry: {}}
+    blocks = {}
+    worklist = [entry]
+    written = {}  # callee -> clobbers()
+
+    def enter(target, known):
+        state = states.get(target)
+        if state is None:
+            states[target] = dict(known)
+        else:
+            merged = {r: v for r, v in state.items() if known.get(r) == v}
+            if merged == state:
+                return
+            states[target] = merged
+        worklist.append(target)
+
+    while worklist:
+        start = worklist.pop()
+        block, known = build_block(memory, start, leaders, dict(states[start]))
+        blocks[start] = block
+
+        last = block.instructions[-1][1] if block.instructions else None
+        after = known
+        if last == INT:
+            after = {}
+        elif last == CALL:
+            # Constants survive a call in the registers the callee leaves alone
+            callees = [target for kind, target in block.successors if kind == CALLS]
+            if callees and callees[0] not in written:
+                written[callees[0]] = clobbers(memory, callees[0])
+            clobbered = written[callees[0]] if callees else None
+            after = {} if clobbered is None else {
+                r: v for r, v in known.items() if r not in clobbered}
+
+        for kind, target in block.successors:
+            enter(target, after if kind == FALLTHROUGH else known)
+        for handler in block.handlers:
+            enter(handler, {})
+
+    return blocks
+
+
+def stack_usage(program, function):
+    """
+    Fill in `function.blocks`, `calls`, `call_sites` and `local` by walking
+    its blocks with the stack depth at the start of each
+    """
+
+    blocks = program.blocks
+    depth_at = {function.entry: 0}
+    worklist = [function.entry]
+    deepest = 0
+    bounded = True
+
+    while worklist:
+        start = worklist.pop()
+        function.blocks.add(start)
+        block = blocks.get(start)
+        if block is None:
+            continue
+        depth = depth_at[start]
+
+        for address, op, a, b, size in block.instructions:
+            if op == PUSH:
+                depth += 1
+            elif op == POP:
+                depth -= 1
+            elif op == CALL:
+                targets = [t for kind, t in block.successors if kind == CALLS]
+                target = targets[0] if targets else None
+                function.call_sites.append((depth + 1, target))
+                if target is not None:
+                    function.calls.add(target)
+                deepest = max(deepest, depth + 1)
+            if op in WRITES_A and a == SP:
+                bounded = False
+            deepest = max(deepest, depth)
+
+        for kind, target in block.successors:
+            if kind == CALLS:
+                continue
+            if target not in depth_at:
+                depth_at[target] = depth
+                worklist.append(target)
+            elif depth_at[target] != depth:
+                # Reached with two different depths: a loop that pushes
+                bounded = False
+
+    function.local = deepest if bounded else None
+
+
+def call_depth(program, entry, active, done):
+    """
+    Set `depth` and `path` of the function at `entry` and its callees;
+    returns the depth
+    """
+
+    function = program.functions[entry]
+    if entry in done:
+        return function.depth
+    if entry in active:
+        return None  # recursion
+
+    active.add(entry)
+    depth, path = function.local, (entry,)
+    for site, target in function.call_sites:
+        if depth is None:
+            break
+        inner = None if target is None else call_depth(program, target, active, done)
+        if inner is None:
+            depth = None
+        elif site + inner >= depth:
+            depth, path = site + inner, (entry,) + program.functions[target].path
+    active.discard(entry)
+    done.add(entry)
+
+    function.depth = depth
+    function.path = path if depth is not None else ()
+    return depth
+
+
+def analyze(memory, symbols=None, entry=0):
+    """ Analyze a 256-byte image; returns a `Program` """
+
+    memory = bytes(memory[:256]).ljust(256, b'\0')
+    program = Program(memory, symbols, entry)
+
+    # Constant propagation can resolve jumps the first walk could not; those
+    # targets become leaders too, and the blocks are rebuilt around them
+    roots = {entry}
+    while True:
+        leaders = find_leaders(memory, roots)
+        blocks = propagate(memory, leaders, entry)
+        targets = {target for block in blocks.values()
+                   for _, target in block.successors}
+        targets.update(*(block.handlers for block in blocks.values()))
+        if targets <= leaders:
+            break
+        roots |= targets
+
+    # Keep the blocks still reached along the final edges; earlier builds
+    # with more constants known may have led to others
+    live = {}
+    worklist = [entry]
+    while worklist:
+        start = worklist.pop()
+        if start in live or start not in blocks:
+            continue
+        live[start] = block = blocks[start]
+        worklist.extend(target for _, target in block.successors)
+        worklist.extend(block.handlers)
+
+    for start, block in sorted(live.items()):
+        if block.invalid is not None:
+            program.invalid.add(block.invalid)
+        if block.indirect:
+            program.unresolved.add(block.instructions[-1][0])
+        program.handlers |= block.handlers
+        if block.instructions:
+            program.blocks[start] = block
+
+    for block in program.blocks.values():
+        for kind, target in block.successors:
+            if target in program.blocks:
+                program.blocks[target].predecessors.append((kind, block.start))
+        for address, op, a, b, size in block.instructions:
+            program.kinds[address] = OPCODE
+            for offset in range(1, size):
+                program.kinds[address + offset] = OPERAND
+
+    # Functions: the entry point, the handlers and every call target
+    kinds = {entry: 'main'}
+    kinds.update(dict.fromkeys(program.handlers, 'handler'))
+    for block in program.blocks.values():
+        for kind, target in block.successors:
+            if kind == CALLS:
+                kinds.setdefault(target, 'sub')
+    for address, kind in sorted(kinds.items()):
+        name = program.labels.get(address, '<main>' if kind == 'main' else None)
+        function = Function(address, name or program.name(address), kind)
+        program.functions[address] = function
+        stack_usage(program, function)
+    done = set()
+    for address in program.functions:
+        call_depth(program, address, set(), done)
+
+    return program
+
+
+def uses_interrupts(memory):
+    """
+    True unless the analysis shows the program can't notice devices: it
+    installs no handler, every jump resolves and no instruction names IM
+    or IS
+    """
+
+    program = analyze(memory)
+    if program.handlers or program.unresolved or program.invalid:
+        return True
+    for block in program.blocks.values():
+        for _, op, a, b, size in block.instructions:
+            registers = [a] if op == LDI else [a, b][:size - 1]
+            if IM in registers or IS in registers:
+                return True
+    return False
+
+
+def listing(program, file=sys.stdout):
+    """ Print the blocks, functions and code map of `program` """
+
+    for start, block in sorted(program.blocks.items()):
+        label = program.labels.get(start)
+        print(f"{start:02x}:{' ' + label if label else ''}", file=file)
+        for address, op, a, b, size in block.instructions:
+            operands = ','.join(str(x) for x in (a, b)[:size - 1])
+            print(f"    {address:02x}  {OPCODE_NAMES.get(op, '?'):5} {operands}", file=file)
+        edges = ', '.join(f'{kind} {target:02x}' for kind, target in block.successors)
+        if block.indirect:
+            edges = ', '.join(filter(None, [edges, 'indirect']))
+        print(f"    -> {edges or 'exit'}", file=file)
+
+    print("\nfunctions:              local  depth  deepest path", file=file)
+    for address, function in sorted(program.functions.items()):
+        path = ' > '.join(program.functions[e].name for e in function.path)
+        print(f"  {function.name:16} {function.kind:7} "
+              f"{'?' if function.local is None else function.local:>5} "
+              f"{'?' if function.depth is None else function.depth:>6}  {path}",
+              file=file)
+
+    depth = program.max_stack_depth
+    print(f"\nmax stack depth: {'unbounded' if depth is None else depth}", file=file)
+    print(f"code bytes: {sum(1 for k in program.kinds if k)} of 256"
+          f"{'' if program.complete else ' (indirect jumps unresolved)'}", file=file)
+
+
+def main(argv):
+    if len(argv) != 2:
+        print("usage: cfg.py program.ls8", file=sys.stderr)
+        return 1
+
+    path = argv[1]
+    if ls8b.is_binary(path):
+        image, symbols, _ = ls8b.read(path)
+    else:
+        with open(path) as f:
+            image, symbols, _ = ls8b.from_text(f.read().split('\n'))
+
+    listing(analyze(image, symbols))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,13 +1,26 @@
 """CPU functionality."""
 
 import sys
+import time
+import threading
+from collections import namedtuple
 from sys import argv
 
+import ls8b
+from alu import TABLES
+from sinks import StreamSink
+
+IM = 5
+IS = 6
 SP = 7
 CMP = 0b10100111
 JMP = 0b01010100
 JEQ = 0b01010101
 JNE = 0b01010110
+JLT = 0b01011000
+JLE = 0b01011001
+JGT = 0b01010111
+JGE = 0b01011010
 PRN = 0b01000111
 LDI = 0b10000010
 HLT = 0b00000001
@@ -22,7 +35,85 @@ SUB = 0b10100001
 ADD = 0b10100000
 DEC = 0b01100110
 INC = 0b01100101
+AND = 0b10101000
+OR = 0b10101010
+XOR = 0b10101011
+NOT = 0b01101001
+SHL = 0b10101100
+SHR = 0b10101101
 PRA = 0b01001000
+ST = 0b10000100
+LD = 0b10000011
+INT = 0b01010010
+IRET = 0b00010011
+
+""" ALU instructions taking two registers (Ra = Ra op Rb), and one (Ra = op Ra) """
+BINARY_OPS = {
+    ADD: 'ADD', SUB: 'SUB', MUL: 'MUL', DIV: 'DIV', MOD: 'MOD',
+    AND: 'AND', OR: 'OR', XOR: 'XOR', SHL: 'SHL', SHR: 'SHR',
+}
+UNARY_OPS = {INC: 'INC', DEC: 'DEC', NOT: 'NOT'}
+""" Conditional jumps, taken depending on the FL bits CMP sets """
+BRANCH_OPS = {JEQ: 'JEQ', JNE: 'JNE', JLT: 'JLT', JLE: 'JLE', JGT: 'JGT', JGE: 'JGE'}
+""" Every instruction's mnemonic, by opcode """
+OPCODE_NAMES = {
+    LDI: 'LDI', LD: 'LD', ST: 'ST', PRN: 'PRN', PRA: 'PRA', HLT: 'HLT',
+    PUSH: 'PUSH', POP: 'POP', CALL: 'CALL', RET: 'RET', JMP: 'JMP', CMP: 'CMP',
+    INT: 'INT', IRET: 'IRET', **BINARY_OPS, **UNARY_OPS, **BRANCH_OPS,
+}
+
+""" Their lookup tables from alu.py, by opcode """
+BINARY_TABLES = {op: TABLES[name] for op, name in BINARY_OPS.items()}
+UNARY_TABLES = {op: TABLES[name] for op, name in UNARY_OPS.items()}
+BRANCH_TABLES = {op: TABLES[name] for op, name in BRANCH_OPS.items()}
+COMPARE_TABLE = TABLES['CMP']
+""" ALU instructions that fault when Rb is 0 """
+DIVISIONS = {DIV, MOD}
+
+""" run() statuses """
+HALTED = 'halted'
+BUDGET = 'budget exhausted'
+DEADLINE = 'deadline passed'
+FAULT = 'fault'
+
+""" Instructions between deadline checks """
+DEADLINE_CHECK = 4096
+
+
+class Halt(Exception):
+    """ Raised by HLT to leave the run loop """
+
+
+"""
+What `run()` returns: the `status`, the `instructions` executed by this
+run, the exception for a fault (else None) and the final `pc`.
+"""
+RunResult = namedtuple('RunResult', 'status instructions error pc')
+
+"""
+What `snapshot()` returns: the whole machine state as immutable values, so
+one snapshot can be restored any number of times, into any number of CPUs
+or batch lanes. `device_writes` is a tuple of (interrupt, (address,
+value)) input not yet delivered.
+"""
+Snapshot = namedtuple('Snapshot', 'registers memory PC FL '
+                                  'interrupts_enabled pending raised '
+                                  'device_writes instructions')
+
+""" Interrupt vector table: the handler for interrupt n is at 0xF8 + n """
+I0_VECTOR = 0xF8
+""" The most recent key pressed """
+KEY_ADDRESS = 0xF4
+
+"""
+Instructions allowed in the body of a wait loop (`Loop: ... JMP Loop`), with
+their sizes: only ones that change nothing but registers.
+"""
+WAIT_LOOP_SIZES = {LDI: 3, LD: 3, CMP: 3}
+WAIT_LOOP_SIZES.update(dict.fromkeys(BINARY_OPS, 3))
+WAIT_LOOP_SIZES.update(dict.fromkeys(UNARY_OPS, 2))
+""" Longest wait loop body looked at, in bytes """
+MAX_WAIT_LOOP = 16
 
 
 
@@ -30,22 +121,7 @@ class CPU:
     """Main CPU class."""
 
     def __init__(self):
-        self.alu_ops = {
-            0b10100010: 'MUL',
-            0b10100011: 'DIV',
-            0b10100100: 'MOD',
-            0b10100001: 'SUB',
-            0b10100000: 'ADD',
-            0b10101011: 'XOR',
-            0b01101001: 'NOT',
-            0b10101010: 'OR',
-            0b01100101: 'INC',
-            0b01100110: 'DEC',
-            0b10100111: 'CMP',
-            0b10101100: 'SHL',
-            0b10101101: 'SHR',
-            0b10101000: 'AND'
-        }
+        self.alu_ops = {**BINARY_OPS, **UNARY_OPS, CMP: 'CMP'}
         # self.pc_mutators = {
         #     'PRN' : 0b01000111,
         #     'LDI' : 0b10000010,
@@ -63,8 +139,6 @@ class CPU:
         self.branchtable = {}
         self.branchtable[CMP] = self.handle_cmp
         self.branchtable[JMP] = self.handle_jmp
-        self.branchtable[JEQ] = self.handle_jeq
-        self.branchtable[JNE] = self.handle_jne
         self.branchtable[PUSH] = self.handle_push
         self.branchtable[POP] = self.handle_pop
         self.branchtable[CALL] = self.handle_call
@@ -72,12 +146,19 @@ class CPU:
         self.branchtable[HLT] = self.handle_hlt
         self.branchtable[RET] = self.handle_ret
         self.branchtable[LDI] = self.handle_ldi
-        self.branchtable[ADD] = self.handle_add
-        self.branchtable[SUB] = self.handle_sub
-        self.branchtable[MUL] = self.handle_mul
-        self.branchtable[DEC] = self.handle_dec
-        self.branchtable[INC] = self.handle_inc
         self.branchtable[PRA] = self.handle_pra
+        self.branchtable[ST] = self.handle_st
+        self.branchtable[LD] = self.handle_ld
+        self.branchtable[INT] = self.handle_int
+        self.branchtable[IRET] = self.handle_iret
+        for op in BRANCH_OPS:
+            self.branchtable[op] = self.handle_branch
+        for op in BINARY_OPS:
+            self.branchtable[op] = self.handle_alu
+        for op in UNARY_OPS:
+            self.branchtable[op] = self.handle_alu_unary
+        for op in DIVISIONS:
+            self.branchtable[op] = self.handle_divide
 
 
 
@@ -126,6 +207,39 @@ class CPU:
         """
         self.FL = 0
 
+        """ Number of instructions executed by `run()`, for instructions/second stats """
+        self.instructions = 0
+
+        """
+        Interrupts. Devices (see devices.py) run in their own threads and
+        call `raise_interrupt()`, which records the interrupt and sets the
+        single `pending` flag. The run loop only looks at IM/IS when that
+        flag is set, so interrupt support costs one attribute test per
+        instruction.
+        """
+        self.interrupts_enabled = True
+        self.pending = False
+        self.raised = 0
+        self.device_writes = {}
+        self.interrupt_lock = threading.Lock()
+
+        """
+        Idle loops. `devices` lists the attached interrupt sources; while
+        there are any, a program spinning in a wait loop sleeps on `wakeup`
+        (set by `raise_interrupt()`) instead of burning a core.
+        `idle_state` is the state seen at the last backward JMP.
+        """
+        self.devices = []
+        self.wakeup = threading.Event()
+        self.idle_state = None
+        self.idle_time = 0.0
+
+        """ Where PRN and PRA output goes; see sinks.py """
+        self.output = StreamSink()
+
+        """ `time.monotonic()` deadline of the current run, for idle waits """
+        self.deadline = None
+
 
 
 
@@ -145,6 +259,116 @@ class CPU:
                     self.memory[address] = int(instruction, 2)
                     address += 1
 
+        self.image_loaded()
+
+    def load_binary(self, path):
+        """ Load an .ls8b image: the bytes go straight into memory, no parsing """
+
+        ls8b.load_into(self.memory, path)
+        self.image_loaded()
+
+    def load_file(self, path):
+        """ Load an .ls8 or .ls8b file, whichever `path` turns out to be """
+
+        if ls8b.is_binary(path):
+            self.load_binary(path)
+        else:
+            with open(path, 'r') as f:
+                self.load(f.read().split('\n'))
+
+    def load_image(self, image):
+        """ Load raw program bytes, e.g. from `asm.assemble()` """
+
+        self.memory[:len(image)] = image
+        self.image_loaded()
+
+    def image_loaded(self):
+        """ Called after a program has been loaded; engines hook in here """
+
+    def reset(self):
+        """
+        Put the CPU back into its power-on state in place: `registers` and
+        `memory` are zeroed without reallocating them and `branchtable` is
+        kept, so a warm CPU can run program after program. The output sink
+        and attached devices stay as they are.
+        """
+
+        self.registers[:] = bytes(8)
+        self.registers[SP] = 0xF4
+        self.memory[:] = bytes(256)
+        self.PC = 0
+        self.FL = 0
+        self.instructions = 0
+
+        with self.interrupt_lock:
+            self.interrupts_enabled = True
+            self.pending = False
+            self.raised = 0
+            self.device_writes = {}
+        self.idle_state = None
+        self.idle_time = 0.0
+
+    """ Snapshots """
+
+    def snapshot(self):
+        """ Capture the machine state; registers and memory are plain buffer copies """
+
+        with self.interrupt_lock:
+            pending = self.pending
+            raised = self.raised
+            device_writes = tuple(self.device_writes.items())
+
+        return Snapshot(bytes(self.registers), bytes(self.memory), self.PC,
+                        self.FL, self.interrupts_enabled, pending, raised,
+                        device_writes, self.instructions)
+
+    def restore(self, snapshot):
+        """ Put the CPU back into the state captured by `snapshot()`, in place """
+
+        previous = bytes(self.memory)
+        self.registers[:] = snapshot.registers
+        self.memory[:] = snapshot.memory
+        self.PC = snapshot.PC
+        self.FL = snapshot.FL
+        self.instructions = snapshot.instructions
+
+        with self.interrupt_lock:
+            self.interrupts_enabled = snapshot.interrupts_enabled
+            self.pending = snapshot.pending
+            self.raised = snapshot.raised
+            self.device_writes = dict(snapshot.device_writes)
+        self.idle_state = None
+
+        if previous != snapshot.memory:
+            self.memory_restored(previous)
+
+    def memory_restored(self, previous):
+        """
+        Called by `restore()` when memory changed; `previous` is what it
+        held before. Engines caching decoded code hook in here.
+        """
+
+    def spawn(self):
+        """ A new, blank CPU of the same engine and settings """
+
+        return type(self)()
+
+    def fork(self, n):
+        """
+        `n` independent CPUs continuing from this one's current state. They
+        all restore the same immutable snapshot, and engines share what
+        they can (the compiled engine shares its translation). Forks get
+        the default output sink and no devices.
+        """
+
+        snapshot = self.snapshot()
+        forks = []
+        for _ in range(n):
+            cpu = self.spawn()
+            cpu.restore(snapshot)
+            forks.append(cpu)
+        return forks
+
 
     """ Step 2: Add RAM functions """
 
@@ -174,16 +398,15 @@ class CPU:
 
     def handle_jmp(self):
         register_a = self.memory[self.PC + 1]
-        self.PC = self.registers[register_a]
+        target = self.registers[register_a]
+        if target <= self.PC and self.devices:
+            self.idle_check(self.PC, target)
+        self.PC = target
 
-    def handle_jeq(self):
-        if self.E == 1:
-            self.handle_jmp()
-        else:
-            self.PC += 2
+    def handle_branch(self):
+        """ JEQ, JNE, JLT, JLE, JGT and JGE, looked up by opcode and FL """
 
-    def handle_jne(self):
-        if self.E == self.FL:
+        if BRANCH_TABLES[self.memory[self.PC]][self.FL]:
             self.handle_jmp()
         else:
             self.PC += 2
@@ -208,7 +431,7 @@ class CPU:
         self.PC = self.registers[register_a]
 
     def handle_hlt(self):
-        sys.exit(0)
+        raise Halt()
 
     def handle_ret(self):
         self.PC = self.memory[self.registers[SP]]
@@ -222,91 +445,217 @@ class CPU:
 
     def handle_prn(self):
         register_a = self.memory[self.PC + 1]
-        print(self.registers[register_a])
+        self.output.write(f'{self.registers[register_a]}\n')
         self.PC += 2
 
     def handle_pra(self):
+        register_a = self.ram_read(self.PC + 1)
+        self.output.write(chr(self.registers[register_a]))
+        self.PC += 2
+
+    def handle_st(self):
         register_a = self.ram_read(self.PC + 1)
         register_b = self.ram_read(self.PC + 2)
-        self.registers[register_a] = register_b
+        self.ram_write(self.registers[register_b], self.registers[register_a])
+        self.PC += 3
+
+    def handle_ld(self):
+        register_a = self.ram_read(self.PC + 1)
+        register_b = self.ram_read(self.PC + 2)
+        self.registers[register_a] = self.ram_read(self.registers[register_b])
         self.PC += 3
 
-        print(ascii(register_b))
+    def handle_int(self):
+        register_a = self.ram_read(self.PC + 1)
+        self.registers[IS] |= 1 << (self.registers[register_a] & 7)
+        self.pending = True
+        self.PC += 2
+
+    def handle_iret(self):
+        for r in range(6, -1, -1):
+            self.registers[r] = self.stack_pop()
+        self.FL = self.stack_pop()
+        self.PC = self.stack_pop()
+        self.interrupts_enabled = True
+        # Anything raised while the handler ran can be serviced now
+        self.pending = True
+
+    """ Interrupts """
+
+    def stack_push(self, value):
+        self.registers[SP] -= 1
+        self.ram_write(value, self.registers[SP])
+
+    def stack_pop(self):
+        value = self.ram_read(self.registers[SP])
+        self.registers[SP] += 1
+        return value
+
+    def raise_interrupt(self, number, write=None):
+        """
+        Raise interrupt `number` from a device, optionally with a byte to
+        store in memory (`write` is (address, value), e.g. the key pressed).
+        The byte is stored when the interrupt is serviced, so the handler
+        always sees the value that went with it. Safe to call from any thread.
+        """
+
+        with self.interrupt_lock:
+            self.raised |= 1 << number
+            if write is not None:
+                self.device_writes[number] = write
+            self.pending = True
+        self.wakeup.set()
+
+    def check_interrupts(self):
+        """
+        Called by the run loop, before an instruction fetch, when `pending`
+        is set. Moves device events into IS, then services the
+        lowest-numbered interrupt that is both raised and unmasked.
+
+        An interrupt that is raised but masked stays in IS and is looked at
+        again on the next device event, INT or IRET.
+        """
+
+        with self.interrupt_lock:
+            raised, self.raised = self.raised, 0
+            self.pending = False
+
+        self.service_interrupts(raised)
+
+    def service_interrupts(self, raised):
+        """
+        The rest of `check_interrupts()`, once the device events in `raised`
+        have been taken; events.py takes them itself to log them first.
+        """
+
+        self.registers[IS] |= raised
+
+        if not self.interrupts_enabled:
+            return
+
+        masked_interrupts = self.registers[IM] & self.registers[IS]
+        if not masked_interrupts:
+            return
+
+        number = (masked_interrupts & -masked_interrupts).bit_length() - 1
+
+        with self.interrupt_lock:
+            write = self.device_writes.pop(number, None)
+        if write is not None:
+            self.ram_write(write[1], write[0])
+
+        self.interrupts_enabled = False
+        self.idle_state = None
+        self.registers[IS] &= ~(1 << number) & 0xFF
+        self.stack_push(self.PC)
+        self.stack_push(self.FL)
+        for r in range(7):
+            self.stack_push(self.registers[r])
+        self.PC = self.ram_read(I0_VECTOR + number)
+
+    """ Idle loops """
+
+    def is_wait_loop(self, target, pc):
+        """
+        True if `target`..`pc` is straight-line code that only touches
+        registers, ending in the `JMP` at `pc`: once such a loop comes back
+        to the JMP with the same registers, only an interrupt gets it out.
+        """
+
+        memory = self.memory
+        if memory[pc] != JMP or pc - target > MAX_WAIT_LOOP:
+            return False
+
+        address = target
+        while address < pc:
+            size = WAIT_LOOP_SIZES.get(memory[address])
+            if size is None:
+                return False
+            address += size
+        return address == pc
+
+    def idle_check(self, pc, target):
+        """
+        Called on a backward jump from `pc` to `target` while devices are
+        attached. Sleeps until the next interrupt if the program is spinning
+        in a wait loop, i.e. it has come round to the same JMP with the same
+        state and nothing has happened since.
+        """
+
+        if not self.is_wait_loop(target, pc):
+            self.idle_state = None
+            return
+
+        state = (pc, bytes(self.registers), self.FL)
+        if state == self.idle_state:
+            self.idle()
+        else:
+            self.idle_state = state
+
+    def idle(self):
+        """ Block until an interrupt is raised or the last device detaches """
+
+        self.output.flush()
+        start = time.perf_counter()
+        wakeup = self.wakeup
+        wakeup.clear()
+        while not self.pending and self.devices:
+            if self.deadline is None:
+                wakeup.wait()
+            elif not wakeup.wait(max(self.deadline - time.monotonic(), 0)):
+                break
+            wakeup.clear()
+        self.idle_time += time.perf_counter() - start
 
     def alu(self, op, reg_a, reg_b):
-        """ALU operations."""
+        """ALU operations, looked up in the precomputed tables of alu.py."""
 
-        if op == "ADD":
-            self.registers[reg_a] += self.registers[reg_b]
-        
-        elif op == "SUB":
-            self.registers[reg_a] -= self.registers[reg_b]
-
-        # Step 8: Implement a Multiply and Print the Result
-        elif op == "MUL":
-            self.registers[reg_a] *= self.registers[reg_b]
-
-        elif op == "DEC":
-            self.registers[reg_a] = self.registers[reg_b] - 1
-
-        elif op == "INC":
-            self.registers[reg_a] = self.registers[reg_b] + 1
-
-        elif op == "CMP":
-            if self.registers[reg_a] == self.registers[reg_b]:
-                self.E = 1
-                self.L = self.FL
-                self.G = self.FL
-            elif reg_a < reg_b:
-                self.E = self.FL
-                self.L = 1
-                self.G = self.FL
-
-            elif reg_a > reg_b:
-                self.E = self.FL
-                self.L = self.FL
-                self.G = self.FL
+        registers = self.registers
 
+        if op in UNARY_TABLES:
+            registers[reg_a] = UNARY_TABLES[op][registers[reg_a]]
+            return
+
+        index = registers[reg_a] << 8 | registers[reg_b]
+        if op == CMP:
+            self.FL = COMPARE_TABLE[index]
+        elif op in BINARY_TABLES:
+            if op in DIVISIONS and not registers[reg_b]:
+                raise ZeroDivisionError(f"{BINARY_OPS[op]} by zero")
+            registers[reg_a] = BINARY_TABLES[op][index]
         else:
             raise Exception("Unsupported ALU operation")
 
     """ *These are instructions handled by the ALU.* """
 
-    def handle_cmp(self):
-        register_a = self.ram_read(self.PC + 1)
-        register_b = self.ram_read(self.PC + 2)
-        self.alu('CMP', register_a, register_b)
-        self.PC += 3
-
-
-    def handle_add(self):
-        register_a = self.ram_read(self.PC + 1)
-        register_b = self.ram_read(self.PC + 2)
-        self.alu('ADD', register_a, register_b)
-        self.PC += 3
+    # The common instructions index their table directly rather than going
+    # through alu()
 
-    def handle_sub(self):
-        register_a = self.ram_read(self.PC + 1)
-        register_b = self.ram_read(self.PC + 2)
-        self.alu('SUB', register_a, register_b)
+    def handle_alu(self):
+        table = BINARY_TABLES[self.memory[self.PC]]
+        register_a = self.memory[self.PC + 1]
+        register_b = self.memory[self.PC + 2]
+        registers = self.registers
+        registers[register_a] = table[registers[register_a] << 8 | registers[register_b]]
         self.PC += 3
 
-    def handle_mul(self):
-        register_a = self.ram_read(self.PC + 1)
-        register_b = self.ram_read(self.PC + 2)
-        self.alu('MUL', register_a, register_b)
-        self.PC += 3
+    def handle_alu_unary(self):
+        table = UNARY_TABLES[self.memory[self.PC]]
+        register_a = self.memory[self.PC + 1]
+        self.registers[register_a] = table[self.registers[register_a]]
+        self.PC += 2
 
-    def handle_dec(self):
-        register_a = self.ram_read(self.PC + 1)
-        register_b = self.ram_read(self.PC + 2)
-        self.alu('DEC', register_a, register_b)
+    def handle_cmp(self):
+        register_a = self.memory[self.PC + 1]
+        register_b = self.memory[self.PC + 2]
+        registers = self.registers
+        self.FL = COMPARE_TABLE[registers[register_a] << 8 | registers[register_b]]
         self.PC += 3
 
-    def handle_inc(self):
+    def handle_divide(self):
         register_a = self.ram_read(self.PC + 1)
         register_b = self.ram_read(self.PC + 2)
-        self.alu('INC', register_a, register_b)
+        self.alu(self.memory[self.PC], register_a, register_b)
         self.PC += 3
 
     def trace(self):
@@ -331,7 +680,42 @@ class CPU:
 
 
 
-    def run(self):
+    def run(self, max_instructions=None, deadline=None, recorder=None):
+        """
+        Run until the program halts or faults, `max_instructions` have been
+        executed, or `time.monotonic()` passes `deadline`.
+
+        Returns a `RunResult`; nothing is raised for HLT or for faults, so
+        the CPU can be embedded and reused (see `reset()`). Engines only
+        override `execute()`.
+
+        With a `reverse.Recorder`, the run is interpreted one instruction at
+        a time and logged so it can be stepped backwards afterwards.
+        """
+
+        execute = self.execute if recorder is None else recorder.execute
+        return self.supervise(execute, max_instructions, deadline)
+
+    def supervise(self, execute, max_instructions=None, deadline=None):
+        """ Call `execute(max_instructions, deadline)` and build its RunResult """
+
+        start = self.instructions
+        previous, self.deadline = self.deadline, deadline
+        error = None
+        try:
+            status = execute(max_instructions, deadline)
+        except Halt:
+            status = HALTED
+        except Exception as e:
+            status = FAULT
+            error = e
+        finally:
+            self.deadline = previous
+            self.output.flush()
+
+        return RunResult(status, self.instructions - start, error, self.PC)
+
+    def execute(self, max_instructions, deadline):
         """  Step 3: Implement the core of `CPU`'s `run()` method """
 
         """
@@ -348,15 +732,31 @@ class CPU:
         Using `ram_read()`,
         read the bytes at `PC+1` and `PC+2` from RAM into variables `operand_a` and
         `operand_b` in case the instruction needs them.
-  
+
+        Returns BUDGET or DEADLINE; HLT and faults leave by raising.
         """
-        running = True
+        limit = sys.maxsize if max_instructions is None else max_instructions
+        # Without a deadline the whole budget is one chunk
+        chunk = limit if deadline is None else DEADLINE_CHECK
+        count = 0
 
         """ `IR`: Instruction Register, contains a copy of the currently executing instruction"""
-        while running:
-            IR = self.PC
-            INS = self.memory[IR]
-            self.branchtable[INS]()
+        try:
+            while count < limit:
+                stop = min(limit, count + chunk)
+                while count < stop:
+                    if self.pending:
+                        self.check_interrupts()
+                    IR = self.PC
+                    INS = self.memory[IR]
+                    count += 1
+                    self.branchtable[INS]()
+                if deadline is not None and time.monotonic() >= deadline:
+                    return DEADLINE
+            return BUDGET
+        finally:
+            # HLT and faults leave by raising, so keep the count on the way out
+            self.instructions += count
 
             """ 
              This is _currently_ `O(n)` It would be a lot better if it were an `O(1)` process..
@@ -0,0 +1,599 @@
+"""Pre-decoded, threaded-dispatch execution engine."""
+
+import sys
+import time
+from functools import partial
+
+from cpu import *
+
+"""
+Superinstructions: idioms asm.py emits all the time, each run by one fused
+closure. Names are the `fusion_stats` keys; `Jcc` is any conditional jump.
+"""
+FUSIONS = ('CMP+LDI+Jcc', 'LDI+CMP+Jcc', 'CMP+Jcc', 'LDI+JMP', 'LDI+Jcc',
+           'LDI+CALL', 'PUSH+POP')
+
+""" Most instructions in one fused closure, and most bytes they span """
+MAX_FUSED = 3
+MAX_FUSED_SIZE = 8
+
+
+class DecodedCPU(CPU):
+    """
+    CPU that decodes every instruction once into a closure with its operands
+    already baked in.
+
+    `self.decoded` holds one entry per address. An entry is either the
+    decoded closure for the instruction at that address, or a "miss" stub
+    that decodes it on first execution. Every closure returns the next `PC`,
+    so `run()` is just "fetch closure, call, next".
+
+    Writes to memory (`ram_write()`, `ST`, `PUSH`, `CALL`, interrupt entry)
+    drop the decoded entries that cover the written byte, so self-modifying
+    programs stay correct.
+
+    With `fuse` on, a decoded entry can instead be a superinstruction (see
+    `FUSIONS`) doing the work of several instructions in one dispatch;
+    `self.weights` holds how many instructions each entry counts for. The
+    unfused closures stay in `self.singles`, for the last few instructions
+    of a budget and for guards that fail (stack at 0, a push landing in the
+    fused code). `self.fusion_stats` counts the hits of each fusion.
+    """
+
+    def __init__(self, fuse=True):
+        super().__init__()
+        self.fuse = fuse
+
+        # Opcode -> factory building the closure for one instruction
+        self.decoders = {}
+        self.decoders[CMP] = self.decode_cmp
+        self.decoders[JMP] = self.decode_jmp
+        self.decoders[PUSH] = self.decode_push
+        self.decoders[POP] = self.decode_pop
+        self.decoders[CALL] = self.decode_call
+        self.decoders[PRN] = self.decode_prn
+        self.decoders[HLT] = self.decode_hlt
+        self.decoders[RET] = self.decode_ret
+        self.decoders[LDI] = self.decode_ldi
+        self.decoders[PRA] = self.decode_pra
+        self.decoders[ST] = self.decode_st
+        self.decoders[LD] = self.decode_ld
+        self.decoders[INT] = self.decode_int
+        self.decoders[IRET] = self.decode_iret
+        for op in BRANCH_OPS:
+            self.decoders[op] = self.decode_branch
+        for op in BINARY_OPS:
+            self.decoders[op] = self.decode_alu
+        for op in UNARY_OPS:
+            self.decoders[op] = self.decode_alu_unary
+
+        self.misses = [partial(self.miss, address) for address in range(256)]
+        self.decoded = list(self.misses)
+        self.singles = list(self.misses)
+        self.weights = [1] * 256
+
+        # 1 for every byte that is part of a decoded instruction
+        self.covered = bytearray(256)
+
+        # (instructions not run, PC of the faulting one) when a
+        # superinstruction faulted part-way
+        self.unfinished = None
+
+        self.fusion_stats = dict.fromkeys(FUSIONS, 0)
+
+        # Opcode -> factory building a superinstruction starting there
+        self.fusers = {}
+        self.fusers[LDI] = self.fuse_ldi
+        self.fusers[CMP] = self.fuse_cmp
+        self.fusers[PUSH] = self.fuse_push
+
+    def image_loaded(self):
+        self.invalidate_all()
+
+    def ram_write(self, memory_data_register, memory_address_register):
+        super().ram_write(memory_data_register, memory_address_register)
+        self.invalidate(memory_address_register)
+
+    # The interpreter's PUSH and CALL store without ram_write(); they still
+    # run here when the CPU is driven through its branch table (profiler,
+    # recorder)
+
+    def handle_push(self):
+        super().handle_push()
+        self.invalidate(self.registers[SP])
+
+    def handle_call(self):
+        super().handle_call()
+        self.invalidate(self.registers[SP])
+
+    def invalidate(self, address):
+        """ Drop the decoded instructions whose bytes include `address` """
+
+        if self.covered[address]:
+            for a in range(max(address - MAX_FUSED_SIZE + 1, 0), address + 1):
+                self.decoded[a] = self.singles[a] = self.misses[a]
+                self.weights[a] = 1
+            self.covered[address] = 0
+
+    def invalidate_all(self):
+        self.decoded[:] = self.misses
+        self.singles[:] = self.misses
+        self.weights[:] = [1] * 256
+        self.covered[:] = bytes(256)
+
+    def miss(self, address):
+        """
+        Decode the instruction at `address`, cache it, then execute it.
+
+        Only the single instruction runs now, as this dispatch was counted
+        as one; a superinstruction starting here is used from the next one.
+        """
+
+        op = self.memory[address]
+        handler, size = self.decoders[op](address)
+        if address + size > 256:
+            # Cut off by the end of memory: the interpreter's handler
+            # faults part way through, exactly as CPU.run() does
+            handler = self.interpreted(address)
+        self.decoded[address] = self.singles[address] = handler
+
+        fuser = self.fusers.get(op) if self.fuse and address + size <= 256 else None
+        fused = fuser(address) if fuser else None
+        if fused is not None:
+            self.decoded[address], size, self.weights[address] = fused
+
+        for a in range(address, min(address + size, 256)):
+            self.covered[a] = 1
+        return handler()
+
+    def interpreted(self, address):
+        """ A closure running the instruction at `address` with the branch table """
+
+        handler = self.branchtable[self.memory[address]]
+
+        def interpret():
+            self.PC = address
+            handler()
+            return self.PC
+        return interpret
+
+    def operands(self, address):
+        memory = self.memory
+        a = memory[address + 1] if address + 1 < 256 else 0
+        b = memory[address + 2] if address + 2 < 256 else 0
+        return a, b
+
+    """ Decoders: each returns (closure, instruction size in bytes) """
+
+    def decode_ldi(self, pc):
+        registers = self.registers
+        reg_a, value = self.operands(pc)
+        next_pc = pc + 3
+
+        def ldi():
+            registers[reg_a] = value
+            return next_pc
+        return ldi, 3
+
+    def decode_prn(self, pc):
+        registers = self.registers
+        reg_a, _ = self.operands(pc)
+        next_pc = pc + 2
+
+        def prn():
+            self.output.write(f'{registers[reg_a]}\n')
+            return next_pc
+        return prn, 2
+
+    def decode_pra(self, pc):
+        registers = self.registers
+        reg_a, _ = self.operands(pc)
+        next_pc = pc + 2
+
+        def pra():
+            self.output.write(chr(registers[reg_a]))
+            return next_pc
+        return pra, 2
+
+    def decode_st(self, pc):
+        registers = self.registers
+        ram_write = self.ram_write
+        reg_a, reg_b = self.operands(pc)
+        next_pc = pc + 3
+
+        def st():
+            ram_write(registers[reg_b], registers[reg_a])
+            return next_pc
+        return st, 3
+
+    def decode_ld(self, pc):
+        registers = self.registers
+        memory = self.memory
+        reg_a, reg_b = self.operands(pc)
+        next_pc = pc + 3
+
+        def ld():
+            registers[reg_a] = memory[registers[reg_b]]
+            return next_pc
+        return ld, 3
+
+    def decode_int(self, pc):
+        registers = self.registers
+        reg_a, _ = self.operands(pc)
+        next_pc = pc + 2
+
+        def int_():
+            registers[IS] |= 1 << (registers[reg_a] & 7)
+            self.pending = True
+            return next_pc
+        return int_, 2
+
+    def decode_iret(self, pc):
+        handle_iret = self.handle_iret
+
+        def iret():
+            handle_iret()
+            return self.PC
+        return iret, 1
+
+    def decode_hlt(self, pc):
+        handle_hlt = self.handle_hlt
+
+        def hlt():
+            handle_hlt()
+        return hlt, 1
+
+    def decode_push(self, pc):
+        registers = self.registers
+        memory = self.memory
+        invalidate = self.invalidate
+        reg_a, _ = self.operands(pc)
+        next_pc = pc + 2
+
+        def push():
+            value = registers[reg_a]
+            registers[SP] -= 1
+            sp = registers[SP]
+            memory[sp] = value
+            invalidate(sp)
+            return next_pc
+        return push, 2
+
+    def decode_pop(self, pc):
+        registers = self.registers
+        memory = self.memory
+        reg_a, _ = self.operands(pc)
+        next_pc = pc + 2
+
+        def pop():
+            registers[reg_a] = memory[registers[SP]]
+            registers[SP] += 1
+            return next_pc
+        return pop, 2
+
+    def decode_call(self, pc):
+        registers = self.registers
+        memory = self.memory
+        invalidate = self.invalidate
+        reg_a, _ = self.operands(pc)
+        operand = pc + 1
+        return_address = pc + 2
+
+        def call():
+            registers[SP] -= 1
+            sp = registers[SP]
+            memory[sp] = return_address
+            invalidate(sp)
+            if sp == operand:
+                # The push overwrote this CALL's own operand, which
+                # CPU.handle_call() reads after pushing
+                return registers[return_address]
+            return registers[reg_a]
+        return call, 2
+
+    def decode_ret(self, pc):
+        registers = self.registers
+        memory = self.memory
+
+        def ret():
+            address = memory[registers[SP]]
+            try:
+                registers[SP] += 1
+            except ValueError:
+                # SP was 255: CPU.handle_ret() faults with PC already
+                # at the return address
+                self.unfinished = (0, address)
+                raise
+            return address
+        return ret, 1
+
+    def decode_jmp(self, pc):
+        registers = self.registers
+        devices = self.devices
+        idle_check = self.idle_check
+        reg_a, _ = self.operands(pc)
+
+        def jmp():
+            target = registers[reg_a]
+            if target <= pc and devices:
+                idle_check(pc, target)
+            return target
+        return jmp, 2
+
+    def decode_branch(self, pc):
+        registers = self.registers
+        taken = BRANCH_TABLES[self.memory[pc]]
+        reg_a, _ = self.operands(pc)
+        next_pc = pc + 2
+
+        def branch():
+            if taken[self.FL]:
+                return registers[reg_a]
+            return next_pc
+        return branch, 2
+
+    """ ALU instructions, with their lookup table bound instead of going through alu() """
+
+    def decode_alu(self, pc):
+        registers = self.registers
+        op = self.memory[pc]
+        table = BINARY_TABLES[op]
+        reg_a, reg_b = self.operands(pc)
+        next_pc = pc + 3
+
+        if op in DIVISIONS:
+            alu = self.alu
+
+            def divide():
+                alu(op, reg_a, reg_b)
+                return next_pc
+            return divide, 3
+
+        def binary():
+            registers[reg_a] = table[registers[reg_a] << 8 | registers[reg_b]]
+            return next_pc
+        return binary, 3
+
+    def decode_alu_unary(self, pc):
+        registers = self.registers
+        table = UNARY_TABLES[self.memory[pc]]
+        reg_a, _ = self.operands(pc)
+        next_pc = pc + 2
+
+        def unary():
+            registers[reg_a] = table[registers[reg_a]]
+            return next_pc
+        return unary, 2
+
+    def decode_cmp(self, pc):
+        registers = self.registers
+        reg_a, reg_b = self.operands(pc)
+        next_pc = pc + 3
+
+        def cmp():
+            self.FL = COMPARE_TABLE[registers[reg_a] << 8 | registers[reg_b]]
+            return next_pc
+        return cmp, 3
+
+    """
+    Fusers: each returns (closure, size in bytes, instructions), or None when
+    the code at `pc` is not one of `FUSIONS`. Only sequences lying wholly in
+    memory, on registers R0-R7, are fused.
+    """
+
+    def following(self, pc, *ops):
+        """
+        The (opcode, operand a, operand b) of each instruction from `pc` on,
+        or None unless their opcodes are in `ops` (sets), in order
+        """
+
+        memory = self.memory
+        found = []
+        for allowed in ops:
+            if pc >= 256 or memory[pc] not in allowed:
+                return None
+            op = memory[pc]
+            size = (op >> 6) + 1
+            if pc + size > 256:
+                return None
+            a, b = self.operands(pc)
+            found.append((op, a, b))
+            pc += size
+        return found
+
+    def unfused(self, pc, weight):
+        """ Run the `weight` instructions at `pc` one at a time """
+
+        singles = self.singles
+        for done in range(weight):
+            try:
+                pc = singles[pc]()
+            except Exception:
+                self.unfinished = (weight - done - 1, pc)
+                raise
+        return pc
+
+    def fuse_ldi(self, pc):
+        registers = self.registers
+        stats = self.fusion_stats
+        devices = self.devices
+        idle_check = self.idle_check
+        found = self.following(pc, {LDI}, {JMP, CALL, CMP} | set(BRANCH_OPS))
+        if found is None:
+            return None
+        (_, reg_x, value), (op, reg_a, reg_b) = found
+        if reg_x >= 8:
+            return None
+
+        if op == CMP:
+            found = self.following(pc + 6, set(BRANCH_OPS))
+            if found is None or found[0][1] != reg_x or max(reg_a, reg_b) >= 8:
+                return None
+            taken = BRANCH_TABLES[found[0][0]]
+            next_pc = pc + 8
+
+            def ldi_cmp_branch():
+                stats['LDI+CMP+Jcc'] += 1
+                registers[reg_x] = value
+                self.FL = fl = COMPARE_TABLE[registers[reg_a] << 8 | registers[reg_b]]
+                return value if taken[fl] else next_pc
+            return ldi_cmp_branch, 8, 3
+
+        if reg_a != reg_x:
+            return None
+        jump_pc = pc + 3
+        next_pc = pc + 5
+
+        if op == JMP:
+            backward = value <= jump_pc
+
+            def ldi_jmp():
+                stats['LDI+JMP'] += 1
+                registers[reg_x] = value
+                if backward and devices:
+                    idle_check(jump_pc, value)
+                return value
+            return ldi_jmp, 5, 2
+
+        if op == CALL:
+            if reg_x == SP:
+                return None
+            memory = self.memory
+            invalidate = self.invalidate
+            unfused = self.unfused
+
+            def ldi_call():
+                sp = registers[SP] - 1
+                if sp < 0 or pc <= sp < next_pc:
+                    return unfused(pc, 2)
+                stats['LDI+CALL'] += 1
+                registers[reg_x] = value
+                registers[SP] = sp
+                memory[sp] = next_pc
+                invalidate(sp)
+                return value
+            return ldi_call, 5, 2
+
+        taken = BRANCH_TABLES[op]
+
+        def ldi_branch():
+            stats['LDI+Jcc'] += 1
+            registers[reg_x] = value
+            return value if taken[self.FL] else next_pc
+        return ldi_branch, 5, 2
+
+    def fuse_cmp(self, pc):
+        registers = self.registers
+        stats = self.fusion_stats
+        found = self.following(pc, {CMP}, {LDI}, set(BRANCH_OPS))
+        if found is None:
+            return self.fuse_cmp_branch(pc)
+        (_, reg_a, reg_b), (_, reg_x, value), (op, reg_j, _) = found
+        if max(reg_a, reg_b, reg_x) >= 8 or reg_j != reg_x:
+            return None
+        taken = BRANCH_TABLES[op]
+        next_pc = pc + 8
+
+        def cmp_ldi_branch():
+            stats['CMP+LDI+Jcc'] += 1
+            self.FL = fl = COMPARE_TABLE[registers[reg_a] << 8 | registers[reg_b]]
+            registers[reg_x] = value
+            return value if taken[fl] else next_pc
+        return cmp_ldi_branch, 8, 3
+
+    def fuse_cmp_branch(self, pc):
+        registers = self.registers
+        stats = self.fusion_stats
+        found = self.following(pc, {CMP}, set(BRANCH_OPS))
+        if found is None:
+            return None
+        (_, reg_a, reg_b), (op, reg_j, _) = found
+        if max(reg_a, reg_b, reg_j) >= 8:
+            return None
+        taken = BRANCH_TABLES[op]
+        next_pc = pc + 5
+
+        def cmp_branch():
+            stats['CMP+Jcc'] += 1
+            self.FL = fl = COMPARE_TABLE[registers[reg_a] << 8 | registers[reg_b]]
+            return registers[reg_j] if taken[fl] else next_pc
+        return cmp_branch, 5, 2
+
+    def fuse_push(self, pc):
+        registers = self.registers
+        stats = self.fusion_stats
+        memory = self.memory
+        invalidate = self.invalidate
+        unfused = self.unfused
+        found = self.following(pc, {PUSH}, {POP})
+        if found is None:
+            return None
+        (_, reg_a, _), (_, reg_b, _) = found
+        if max(reg_a, reg_b) >= SP:
+            return None
+        next_pc = pc + 4
+
+        def push_pop():
+            sp = registers[SP] - 1
+            if sp < 0 or pc <= sp < next_pc:
+                return unfused(pc, 2)
+            stats['PUSH+POP'] += 1
+            memory[sp] = registers[reg_b] = registers[reg_a]
+            invalidate(sp)
+            return next_pc
+        return push_pop, 4, 2
+
+    def reset(self):
+        super().reset()
+        self.invalidate_all()
+        self.fusion_stats.update(dict.fromkeys(FUSIONS, 0))
+
+    def memory_restored(self, previous):
+        memory = self.memory
+        for address in range(256):
+            if memory[address] != previous[address]:
+                self.invalidate(address)
+
+    def execute(self, max_instructions, deadline):
+        """ Same contract as `CPU.execute()`, dispatching through `self.decoded` """
+
+        decoded = self.decoded
+        singles = self.singles
+        weights = self.weights
+        limit = sys.maxsize if max_instructions is None else max_instructions
+        chunk = limit if deadline is None else DEADLINE_CHECK
+        pc = self.PC
+        count = 0
+
+        try:
+            while count < limit:
+                stop = min(limit, count + chunk)
+                # Superinstructions while none can overshoot `stop`, then
+                # single instructions up to it
+                while count <= stop - MAX_FUSED:
+                    if self.pending:
+                        self.PC = pc
+                        self.check_interrupts()
+                        pc = self.PC
+                    count += weights[pc]
+                    pc = decoded[pc]()
+                while count < stop:
+                    if self.pending:
+                        self.PC = pc
+                        self.check_interrupts()
+                        pc = self.PC
+                    # Fetch before counting: running off the end of
+                    # memory faults uncounted, as in CPU.execute()
+                    single = singles[pc]
+                    count += 1
+                    pc = single()
+                if deadline is not None and time.monotonic() >= deadline:
+                    return DEADLINE
+            return BUDGET
+        finally:
+            if self.unfinished is not None:
+                uncounted, pc = self.unfinished
+                count -= uncounted
+                self.unfinished = None
+            self.PC = pc
+            self.instructions += count
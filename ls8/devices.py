@@ -0,0 +1,127 @@
+"""
+Interrupt sources for the LS-8: the timer (I0) and the keyboard (I1).
+
+Each device runs in a daemon thread and delivers events with
+`CPU.raise_interrupt()`, which only records the event and sets the CPU's
+pending flag; the run loop does the rest between instructions. A device
+is in `cpu.devices` while it may still raise interrupts, which is what lets
+an idle CPU sleep until the next one.
+"""
+
+import os
+import sys
+import threading
+import time
+
+from cpu import KEY_ADDRESS
+
+try:
+    import termios
+    import tty
+except ImportError:  # not a Unix terminal
+    termios = None
+
+
+def detach(cpu, device):
+    """ Take `device` off the CPU, waking it if it was idle waiting for one """
+
+    if device in cpu.devices:
+        cpu.devices.remove(device)
+        cpu.wakeup.set()
+
+
+class TimerDevice:
+    """Raises interrupt 0 once every `interval` seconds."""
+
+    number = 0
+
+    def __init__(self, cpu, interval=1.0):
+        self.cpu = cpu
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.tick, name='ls8-timer',
+                                       daemon=True)
+
+    def start(self):
+        self.cpu.devices.append(self)
+        self.thread.start()
+        return self
+
+    def tick(self):
+        while not self.stopped.wait(self.interval):
+            self.cpu.raise_interrupt(self.number)
+
+    def stop(self):
+        self.stopped.set()
+        detach(self.cpu, self)
+
+
+class KeyboardDevice:
+    """
+    Raises interrupt 1 for every byte read from `fd` (stdin by default),
+    storing the byte at address 0xF4 first. A terminal is put in cbreak mode
+    so keys arrive as they are pressed; `stop()` puts it back.
+
+    Keys that arrive faster than the program handles them (pasted or piped
+    input) are held back until the previous one has been delivered. While a
+    key waits, the interrupt is raised again every `retry` seconds, like a
+    level-triggered line, so a key that came in while I1 was masked still
+    gets through once the program unmasks it.
+    """
+
+    retry = 0.01
+
+    number = 1
+
+    def __init__(self, cpu, fd=None):
+        self.cpu = cpu
+        self.fd = sys.stdin.fileno() if fd is None else fd
+        self.saved = None
+        self.thread = threading.Thread(target=self.read, name='ls8-keyboard',
+                                       daemon=True)
+
+    def start(self):
+        if termios is not None and os.isatty(self.fd):
+            self.saved = termios.tcgetattr(self.fd)
+            tty.setcbreak(self.fd)
+        self.cpu.devices.append(self)
+        self.thread.start()
+        return self
+
+    def read(self):
+        while True:
+            try:
+                key = os.read(self.fd, 1)
+            except OSError:
+                key = b''
+            if not key:
+                # No more keys will come; don't let the CPU wait for them
+                detach(self.cpu, self)
+                return
+            self.cpu.raise_interrupt(self.number, (KEY_ADDRESS, key[0]))
+            while self.waiting():
+                time.sleep(self.retry)
+
+    def waiting(self):
+        """ Raise I1 again if the last key hasn't been delivered yet """
+
+        cpu = self.cpu
+        with cpu.interrupt_lock:
+            if self.number not in cpu.device_writes:
+                return False
+            cpu.raised |= 1 << self.number
+            cpu.pending = True
+            return True
+
+    def stop(self):
+        detach(self.cpu, self)
+        if self.saved is not None:
+            termios.tcsetattr(self.fd, termios.TCSADRAIN, self.saved)
+            self.saved = None
+
+
+""" Devices selectable with ls8.py --devices """
+DEVICES = {
+    'timer': TimerDevice,
+    'keyboard': KeyboardDevice,
+}
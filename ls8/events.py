@@ -0,0 +1,209 @@
+"""
+Record and replay device interrupts, so runs of interactive programs
+(keyboard.ls8, interrupts.ls8) can be reproduced exactly and at full speed.
+
+    recorder = EventRecorder(cpu, 'session.ls8e')   # devices attached
+    try:
+        recorder.run()
+    finally:
+        recorder.close()
+
+    replayer = EventReplayer(cpu, 'session.ls8e')   # same program, no devices
+    replayer.run()
+
+The recorder interprets the program one instruction at a time and logs
+device events at the point the run loop takes them into IS, before an
+instruction fetch, as (instruction count, interrupt number, write). That
+is the only point where timer ticks and keystrokes reach the machine, so
+injecting the same events at the same counts reproduces the run exactly:
+the replayer runs the CPU's own engine up to each count with a budget,
+raises the logged interrupts and carries on. Nothing sleeps and nothing
+reads stdin; a program waiting for its next interrupt was asleep while
+recording, not executing, so an hour of mostly idle session is a few
+instructions per event.
+
+Log layout (all integers little-endian):
+
+    offset  size
+    0       4     magic b"LS8E"
+    4       1     format version (1)
+    5       8     BLAKE2b digest of the 256 bytes of memory at the start
+
+followed by 11-byte events: u64 instruction count, u8 interrupt number
+(WRITE set if the event stores a byte, END for the last record), u8
+address and u8 value of the byte. The END record holds the instruction
+count the recording stopped at.
+"""
+
+import sys
+import time
+import struct
+import hashlib
+
+from cpu import *
+
+MAGIC = b'LS8E'
+VERSION = 1
+
+HEADER = struct.Struct('<4sB8s')
+EVENT = struct.Struct('<QBBB')
+
+""" Interrupt number flags """
+WRITE = 0x80  # the device stores (address, value) when the interrupt is serviced
+END = 0xFF  # not an event: where the recording stopped
+
+
+class EventLogError(Exception):
+    """Raised for files that are not event logs of the loaded program."""
+
+
+def image_digest(memory):
+    """ The digest that ties a log to the program it was recorded with """
+
+    return hashlib.blake2b(bytes(memory), digest_size=8).digest()
+
+
+def read(path):
+    """ Read a log; returns (digest, [(count, number, write)], end count or None) """
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if len(data) < HEADER.size:
+        raise EventLogError('truncated header')
+    magic, version, digest = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise EventLogError('not an event log')
+    if version != VERSION:
+        raise EventLogError(f'unsupported event log version {version}')
+
+    body = memoryview(data)[HEADER.size:]
+    # A recording that was killed may end in a partial event; drop it
+    body = body[:len(body) - len(body) % EVENT.size]
+
+    events = []
+    end = None
+    for count, number, address, value in EVENT.iter_unpack(body):
+        if number == END:
+            end = count
+            break
+        write = (address, value) if number & WRITE else None
+        events.append((count, number & ~WRITE, write))
+    return digest, events, end
+
+
+class EventRecorder:
+    """
+    Runs the CPU like `CPU.run()`, interpreting, and logs the device events
+    it takes to `path`. `close()` marks where the recording stopped.
+    """
+
+    def __init__(self, cpu, path):
+        self.cpu = cpu
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, image_digest(cpu.memory)))
+        self.events = 0
+
+    def run(self, max_instructions=None, deadline=None):
+        """ Record `CPU.run()`: same arguments, same RunResult """
+
+        return self.cpu.supervise(self.execute, max_instructions, deadline)
+
+    def execute(self, max_instructions, deadline):
+        cpu = self.cpu
+        memory = cpu.memory
+        branchtable = cpu.branchtable
+        start = cpu.instructions
+        count = 0
+        limit = sys.maxsize if max_instructions is None else max_instructions
+
+        try:
+            while count < limit:
+                if (deadline is not None and count % DEADLINE_CHECK == 0
+                        and time.monotonic() >= deadline):
+                    return DEADLINE
+
+                if cpu.pending:
+                    cpu.service_interrupts(self.take(start + count))
+
+                count += 1
+                branchtable[memory[cpu.PC]]()
+            return BUDGET
+        finally:
+            cpu.instructions += count
+
+    def take(self, position):
+        """
+        `check_interrupts()`'s first half: take the raised interrupts, logging
+        each under the same lock so no event slips in unlogged
+        """
+
+        cpu = self.cpu
+        records = []
+        with cpu.interrupt_lock:
+            raised, cpu.raised = cpu.raised, 0
+            cpu.pending = False
+            for number in range(8):
+                if raised >> number & 1:
+                    write = cpu.device_writes.get(number)
+                    if write is None:
+                        records.append(EVENT.pack(position, number, 0, 0))
+                    else:
+                        records.append(EVENT.pack(position, number | WRITE, *write))
+
+        self.file.write(b''.join(records))
+        self.events += len(records)
+        return raised
+
+    def close(self):
+        """ Write the END record and close the log """
+
+        if not self.file.closed:
+            self.file.write(EVENT.pack(self.cpu.instructions, END, 0, 0))
+            self.file.close()
+
+
+class EventReplayer:
+    """
+    Replays a log made by `EventRecorder` on a CPU with the same program
+    loaded and no devices attached. Any engine will do.
+    """
+
+    def __init__(self, cpu, path):
+        digest, self.events, self.end = read(path)
+        if digest != image_digest(cpu.memory):
+            raise EventLogError(f'{path} was recorded with a different program')
+        self.cpu = cpu
+        self.next = 0  # index into `events` of the next one to raise
+
+    def run(self, max_instructions=None, deadline=None):
+        """
+        Like `CPU.run()`. Stops with BUDGET where the recording stopped,
+        unless the program halted or faulted there.
+        """
+
+        return self.cpu.supervise(self.execute, max_instructions, deadline)
+
+    def execute(self, max_instructions, deadline):
+        cpu = self.cpu
+        events = self.events
+        stop = None if max_instructions is None else cpu.instructions + max_instructions
+
+        while True:
+            while self.next < len(events) and events[self.next][0] <= cpu.instructions:
+                count, number, write = events[self.next]
+                if count < cpu.instructions:
+                    raise EventLogError(f'the CPU ran past the event at instruction {count}')
+                cpu.raise_interrupt(number, write)
+                self.next += 1
+
+            target = events[self.next][0] if self.next < len(events) else self.end
+            if stop is not None:
+                target = stop if target is None else min(target, stop)
+            if target is None:
+                return cpu.execute(None, deadline)
+            if cpu.instructions >= target:
+                return BUDGET
+
+            if cpu.execute(target - cpu.instructions, deadline) == DEADLINE:
+                return DEADLINE
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+
+"""
+Differential fuzzing of the execution engines against the interpreter.
+
+Each case is a random machine state: a program of random instructions
+(drawn from asm.py's `OPCODES`, operands biased towards valid registers
+and towards the addresses of other instructions so jumps and calls land
+somewhere useful) at address 0 or running up to the end of memory, and
+started at its first instruction or another one; random data, stack and
+interrupt vectors; and random registers, FL and interrupt state. Every
+engine runs the case from that state with an instruction budget, and the
+outcome - status, fault type, instructions executed, registers, memory,
+PC, FL, interrupt state and output - must match `CPU`'s exactly.
+
+A diverging case is minimized before it is reported: the budget is cut to
+the first instruction where the engines disagree, then every byte of
+memory and every register that can be zeroed without losing the
+divergence is.
+
+Cases are numbered and generated from their number, so workers are only
+sent ranges of numbers, and `--case N` reproduces case N. Each worker
+keeps one warm CPU per engine and resets it between cases; the batch
+engine (if NumPy is installed) runs a whole range as one batch of lanes.
+
+Usage: fuzz.py [--cases N] [--start N | --case N] [--engines a,b]
+               [--budget N] [--length N] [--jobs N] [--save DIR]
+       fuzz.py --repro case123-decoded.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import functools
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'asm'))
+
+from asm import OPCODES, TYPE_SIZES
+from cpu import *
+from decoded import DecodedCPU
+from ls8c import CompiledCPU
+from jit import JitCPU
+from sinks import MemorySink
+
+try:
+    from batch import BatchCPU, RUNNING, FAULTED
+except ImportError:  # no NumPy
+    BatchCPU = None
+
+"""
+Engines compared against the interpreter, built for fuzzing: translations
+stay in memory and the jit compiles a block on its second entry, so short
+random programs still run compiled code.
+"""
+ENGINES = {
+    'decoded': DecodedCPU,
+    'compiled': functools.partial(CompiledCPU, cache_dir=None),
+    'jit': functools.partial(JitCPU, threshold=2),
+}
+if BatchCPU is not None:
+    ENGINES['batch'] = BatchCPU
+
+""" (opcode, size) of every instruction the assembler knows """
+INSTRUCTIONS = [(int(info['code'], 2), TYPE_SIZES[info['type']])
+                for info in OPCODES.values()]
+
+DEFAULT_CASES = 10_000
+DEFAULT_BUDGET = 500
+DEFAULT_LENGTH = 24
+
+""" Share of cases whose program runs up to the end of memory """
+END_OF_MEMORY = 0.25
+
+""" Cases per task sent to a worker """
+CHUNK = 250
+
+"""
+Everything compared after a run. `error` is the fault's exception type
+name; `output` what PRN and PRA printed.
+"""
+Outcome = namedtuple('Outcome', 'status error instructions registers memory '
+                                'PC FL interrupts_enabled output')
+
+
+def generate(number, length=DEFAULT_LENGTH):
+    """ Case `number`: a `Snapshot` to start every engine from """
+
+    rng = random.Random(number)
+    memory = bytearray(256)
+
+    # The program, remembering where each instruction starts. Some cases
+    # put it at the end of memory, running up to 0xFF with the last
+    # instruction perhaps cut off, where fetches and pushes fall off
+    if rng.random() < END_OF_MEMORY:
+        origin, limit = rng.randrange(0xC0, 0x100), 0x100
+    else:
+        origin, limit = 0, 0xE0
+    starts = []
+    address = origin
+    for _ in range(length):
+        op, size = rng.choice(INSTRUCTIONS)
+        if address >= limit or (address + size > limit and limit < 0x100):
+            break
+        starts.append(address)
+        memory[address] = op
+        for offset in range(1, min(size, 256 - address)):
+            memory[address + offset] = register(rng)
+        address += size
+    end = min(address, 256)
+
+    # LDI immediates: mostly instruction addresses, so that the next
+    # JMP/CALL/Jcc through that register goes somewhere
+    for start in starts:
+        if memory[start] == LDI and start + 2 < 256:
+            roll = rng.random()
+            if roll < 0.6:
+                memory[start + 2] = rng.choice(starts)
+            elif roll < 0.8:
+                memory[start + 2] = rng.randrange(8)
+            else:
+                memory[start + 2] = rng.randrange(256)
+
+    # Data after the program, some of it in the stack and around SP's
+    # power-on value, and handlers in the vector table
+    for address in range(end, 256):
+        if rng.random() < 0.2:
+            memory[address] = rng.randrange(256)
+    for vector in range(max(I0_VECTOR, end), 256):
+        if rng.random() < 0.5:
+            memory[vector] = rng.choice(starts) if starts else 0
+
+    registers = bytearray(rng.randrange(256) if rng.random() < 0.3 else rng.choice(starts or [0])
+                          for _ in range(5))
+    registers.append(rng.choice([0, 0xFF, rng.randrange(256)]))  # IM
+    registers.append(rng.choice([0, 0, rng.randrange(256)]))  # IS
+    roll = rng.random()
+    if roll < 0.7:
+        registers.append(0xF4)
+    elif roll < 0.9:
+        registers.append(rng.choice([0, 1, 0xFE, 0xFF, min(end, 0xFF)]))
+    else:
+        registers.append(rng.randrange(256))
+
+    # Start at the program, or now and then at any instruction in it
+    pc = rng.choice(starts) if starts and rng.random() < 0.2 else origin
+
+    return Snapshot(bytes(registers), bytes(memory), pc,
+                    rng.choice([0, 1, 2, 4, rng.randrange(256)]),
+                    rng.random() < 0.8, rng.random() < 0.2, 0, (), 0)
+
+
+def register(rng):
+    """ A register operand: almost always R0-R7 """
+
+    return rng.randrange(8) if rng.random() < 0.97 else rng.randrange(256)
+
+
+def build(name):
+    return CPU() if name == 'interp' else ENGINES[name]()
+
+
+def run_case(cpu, case, budget):
+    """ Run `case` on a warm scalar CPU; returns its Outcome """
+
+    cpu.reset()
+    cpu.load_image(case.memory)
+    cpu.restore(case)
+    cpu.output = output = MemorySink()
+    result = cpu.run(max_instructions=budget)
+    return Outcome(result.status, type(result.error).__name__ if result.error else None,
+                   result.instructions, bytes(cpu.registers), bytes(cpu.memory),
+                   cpu.PC, cpu.FL, cpu.interrupts_enabled, output.getvalue())
+
+
+def run_batch(cases, budget):
+    """ Run `cases` as the lanes of one BatchCPU; returns their Outcomes """
+
+    batch = BatchCPU(len(cases))
+    for lane, case in enumerate(cases):
+        batch.restore(case, [lane])
+    batch.run(max_steps=budget)
+
+    outcomes = []
+    for lane in range(len(cases)):
+        state = batch.snapshot(lane)
+        status = batch.status[lane]
+        if status == RUNNING:
+            status = BUDGET
+        elif status == FAULTED:
+            status = FAULT
+        else:
+            status = HALTED
+        outcomes.append(Outcome(status, batch.errors.get(lane), state.instructions,
+                                state.registers, state.memory, state.PC, state.FL,
+                                state.interrupts_enabled, batch.lane_output(lane)))
+    return outcomes
+
+
+def run_all(name, cases, budget, cpus):
+    """ Outcomes of `cases` on engine `name`, with warm CPUs from `cpus` """
+
+    if name == 'batch':
+        return run_batch(cases, budget)
+    if name not in cpus:
+        cpus[name] = build(name)
+    return [run_case(cpus[name], case, budget) for case in cases]
+
+
+""" Warm CPUs for this worker process, one per engine """
+_cpus = {}
+
+
+def fuzz_range(start, count, engines, budget, length):
+    """
+    Run cases `start` .. `start + count - 1` in this worker. Returns the
+    [(case number, [diverging engines])] of the cases that diverged.
+    """
+
+    cases = [generate(number, length) for number in range(start, start + count)]
+    reference = run_all('interp', cases, budget, _cpus)
+    diverging = {}
+    for name in engines:
+        for number, expected, outcome in zip(range(start, start + count), reference,
+                                             run_all(name, cases, budget, _cpus)):
+            if outcome != expected:
+                diverging.setdefault(number, []).append(name)
+    return sorted(diverging.items())
+
+
+def diverges(name, case, budget, cpus):
+    """ (diverges?, reference Outcome, engine Outcome) for one case """
+
+    expected, = run_all('interp', [case], budget, cpus)
+    outcome, = run_all(name, [case], budget, cpus)
+    return outcome != expected, expected, outcome
+
+
+def minimize(name, case, budget, cpus):
+    """ A smaller (case, budget) on which engine `name` still diverges """
+
+    def fails(candidate, n):
+        return diverges(name, candidate, n, cpus)[0]
+
+    def shortest(case, budget):
+        # `high` always diverges
+        low, high = 0, budget
+        while low + 1 < high:
+            middle = (low + high) // 2
+            if fails(case, middle):
+                high = middle
+            else:
+                low = middle
+        return high
+
+    budget = shortest(case, budget)
+
+    changed = True
+    while changed:
+        changed = False
+        for address in range(256):
+            if case.memory[address]:
+                memory = bytearray(case.memory)
+                memory[address] = 0
+                candidate = case._replace(memory=bytes(memory))
+                if fails(candidate, budget):
+                    case, changed = candidate, True
+        for r in range(8):
+            if case.registers[r]:
+                registers = bytearray(case.registers)
+                registers[r] = 0
+                candidate = case._replace(registers=bytes(registers))
+                if fails(candidate, budget):
+                    case, changed = candidate, True
+        for field, plain in (('FL', 0), ('interrupts_enabled', True), ('pending', False)):
+            if getattr(case, field) != plain:
+                candidate = case._replace(**{field: plain})
+                if fails(candidate, budget):
+                    case, changed = candidate, True
+        budget = shortest(case, budget)
+
+    return case, budget
+
+
+def describe(title, name, case, budget, expected, outcome):
+    """ A repro as text: the starting state and where the outcomes differ """
+
+    used = max((a for a in range(256) if case.memory[a]), default=-1) + 1
+    lines = [f"{title}: {name} diverges from interp after {budget} "
+             f"instruction{'s' if budget != 1 else ''}",
+             f"  registers: {case.registers.hex(' ')}",
+             f"  FL: {case.FL:08b}  interrupts enabled: {case.interrupts_enabled}  "
+             f"pending: {case.pending}"]
+    for address in range(0, used, 16):
+        lines.append(f"  {address:02x}: {case.memory[address:min(address + 16, used)].hex(' ')}")
+    for field in Outcome._fields:
+        a, b = getattr(expected, field), getattr(outcome, field)
+        if a != b:
+            if isinstance(a, bytes):
+                a, b = a.hex(' '), b.hex(' ')
+            lines.append(f"  {field}: interp {a!r}, {name} {b!r}")
+    return '\n'.join(lines)
+
+
+def save(directory, number, name, case, budget):
+    """ Write a repro as JSON, for loading back with `load()` """
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'case{number}-{name}.json')
+    with open(path, 'w') as f:
+        json.dump({'engine': name, 'budget': budget, 'registers': case.registers.hex(),
+                   'memory': case.memory.hex(), 'FL': case.FL,
+                   'interrupts_enabled': case.interrupts_enabled,
+                   'pending': case.pending}, f, indent=1)
+    return path
+
+
+def load(path):
+    """ (engine, case, budget) from a repro written by `save()` """
+
+    with open(path) as f:
+        repro = json.load(f)
+    case = Snapshot(bytes.fromhex(repro['registers']), bytes.fromhex(repro['memory']), 0,
+                    repro['FL'], repro['interrupts_enabled'], repro['pending'], 0, (), 0)
+    return repro['engine'], case, repro['budget']
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='fuzz.py')
+    parser.add_argument('--cases', type=int, default=DEFAULT_CASES,
+                        help='number of cases (default: %(default)s)')
+    parser.add_argument('--start', type=int, default=0,
+                        help='number of the first case (default: 0)')
+    parser.add_argument('--case', type=int, metavar='N',
+                        help='run and report only case N')
+    parser.add_argument('--engines', default=','.join(ENGINES),
+                        help='comma-separated engines to compare with interp '
+                             '(default: %(default)s)')
+    parser.add_argument('--budget', type=int, default=DEFAULT_BUDGET,
+                        help='instructions per case (default: %(default)s)')
+    parser.add_argument('--length', type=int, default=DEFAULT_LENGTH,
+                        help='instructions per generated program (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=None, metavar='N',
+                        help='worker processes (default: cores)')
+    parser.add_argument('--save', metavar='DIR', help='write minimized repros to DIR')
+    parser.add_argument('--repro', metavar='FILE',
+                        help='run a repro written by --save again')
+    args = parser.parse_args(argv[1:])
+
+    if args.repro:
+        name, case, budget = load(args.repro)
+        failed, expected, outcome = diverges(name, case, budget, {})
+        if not failed:
+            print(f"{args.repro}: {name} matches interp now")
+            return 0
+        print(describe(args.repro, name, case, budget, expected, outcome))
+        return 1
+
+    engines = args.engines.split(',')
+    for name in engines:
+        if name not in ENGINES:
+            parser.error(f'unknown engine {name!r}; choose from {", ".join(ENGINES)}')
+    if args.case is not None:
+        args.start, args.cases = args.case, 1
+
+    jobs = args.jobs or os.cpu_count() or 1
+    starts = range(args.start, args.start + args.cases, CHUNK)
+    counts = [min(CHUNK, args.start + args.cases - s) for s in starts]
+
+    begin = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=min(jobs, len(starts)) or 1) as pool:
+        found = [item for chunk in pool.map(fuzz_range, starts, counts,
+                                            [engines] * len(starts),
+                                            [args.budget] * len(starts),
+                                            [args.length] * len(starts))
+                 for item in chunk]
+    elapsed = max(time.perf_counter() - begin, 1e-9)
+
+    print(f"{args.cases} cases on {', '.join(engines)} in {elapsed:.2f}s "
+          f"({args.cases / elapsed:,.0f} cases/s): {len(found)} diverged")
+
+    cpus = {}
+    for number, names in found:
+        for name in names:
+            case, budget = minimize(name, generate(number, args.length), args.budget, cpus)
+            _, expected, outcome = diverges(name, case, budget, cpus)
+            print()
+            print(describe(f'case {number}', name, case, budget, expected, outcome))
+            if args.save:
+                print(f"  saved {save(args.save, number, name, case, budget)}")
+
+    return 1 if found else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,174 @@
+"""Tiered execution: interpret, then compile hot basic blocks."""
+
+import sys
+import time
+
+from cpu import *
+from alu import TABLES
+from cfg import TERMINATORS
+from ls8c import Emitter, decode_block, emit_function
+
+
+class JitCPU(CPU):
+    """
+    Interpreter that counts basic-block entries and, once a block has been
+    entered `threshold` times, compiles it with `compile()`/`exec()` into a
+    specialized Python function (the same code `ls8c.py` generates for a
+    whole image) and calls that instead from then on.
+
+    Memory writes from `ram_write()` (which `ST` and interrupt entry go
+    through), `PUSH` and `CALL` that land inside a compiled block drop the
+    compiled version; the block goes back to being interpreted and counted,
+    and may be compiled again from the new bytes.
+
+    Stats are kept in `self.jit_stats`:
+
+    * `compiled`: blocks compiled
+    * `invalidations`: compiled blocks dropped by writes into their code
+    * `compiled_instructions`: instructions executed in compiled code
+    * `compiled_time`: seconds spent in compiled code
+    """
+
+    def __init__(self, threshold=50):
+        super().__init__()
+        self.threshold = threshold
+
+        # Block start address -> compiled function, or None
+        self.compiled = [None] * 256
+        self.entries = [0] * 256
+
+        # Bytes covered by compiled blocks, and which blocks cover each byte.
+        # Compiled code reads CODE to avoid writing into compiled code itself.
+        self.code = bytearray(256)
+        self.owners = [set() for _ in range(256)]
+        self.spans = {}
+
+        self.jit_stats = {
+            'compiled': 0,
+            'invalidations': 0,
+            'compiled_instructions': 0,
+            'compiled_time': 0.0,
+        }
+
+    def compile_block(self, start):
+        """ Compile the block at `start`; returns the function or None """
+
+        block, _ = decode_block(self.memory, start)
+        if not block:
+            return None
+
+        name = f'block_{start:02x}'
+        out = Emitter()
+        emit_function(out, name, {start: block})
+        namespace = {'CODE': self.code, **TABLES}
+        exec(compile('\n'.join(out.lines), f'<ls8-jit {start:#04x}>', 'exec'),
+             namespace)
+
+        span = range(start, block[-1][0] + block[-1][4])
+        for address in span:
+            self.code[address] = 1
+            self.owners[address].add(start)
+        self.spans[start] = span
+        self.compiled[start] = namespace[name]
+        self.jit_stats['compiled'] += 1
+        return self.compiled[start]
+
+    def invalidate(self, address):
+        """ Drop every compiled block whose code includes `address` """
+
+        if not self.code[address]:
+            return
+
+        for start in list(self.owners[address]):
+            for a in self.spans.pop(start):
+                self.owners[a].discard(start)
+                if not self.owners[a]:
+                    self.code[a] = 0
+            self.compiled[start] = None
+            self.entries[start] = 0
+            self.jit_stats['invalidations'] += 1
+
+    def ram_write(self, memory_data_register, memory_address_register):
+        super().ram_write(memory_data_register, memory_address_register)
+        self.invalidate(memory_address_register)
+
+    def handle_push(self):
+        super().handle_push()
+        self.invalidate(self.registers[SP])
+
+    def handle_call(self):
+        super().handle_call()
+        self.invalidate(self.registers[SP])
+
+    def spawn(self):
+        return type(self)(threshold=self.threshold)
+
+    def memory_restored(self, previous):
+        memory = self.memory
+        for address in range(256):
+            if memory[address] != previous[address]:
+                self.invalidate(address)
+
+    def reset(self):
+        super().reset()
+        self.compiled[:] = [None] * 256
+        self.entries[:] = [0] * 256
+        self.code[:] = bytes(256)
+        for owners in self.owners:
+            owners.clear()
+        self.spans.clear()
+
+    def execute(self, max_instructions, deadline):
+        compiled = self.compiled
+        entries = self.entries
+        threshold = self.threshold
+        memory = self.memory
+        branchtable = self.branchtable
+        stats = self.jit_stats
+        clock = time.perf_counter
+        limit = sys.maxsize if max_instructions is None else max_instructions
+        chunk = limit if deadline is None else DEADLINE_CHECK
+        count = 0
+
+        # Entering the program counts as entering its first block
+        entered = True
+
+        try:
+            while count < limit:
+                stop = min(limit, count + chunk)
+                while count < stop:
+                    if self.pending:
+                        pc = self.PC
+                        self.check_interrupts()
+                        # Entering a handler counts as entering a block
+                        entered = entered or self.PC != pc
+
+                    if entered:
+                        pc = self.PC
+                        fn = compiled[pc]
+                        if fn is None:
+                            entries[pc] += 1
+                            if entries[pc] >= threshold:
+                                fn = self.compile_block(pc)
+
+                        if fn is not None:
+                            start = clock()
+                            n = fn(self, stop - count)
+                            stats['compiled_time'] += clock() - start
+                            stats['compiled_instructions'] += n
+                            count += n
+                            if n:
+                                # Left the block, possibly straight into another one
+                                continue
+                            # Bailed on its first instruction, or the block
+                            # doesn't fit in the budget; interpret one
+
+                    op = memory[self.PC]
+                    count += 1
+                    branchtable[op]()
+                    entered = op in TERMINATORS
+                if deadline is not None and time.monotonic() >= deadline:
+                    return DEADLINE
+            return BUDGET
+        finally:
+            self.instructions += count
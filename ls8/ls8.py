@@ -3,18 +3,196 @@
 """Main."""
 
 import sys
+import time
+import argparse
 from sys import argv
 from cpu import *
-
-cpu = CPU()
+from decoded import DecodedCPU
+from ls8c import CompiledCPU
+from jit import JitCPU
+from runner import DEFAULT_BUDGET, expand_programs, run_programs, report
+from profiler import Profiler, load_symbols
+from devices import DEVICES
+from cfg import uses_interrupts
+from events import EventRecorder, EventReplayer
+from tracer import Tracer
+from sinks import FileSink
 
 """
-so you can look in `sys.argv[1]` for the name of the file to load.
+Execution engines selectable with `--engine`. They all run the same
+programs with the same results; only the speed differs.
 """
-file_to_load = sys.argv[1]
+ENGINES = {
+    'interp': CPU,
+    'decoded': DecodedCPU,
+    'compiled': CompiledCPU,
+    'jit': JitCPU,
+}
+
+""" Interrupt sources attached to programs that can take interrupts """
+DEFAULT_DEVICES = ['timer', 'keyboard']
+
+
+def parse_commandline(argv):
+    """
+    Usage: ls8.py [--engine ENGINE] [--jit-threshold N] [--stats]
+                  [--profile] [--flamegraph FILE] [--output FILE]
+                  [--devices LIST] [--record FILE | --replay FILE]
+                  [--trace FILE [--trace-last N]] program.ls8
+           ls8.py [--jobs N] [--budget N] program.ls8 ... | directory | 'glob'
+    """
+
+    parser = argparse.ArgumentParser(prog='ls8.py')
+    parser.add_argument('file_to_load', nargs='+',
+                        help='program to run (.ls8 or .ls8b); several programs, a '
+                             'directory or a glob run them all on a process pool')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='interp',
+                        help='execution engine (default: interp)')
+    parser.add_argument('--stats', action='store_true',
+                        help='print instructions/second to stderr on exit')
+    parser.add_argument('--jit-threshold', type=int, default=50, metavar='N',
+                        help='block entries before the jit engine compiles a block')
+    parser.add_argument('--profile', action='store_true',
+                        help='count instructions by opcode, PC and function '
+                             'and print a report to stderr on exit')
+    parser.add_argument('--flamegraph', metavar='FILE',
+                        help='write collapsed call stacks for flamegraph tools')
+    parser.add_argument('--output', metavar='FILE',
+                        help='write what the program prints to FILE instead of stdout')
+    parser.add_argument('--devices', default=None,
+                        help='comma-separated interrupt sources to attach '
+                             '(default: timer,keyboard if the program can take '
+                             'interrupts, else none; "" for none)')
+    parser.add_argument('--record', metavar='FILE',
+                        help='log the interrupts the devices deliver to FILE '
+                             '(interprets the program whatever --engine says)')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='run with the interrupts logged by --record instead '
+                             'of devices, at full speed')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='write a binary trace of every instruction to FILE '
+                             '(interprets the program; decode it with tracer.py)')
+    parser.add_argument('--trace-last', type=int, metavar='N',
+                        help='keep only the last N instructions in the trace')
+    parser.add_argument('--jobs', type=int, default=None, metavar='N',
+                        help='worker processes for several programs (default: cores)')
+    parser.add_argument('--budget', type=int, default=DEFAULT_BUDGET, metavar='N',
+                        help='instructions each program may run when running '
+                             'several programs (default: %(default)s)')
+
+    args = parser.parse_args(argv[1:])
+    modes = [name for name, on in [('--profile/--flamegraph', args.profile or args.flamegraph),
+                                   ('--record', args.record), ('--replay', args.replay),
+                                   ('--trace', args.trace)] if on]
+    if len(modes) > 1:
+        parser.error(f"{' and '.join(modes)} cannot be combined")
+    if args.trace_last is not None and not args.trace:
+        parser.error('--trace-last needs --trace')
+    if args.trace_last is not None and args.trace_last < 1:
+        parser.error('--trace-last must be at least 1')
+
+    args.programs = expand_programs(args.file_to_load)
+    if args.programs != args.file_to_load or len(args.programs) > 1:
+        single = [name for name, on in [('--stats', args.stats), ('--output', args.output),
+                                        ('--devices', args.devices is not None)] if on] + modes
+        if single:
+            parser.error(f"{', '.join(single)} cannot be used with several programs")
+    return args
+
+
+def main(argv):
+    args = parse_commandline(argv)
+
+    programs = args.programs
+    if programs != args.file_to_load or len(programs) > 1:
+        # Several programs: run them in a process pool
+        options = {'threshold': args.jit_threshold} if args.engine == 'jit' else {}
+        results = run_programs(programs, budget=args.budget, jobs=args.jobs,
+                               engine=ENGINES[args.engine], options=options.items())
+        totals = report(results)
+        return 0 if totals[HALTED] == len(results) else 1
+
+    if args.engine == 'jit':
+        cpu = JitCPU(threshold=args.jit_threshold)
+    else:
+        cpu = ENGINES[args.engine]()
+
+    """
+    so you can look in `sys.argv[1]` for the name of the file to load.
+    .ls8 text and .ls8b binary images are told apart by their contents.
+    """
+    cpu.load_file(programs[0])
+
+    if args.output:
+        cpu.output = FileSink(args.output)
+
+    profiler = None
+    if args.profile or args.flamegraph:
+        profiler = Profiler(cpu, load_symbols(programs[0]))
+
+    recorder = replayer = tracer = None
+    if args.record:
+        recorder = EventRecorder(cpu, args.record)
+    if args.replay:
+        # The log stands in for the devices
+        replayer = EventReplayer(cpu, args.replay)
+    if args.trace:
+        tracer = Tracer(cpu, args.trace, last=args.trace_last)
+
+    if args.devices is not None:
+        names = args.devices.split(',')
+    elif uses_interrupts(cpu.memory):
+        names = DEFAULT_DEVICES
+    else:
+        # No stdin thread, cbreak tty or timer for programs that can't notice
+        names = []
+    devices = [DEVICES[name](cpu).start()
+               for name in names if name and replayer is None]
+
+    start = time.perf_counter()
+    try:
+        if profiler is not None:
+            result = profiler.run()
+        elif recorder is not None:
+            result = recorder.run()
+        elif replayer is not None:
+            result = replayer.run()
+        elif tracer is not None:
+            result = tracer.run()
+        else:
+            result = cpu.run()
+    finally:
+        for device in devices:
+            device.stop()
+        if recorder is not None:
+            recorder.close()
+        if tracer is not None:
+            tracer.close()
+        if args.output:
+            cpu.output.close()
+        if args.profile:
+            profiler.report()
+        if args.flamegraph:
+            profiler.write_collapsed(args.flamegraph)
+        if args.stats:
+            elapsed = max(time.perf_counter() - start, 1e-9)
+            print(f"{args.engine}: {cpu.instructions} instructions in "
+                  f"{elapsed:.6f}s ({cpu.instructions / elapsed:,.0f} ins/s)",
+                  file=sys.stderr)
+            if cpu.idle_time:
+                print(f"  idle: {cpu.idle_time:.6f}s asleep in wait loops",
+                      file=sys.stderr)
+            for name, value in getattr(cpu, 'jit_stats', {}).items():
+                print(f"  {name}: {value}", file=sys.stderr)
+            for name, hits in getattr(cpu, 'fusion_stats', {}).items():
+                print(f"  fused {name}: {hits}", file=sys.stderr)
 
-program = open(file_to_load, 'r').read().split('\n')
+    if result.status == FAULT:
+        print(f"fault at PC {result.pc:02x}: "
+              f"{type(result.error).__name__}: {result.error}", file=sys.stderr)
+        return 1
+    return 0
 
-cpu.load(program)
 
-cpu.run()
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+"""
+Compact binary LS-8 image format (.ls8b), and a converter to and from the
+text .ls8 format.
+
+Layout (all integers little-endian):
+
+    offset  size
+    0       4     magic b"LS8B"
+    4       1     format version (1)
+    5       1     number of sections
+    6       2     image length in bytes (at most 256)
+    8       n     image bytes, loaded at address 0
+
+followed by the sections, each a 4-byte tag, a u32 payload length and the
+payload:
+
+* `SYMS` symbol table, repeated: u8 address, u8 name length, name (UTF-8);
+  labels past the end of memory are left out
+* `SMAP` source map, repeated: u8 address, u16 source line number
+
+The image comes first and needs no parsing, so `load_into()` reads it
+straight into CPU memory.
+
+Usage: ls8b.py infile.ls8 outfile.ls8b
+       ls8b.py infile.ls8b outfile.ls8
+"""
+
+import re
+import sys
+import struct
+
+MAGIC = b'LS8B'
+VERSION = 1
+
+HEADER = struct.Struct('<4sBBH')
+SECTION = struct.Struct('<4sI')
+
+""" Labels as asm.py writes them into .ls8 text: `# LABEL (address 24):` """
+LABEL_COMMENT = re.compile(r'#\s*(\w+) \(address (\d+)\):')
+
+
+class ImageError(Exception):
+    """Raised for files that are not valid .ls8b images."""
+
+
+def is_binary(path):
+    """ True if the file at `path` starts with the .ls8b magic """
+
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def read_header(f):
+    """ Read and check the header; returns the image length """
+
+    header = bytearray(HEADER.size)
+    if f.readinto(header) != HEADER.size:
+        raise ImageError('truncated header')
+    magic, version, _, length = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ImageError('not an .ls8b image')
+    if version != VERSION:
+        raise ImageError(f'unsupported .ls8b version {version}')
+    if length > 256:
+        raise ImageError(f'image of {length} bytes does not fit in memory')
+    return length
+
+
+def load_into(memory, path):
+    """
+    Read the image in `path` straight into `memory` (a bytearray) at address
+    0. Returns the image length.
+    """
+
+    with open(path, 'rb') as f:
+        length = read_header(f)
+        if f.readinto(memoryview(memory)[:length]) != length:
+            raise ImageError('truncated image')
+    return length
+
+
+def read(path):
+    """ Read a whole .ls8b file; returns (image, symbols, source_map) """
+
+    with open(path, 'rb') as f:
+        return parse(f.read())
+
+
+def parse(data):
+    """ `read()` for the bytes of an .ls8b file """
+
+    if len(data) < HEADER.size:
+        raise ImageError('truncated header')
+    magic, version, sections, length = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ImageError('not an .ls8b version 1 image')
+    if length > 256:
+        raise ImageError(f'image of {length} bytes does not fit in memory')
+
+    offset = HEADER.size
+    image = data[offset:offset + length]
+    if len(image) != length:
+        raise ImageError('truncated image')
+    offset += length
+
+    symbols = {}
+    source_map = {}
+    try:
+        for _ in range(sections):
+            tag, size = SECTION.unpack_from(data, offset)
+            offset += SECTION.size
+            payload = data[offset:offset + size]
+            if len(payload) != size:
+                raise ImageError(f'truncated {tag!r} section')
+            offset += size
+
+            if tag == b'SYMS':
+                i = 0
+                while i < len(payload):
+                    address, n = payload[i], payload[i + 1]
+                    if i + 2 + n > len(payload):
+                        raise ImageError('truncated symbol name')
+                    symbols[payload[i + 2:i + 2 + n].decode()] = address
+                    i += 2 + n
+            elif tag == b'SMAP':
+                for address, line in struct.iter_unpack('<BH', payload):
+                    source_map[address] = line
+            # Unknown sections are skipped, so newer writers stay readable
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ImageError(f'corrupt section: {e}') from e
+
+    return image, symbols, source_map
+
+
+def write(f, image, symbols=None, source_map=None):
+    """ Write an image and its optional sections to the binary file `f` """
+
+    sections = []
+    if symbols:
+        payload = bytearray()
+        for name, address in symbols.items():
+            encoded = name.encode()
+            if not 0 <= address <= 0xFF or len(encoded) > 0xFF:
+                # e.g. the end label of a full 256-byte program: it names
+                # no byte of memory, and addresses are stored as u8
+                continue
+            payload += bytes((address, len(encoded))) + encoded
+        sections.append((b'SYMS', bytes(payload)))
+    if source_map:
+        payload = b''.join(struct.pack('<BH', address, line)
+                           for address, line in sorted(source_map.items()))
+        sections.append((b'SMAP', payload))
+
+    f.write(HEADER.pack(MAGIC, VERSION, len(sections), len(image)))
+    f.write(bytes(image))
+    for tag, payload in sections:
+        f.write(SECTION.pack(tag, len(payload)))
+        f.write(payload)
+
+
+def from_text(lines):
+    """
+    Parse .ls8 text the way `CPU.load()` does; returns (image, symbols,
+    source_map) with symbols recovered from asm.py's label comments and the
+    source map pointing at lines of the .ls8 file.
+    """
+
+    image = bytearray()
+    symbols = {}
+    source_map = {}
+
+    for line_num, line in enumerate(lines, 1):
+        m = LABEL_COMMENT.match(line.strip())
+        if m is not None:
+            symbols[m.group(1)] = int(m.group(2))
+        words = line.split()
+        if words and words[0][0] != '#':
+            source_map[len(image)] = line_num
+            image.append(int(words[0], 2))
+
+    return image, symbols, source_map
+
+
+def to_text(image, symbols=None):
+    """ Format an image as .ls8 text lines, with label comments """
+
+    labels = {}
+    for name, address in (symbols or {}).items():
+        labels.setdefault(address, []).append(name)
+
+    lines = []
+    for address, byte in enumerate(image):
+        for name in labels.get(address, ()):
+            lines.append(f'# {name} (address {address}):')
+        lines.append('{:08b}'.format(byte))
+    return lines
+
+
+def main(argv):
+    if len(argv) != 3:
+        print("usage: ls8b.py infile.ls8 outfile.ls8b | infile.ls8b outfile.ls8",
+              file=sys.stderr)
+        return 1
+
+    infile, outfile = argv[1], argv[2]
+
+    if is_binary(infile):
+        image, symbols, _ = read(infile)
+        with open(outfile, 'w') as f:
+            f.write('\n'.join(to_text(image, symbols)) + '\n')
+    else:
+        with open(infile) as f:
+            image, symbols, source_map = from_text(f.read().split('\n'))
+        with open(outfile, 'wb') as f:
+            write(f, image, symbols, source_map)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+
+"""
+Ahead-of-time translator from LS-8 images to Python modules.
+
+The image is split into the basic blocks cfg.py finds reachable from
+address 0 and from the interrupt handlers the program installs, following
+every jump target that can be resolved statically (`LDI Rx,label` followed
+by `JMP/CALL Rx` or a conditional jump) plus every `CALL` return address.
+Each block becomes straight-line Python working on locals for R0-R7, PC
+and FL, and jumps become block transitions through a binary dispatch on
+`PC`.
+
+Anything the translation cannot prove static leaves the compiled code with
+the CPU state written back, and the interpreter takes over:
+
+* a jump to an address that is not the start of a translated block
+  (indirect jumps into data, computed addresses)
+* a `PUSH`/`CALL`/`ST` that would write into translated code
+* `INT` and `IRET`, and any interrupt raised by a device: the compiled
+  code checks `cpu.pending` at every block transition and leaves
+* the `JMP` closing a wait loop (a block that only touches registers and
+  jumps back to its own start) while devices are attached, so the
+  interpreter can sleep in it
+* an instruction that would fault in the interpreter (stack pointer
+  overflow, division by zero, unknown opcode), so the interpreter raises
+  the same error at the same `PC`
+
+ALU instructions and conditional jumps index the lookup tables of alu.py,
+which the generated module binds to globals named after each instruction.
+
+Translations are cached on disk keyed by a hash of the image, so repeated
+runs of the same program skip translation.
+
+Usage: ls8c.py program.ls8 [output.py]
+"""
+
+import os
+import sys
+import time
+import types
+import hashlib
+import importlib.util
+
+from cpu import *
+from cfg import TERMINATORS, analyze, decode, track
+
+""" Bump when the generated code changes, so stale cache entries are not reused """
+VERSION = 8
+
+CACHE_DIR = os.environ.get(
+    'LS8C_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'ls8c'))
+
+""" The mnemonic generated code knows each ALU table and jump condition by """
+TABLE_NAMES = {**BINARY_OPS, **UNARY_OPS, **BRANCH_OPS, CMP: 'CMP'}
+
+
+def decode_block(memory, start, stop=()):
+    """
+    Decode the basic block starting at `start`.
+
+    Decoding ends after a terminator, before an address in `stop`, or at the
+    first instruction that cannot be translated. Returns the block as a list
+    of (address, opcode, a, b, size) and the statically known successors.
+    """
+
+    block = []
+    successors = []
+    known = {}  # register -> constant loaded by LDI in this block
+    address = start
+
+    while True:
+        if block and address in stop:
+            # Ran into another block; fall through to it
+            successors.append(address)
+            break
+
+        ins = decode(memory, address)
+        if ins is None:
+            break
+        op, a, b, size = ins
+        block.append((address, op, a, b, size))
+
+        if op in TERMINATORS:
+            if (op in (JMP, CALL) or op in BRANCH_OPS) and a in known:
+                successors.append(known[a])
+            if op in (CALL, INT) or op in BRANCH_OPS:
+                successors.append(address + size)
+            break
+
+        track(known, op, a, b)
+        address += size
+
+    return block, successors
+
+
+def find_blocks(memory, entry=0):
+    """
+    The basic blocks reachable from `entry`, as found by `cfg.analyze()`.
+
+    Returns {start address: [(address, opcode, a, b, size), ...]}. A block
+    that could not be decoded to its end (unknown opcode, runs off the end
+    of memory) simply stops early and bails to the interpreter there.
+    """
+
+    return {start: block.instructions
+            for start, block in analyze(memory, entry=entry).blocks.items()}
+
+
+class Emitter:
+    """ Accumulates indented lines of generated source """
+
+    def __init__(self):
+        self.lines = []
+
+    def emit(self, indent, line):
+        self.lines.append('    ' * indent + line)
+
+
+def is_wait_loop(block):
+    """ True if `block` only touches registers before its final instruction """
+
+    return all(op in WAIT_LOOP_SIZES for _, op, _, _, _ in block[:-1])
+
+
+def emit_block(out, indent, block):
+    """ Emit the straight-line code for one block """
+
+    def bail(i, address, cond=None):
+        # Leave compiled code before the instruction at `address`
+        if cond is None:
+            out.emit(indent, f'PC = {address}; n += {i}; break')
+        else:
+            out.emit(indent, f'if {cond}: PC = {address}; n += {i}; break')
+
+    def jump(i, target):
+        out.emit(indent, f'PC = {target}; n += {i + 1}; continue')
+
+    # Only enter the block if all of it fits in the instruction budget
+    out.emit(indent, f'if n > limit - {len(block)}: break')
+
+    known = {}
+
+    for i, (address, op, a, b, size) in enumerate(block):
+        Ra = f'R{a}' if a < 8 else None
+        Rb = f'R{b}' if b < 8 else None
+        next_pc = address + size
+
+        if op == LDI and Ra:
+            out.emit(indent, f'{Ra} = {b}')
+        elif op == PRN and Ra:
+            out.emit(indent, f"write(f'{{{Ra}}}\\n')")
+        elif op == PRA and Ra:
+            out.emit(indent, f'write(chr({Ra}))')
+        elif op == ST and Ra and Rb:
+            bail(i, address, f'CODE[{Ra}]')
+            out.emit(indent, f'memory[{Ra}] = {Rb}')
+        elif op == LD and Ra and Rb:
+            out.emit(indent, f'{Ra} = memory[{Rb}]')
+        elif op in BINARY_OPS and Ra and Rb:
+            if op in DIVISIONS:
+                bail(i, address, f'not {Rb}')
+            out.emit(indent, f'{Ra} = {BINARY_OPS[op]}[{Ra} << 8 | {Rb}]')
+        elif op in UNARY_OPS and Ra:
+            out.emit(indent, f'{Ra} = {UNARY_OPS[op]}[{Ra}]')
+        elif op == CMP and Ra and Rb:
+            out.emit(indent, f'FL = CMP[{Ra} << 8 | {Rb}]')
+        elif op == PUSH and Ra:
+            bail(i, address, 'R7 == 0 or CODE[R7 - 1]')
+            out.emit(indent, f'memory[R7 - 1] = {Ra}')
+            out.emit(indent, 'R7 -= 1')
+        elif op == POP and Ra:
+            if a == SP:
+                out.emit(indent, 't = memory[R7]')
+                bail(i, address, 't == 255')
+                out.emit(indent, 'R7 = t + 1')
+            else:
+                bail(i, address, 'R7 == 255')
+                out.emit(indent, f'{Ra} = memory[R7]')
+                out.emit(indent, 'R7 += 1')
+        elif op == CALL and Ra and next_pc < 256:
+            bail(i, address, 'R7 == 0 or CODE[R7 - 1]')
+            out.emit(indent, 'R7 -= 1')
+            out.emit(indent, f'memory[R7] = {next_pc}')
+            jump(i, known.get(a, Ra) if a != SP else Ra)
+            return
+        elif op == RET:
+            bail(i, address, 'R7 == 255')
+            out.emit(indent, 't = memory[R7]')
+            out.emit(indent, 'R7 += 1')
+            jump(i, 't')
+            return
+        elif op == JMP and Ra:
+            target = known.get(a, Ra)
+            start = block[0][0]
+            if is_wait_loop(block) and target in (start, Ra):
+                # Spinning in place: with devices attached, let the
+                # interpreter's JMP decide whether to sleep
+                cond = ('cpu.devices' if target == start
+                        else f'{Ra} == {start} and cpu.devices')
+                bail(i, address, cond)
+            jump(i, target)
+            return
+        elif op in BRANCH_OPS and Ra:
+            out.emit(indent, f'if {BRANCH_OPS[op]}[FL]:')
+            out.emit(indent + 1, f'PC = {known.get(a, Ra)}; n += {i + 1}; continue')
+            jump(i, next_pc)
+            return
+        else:
+            # HLT, INT, IRET, unknown opcodes and bad register numbers are
+            # left to the interpreter, which does exactly what it would have
+            bail(i, address)
+            return
+
+        if op == LDI:
+            known[a] = b
+        else:
+            known.pop(a, None)
+            known.pop(SP, None)
+
+    # Fell off the end of the block into the next one
+    address, op, a, b, size = block[-1]
+    out.emit(indent, f'PC = {address + size}; n += {len(block)}; continue')
+
+
+def emit_dispatch(out, indent, starts, blocks):
+    """ Emit a binary search over block start addresses """
+
+    if len(starts) <= 2:
+        for start in starts:
+            out.emit(indent, f'if PC == {start}:')
+            emit_block(out, indent + 1, blocks[start])
+        return
+
+    mid = len(starts) // 2
+    out.emit(indent, f'if PC < {starts[mid]}:')
+    emit_dispatch(out, indent + 1, starts[:mid], blocks)
+    out.emit(indent, 'else:')
+    emit_dispatch(out, indent + 1, starts[mid:], blocks)
+
+
+def code_mask(blocks):
+    """ 256-byte mask with 1 for every byte belonging to a block """
+
+    code = bytearray(256)
+    for block in blocks.values():
+        for address, op, a, b, size in block:
+            for offset in range(size):
+                code[address + offset] = 1
+    return code
+
+
+def emit_function(out, name, blocks):
+    """
+    Emit `def name(cpu, limit)` running the given blocks from `cpu.PC` until
+    control leaves them or `limit` instructions would be exceeded, then
+    writing the CPU state back and returning the instructions executed.
+    Generated code refers to a global `CODE` mask of translated bytes that
+    stack writes must not touch, and to a global per ALU/jump table named
+    after its instruction (see `table_names()`).
+    """
+
+    out.emit(0, f'def {name}(cpu, limit):')
+    out.emit(1, '"""Run from cpu.PC until leaving translated code; returns with state written back"""')
+    out.emit(1, 'memory = cpu.memory')
+    out.emit(1, 'write = cpu.output.write')
+    out.emit(1, 'R0, R1, R2, R3, R4, R5, R6, R7 = cpu.registers')
+    out.emit(1, 'PC = cpu.PC')
+    out.emit(1, 'FL = cpu.FL')
+    out.emit(1, 'n = 0')
+    out.emit(1, 'while True:')
+    out.emit(2, 'if cpu.pending:')
+    out.emit(3, 'break')
+    if blocks:
+        emit_dispatch(out, 2, sorted(blocks), blocks)
+    out.emit(2, 'break')
+    out.emit(1, 'cpu.registers[:] = (R0, R1, R2, R3, R4, R5, R6, R7)')
+    out.emit(1, 'cpu.PC = PC')
+    out.emit(1, 'cpu.FL = FL')
+    out.emit(1, 'return n')
+
+
+def table_names(blocks):
+    """ The tables the code for `blocks` refers to """
+
+    return {TABLE_NAMES[op] for block in blocks.values()
+            for _, op, _, _, _ in block if op in TABLE_NAMES}
+
+
+def translate(memory, entry=0):
+    """ Translate a 256-byte image into the source of a Python module """
+
+    blocks = {start: block
+              for start, block in find_blocks(memory, entry).items() if block}
+
+    out = Emitter()
+    out.emit(0, f'"""Generated by ls8c.py version {VERSION}. Do not edit."""')
+    out.emit(0, '')
+    out.emit(0, 'from alu import TABLES')
+    out.emit(0, '')
+    out.emit(0, f'BLOCKS = {sorted(blocks)!r}')
+    out.emit(0, f'CODE = {bytes(code_mask(blocks))!r}')
+    for name in sorted(table_names(blocks)):
+        out.emit(0, f"{name} = TABLES['{name}']")
+    out.emit(0, '')
+    out.emit(0, '')
+    emit_function(out, 'run', blocks)
+
+    return '\n'.join(out.lines) + '\n'
+
+
+def image_key(memory):
+    return hashlib.sha256(b'ls8c-%d:' % VERSION + bytes(memory)).hexdigest()
+
+
+""" Translations already imported by this process, most recent last """
+LOADED = {}
+MAX_LOADED = 256
+
+
+def load_translation(memory, cache_dir=CACHE_DIR):
+    """
+    Return the translated module for `memory`, translating and writing it to
+    the cache only if it is not there already. A warm CPU loading the same
+    image again gets the already imported module. With no `cache_dir` the
+    translation is compiled in memory, for callers running many throwaway
+    images (fuzz.py).
+    """
+
+    key = image_key(memory)
+    if key in LOADED:
+        LOADED[key] = module = LOADED.pop(key)
+        return module
+
+    if cache_dir is None:
+        module = types.ModuleType(f'ls8c_{key}')
+        exec(compile(translate(memory), f'<ls8c_{key}>', 'exec'), module.__dict__)
+    else:
+        path = os.path.join(cache_dir, f'ls8c_{key}.py')
+
+        if not os.path.exists(path):
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write under a temporary name so concurrent runs never see half a file
+            tmp = f'{path}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                f.write(translate(memory))
+            os.replace(tmp, path)
+
+        spec = importlib.util.spec_from_file_location(f'ls8c_{key}', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+
+    LOADED[key] = module
+    if len(LOADED) > MAX_LOADED:
+        del LOADED[next(iter(LOADED))]
+    return module
+
+
+class CompiledCPU(CPU):
+    """
+    CPU that runs the ahead-of-time translation of the loaded image, and
+    falls back to the interpreter one instruction at a time whenever the
+    translation cannot be used.
+
+    The translation is only trusted while the code it was made from is
+    intact. Like `JitCPU`, the CPU watches the writes the interpreter makes
+    (`ram_write()`, PUSH, CALL, `restore()`), and the first one that
+    changes a translated byte drops the translation for good; compiled code
+    never writes into itself.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        super().__init__()
+        self.cache_dir = cache_dir
+        self.translation = None
+        self.image = None
+
+    def image_loaded(self):
+        self.image = bytes(self.memory)
+        self.translation = load_translation(self.memory, self.cache_dir)
+
+    def reset(self):
+        super().reset()
+        self.translation = None
+
+    def check_code(self, address):
+        """ Drop the translation if `address` is translated code that has changed """
+
+        translation = self.translation
+        if (translation is not None and translation.CODE[address]
+                and self.memory[address] != self.image[address]):
+            self.translation = None
+
+    def ram_write(self, memory_data_register, memory_address_register):
+        super().ram_write(memory_data_register, memory_address_register)
+        self.check_code(memory_address_register)
+
+    def handle_push(self):
+        super().handle_push()
+        self.check_code(self.registers[SP])
+
+    def handle_call(self):
+        super().handle_call()
+        self.check_code(self.registers[SP])
+
+    def memory_restored(self, previous):
+        for address in range(256):
+            if self.memory[address] != previous[address]:
+                self.check_code(address)
+
+    def spawn(self):
+        # Forks run the same image, so they share the translation; its
+        # code check keeps them safe if they diverge
+        cpu = type(self)(self.cache_dir)
+        cpu.translation = self.translation
+        cpu.image = self.image
+        return cpu
+
+    def execute(self, max_instructions, deadline):
+        translation = self.translation
+        memory = self.memory
+        limit = sys.maxsize if max_instructions is None else max_instructions
+        chunk = limit if deadline is None else DEADLINE_CHECK
+        blocks = set()
+        count = 0
+
+        if translation is not None:
+            blocks = set(translation.BLOCKS)
+
+        try:
+            while count < limit:
+                stop = min(limit, count + chunk)
+                while count < stop:
+                    if self.pending:
+                        self.check_interrupts()
+
+                    if translation is not None and self.PC in blocks:
+                        # Interpreted instructions may have written into the
+                        # code and dropped the translation; then stay interpreted
+                        if self.translation is translation:
+                            n = translation.run(self, stop - count)
+                            count += n
+                            if n:
+                                continue
+                        else:
+                            translation = None
+                            blocks = set()
+                            continue
+
+                    # One interpreted instruction, fetched before it is
+                    # counted as in CPU.execute()
+                    op = memory[self.PC]
+                    count += 1
+                    self.branchtable[op]()
+                if deadline is not None and time.monotonic() >= deadline:
+                    return DEADLINE
+            return BUDGET
+        finally:
+            self.instructions += count
+
+
+def main(argv):
+    if len(argv) not in (2, 3):
+        print("usage: ls8c.py program.ls8 [output.py]", file=sys.stderr)
+        return 1
+
+    cpu = CPU()
+    cpu.load_file(argv[1])
+    source = translate(cpu.memory)
+
+    if len(argv) == 3:
+        with open(argv[2], 'w') as f:
+            f.write(source)
+    else:
+        sys.stdout.write(source)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
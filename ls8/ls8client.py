@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+"""
+Thin client for the ls8d.py daemon, taking the same arguments as ls8.py.
+
+When the daemon is running and the run needs nothing it lacks, the program
+file is sent to it and its output, exit status and --stats line come back
+as ls8.py would have printed them, without loading the emulator here. Any
+other run falls back to ls8.py in this process, so the result is the same
+either way: several programs, --profile, --flamegraph, --record, --replay,
+--trace, --jobs or --budget, no daemon, a program that installs
+interrupt handlers while devices are attached (the daemon has none), or
+one that neither halts nor faults within the daemon's --budget and
+--timeout, which is then run again from the start here.
+
+Only the standard library is imported up front, to keep startup short.
+
+Usage: ls8client.py [ls8.py arguments] program.ls8
+       ls8client.py --ping
+"""
+
+import os
+import sys
+import json
+import base64
+import socket
+import argparse
+import tempfile
+
+""" Where the daemon listens """
+SOCKET = os.environ.get('LS8_SOCKET',
+                        os.path.join(tempfile.gettempdir(), f'ls8-{os.getuid()}.sock'))
+
+""" Arguments the daemon handles; any other option runs the program locally """
+ROUTED = argparse.ArgumentParser(add_help=False)
+ROUTED.add_argument('file_to_load', nargs='+')
+ROUTED.add_argument('--engine', default='interp')
+ROUTED.add_argument('--jit-threshold', type=int, default=50)
+ROUTED.add_argument('--stats', action='store_true')
+ROUTED.add_argument('--output')
+ROUTED.add_argument('--devices', default=None)
+
+
+def call(message, path=SOCKET):
+    """
+    Send one request to the daemon and return its reply. Raises OSError
+    (e.g. FileNotFoundError, ConnectionRefusedError) if it isn't running.
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(path)
+        connection.sendall(json.dumps(message).encode() + b'\n')
+        with connection.makefile('rb') as replies:
+            reply = replies.readline()
+    if not reply:
+        raise ConnectionResetError('the daemon closed the connection')
+    return json.loads(reply)
+
+
+def remote(argv):
+    """
+    Run through the daemon if it can; returns ls8.py's exit code, or None
+    to run locally instead
+    """
+
+    args, unknown = ROUTED.parse_known_args(argv[1:])
+    if unknown or len(args.file_to_load) != 1 or os.path.isdir(args.file_to_load[0]):
+        return None
+
+    try:
+        with open(args.file_to_load[0], 'rb') as f:
+            program = f.read()
+    except OSError:
+        return None  # let ls8.py report it
+
+    try:
+        reply = call({
+            'op': 'run',
+            'program': base64.b64encode(program).decode(),
+            'engine': args.engine,
+            'jit_threshold': args.jit_threshold,
+            'devices': args.devices != '',
+        })
+    except OSError:
+        return None
+    if not reply.get('ok') or reply['status'] not in ('halted', 'fault'):
+        # Not done within the daemon's limits; ls8.py has none
+        return None
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(reply['output'])
+    else:
+        sys.stdout.write(reply['output'])
+        sys.stdout.flush()
+
+    if args.stats:
+        elapsed = max(reply['elapsed'], 1e-9)
+        print(f"{args.engine}: {reply['instructions']} instructions in "
+              f"{elapsed:.6f}s ({reply['instructions'] / elapsed:,.0f} ins/s) [ls8d]",
+              file=sys.stderr)
+
+    if reply['status'] == 'fault':
+        print(f"fault at PC {reply['pc']:02x}: "
+              f"{reply['error_type']}: {reply['error']}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def main(argv):
+    if argv[1:] == ['--ping']:
+        try:
+            print(json.dumps(call({'op': 'stats'})))
+            return 0
+        except OSError as e:
+            print(f"ls8d is not running at {SOCKET}: {e}", file=sys.stderr)
+            return 1
+
+    status = remote(argv)
+    if status is not None:
+        return status
+
+    import ls8
+    return ls8.main(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+"""
+A long-lived LS-8 daemon: runs programs sent over a Unix socket on warm
+worker processes, so a run costs a round trip instead of an interpreter
+start-up and a fresh CPU.
+
+Protocol: one JSON object per line each way, one request per connection.
+
+    {"op": "run",
+     "image": base64 raw bytes | "program": base64 .ls8/.ls8b file
+                               | "source": assembly text,
+     "engine": "interp", "jit_threshold": 50,
+     "max_instructions": N, "timeout": seconds, "devices": false}
+
+    -> {"ok": true, "status": "halted", "instructions": N, "elapsed": s,
+        "output": "...", "pc": 0, "fl": 0, "registers": [8 ints],
+        "memory": "hex of the 256 bytes", "error_type": null, "error": null}
+
+    {"op": "stats"} -> counters, also a cheap check that the daemon is up
+
+Failed requests get {"ok": false, "error": "..."}. A run asking for
+devices whose program uses interrupts gets {"ok": false, "local": true}:
+the daemon has no timer and no keyboard, so only the caller can run it.
+
+Limits: `max_instructions` and `timeout` are capped by --budget and
+--timeout, which also stand in when a request leaves them out.
+
+Each worker keeps a `CPUPool` per engine, so a CPU (and its branch table,
+or the compiled engine's translation cache) is built once per worker.
+Requests for the same image, engine and limits that arrive while a run of
+that image is in flight wait for it to finish and then share one run; the
+engines are deterministic, so they would all have got the same answer.
+
+Usage: ls8d.py [--socket PATH] [--workers N] [--budget N] [--timeout S]
+
+ls8client.py takes ls8.py's arguments and routes runs here when it can.
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import signal
+import socket
+import argparse
+import threading
+import functools
+import socketserver
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from cpu import *
+from sinks import MemorySink
+from pool import CPUPool
+from ls8 import ENGINES
+from ls8client import SOCKET
+import cfg
+import ls8b
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'asm'))
+
+import asm
+
+""" Default and largest per-run instruction budget """
+DEFAULT_BUDGET = 10_000_000
+
+""" Default and longest per-run wall-clock limit, in seconds """
+DEFAULT_TIMEOUT = 10.0
+
+""" Warm CPUs for this worker process, by (engine, jit threshold) """
+_pools = {}
+
+
+def engine_pool(engine, threshold):
+    """ This worker's pool of `engine` CPUs """
+
+    key = (engine, threshold if engine == 'jit' else None)
+    if key not in _pools:
+        options = {'threshold': threshold} if engine == 'jit' else {}
+        _pools[key] = CPUPool(ENGINES[engine], **options)
+    return _pools[key]
+
+
+def warm():
+    """ Worker initializer: build an interpreter up front """
+
+    engine_pool('interp', None).release(engine_pool('interp', None).acquire())
+
+
+def run_batch(engine, threshold, image, runs):
+    """
+    Run `image` once per (max_instructions, timeout) in `runs` on this
+    worker's warm CPUs; returns a reply dict for each
+    """
+
+    pool = engine_pool(engine, threshold)
+    replies = []
+    for max_instructions, timeout in runs:
+        with pool.cpu() as cpu:
+            output = cpu.output = MemorySink()
+            start = time.perf_counter()
+            cpu.load_image(image)
+            result = cpu.run(max_instructions, time.monotonic() + timeout)
+            replies.append({
+                'ok': True,
+                'status': result.status,
+                'instructions': result.instructions,
+                'elapsed': time.perf_counter() - start,
+                'output': output.getvalue(),
+                'pc': result.pc,
+                'fl': cpu.FL,
+                'registers': list(cpu.registers),
+                'memory': bytes(cpu.memory).hex(),
+                'error_type': None if result.error is None else type(result.error).__name__,
+                'error': None if result.error is None else str(result.error),
+            })
+    return replies
+
+
+""" cfg's check, once per image """
+uses_interrupts = functools.lru_cache(maxsize=1024)(cfg.uses_interrupts)
+
+
+class Batcher:
+    """
+    Sends runs to the worker pool, at most one batch per (engine, image)
+    at a time. What arrives meanwhile waits, and goes as the next batch
+    when the current one is done, with identical limits run once.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.lock = threading.Lock()
+        self.waiting = {}  # key -> [(limits, Future)] for the next batch
+        self.requests = 0
+        self.batches = 0
+        self.runs = 0
+
+    def submit(self, engine, threshold, image, limits):
+        """ A Future for the reply to running `image` with (max_instructions, timeout) """
+
+        key = (engine, threshold, bytes(image))
+        future = Future()
+        with self.lock:
+            self.requests += 1
+            if key in self.waiting:
+                self.waiting[key].append((limits, future))
+                return future
+            self.waiting[key] = []
+        self.dispatch(key, [(limits, future)])
+        return future
+
+    def dispatch(self, key, requests):
+        runs = list(dict.fromkeys(limits for limits, _ in requests))
+        with self.lock:
+            self.batches += 1
+            self.runs += len(runs)
+        engine, threshold, image = key
+        try:
+            task = self.executor.submit(run_batch, engine, threshold, image, runs)
+        except RuntimeError as e:  # shutting down
+            task = Future()
+            task.set_exception(e)
+        task.add_done_callback(lambda task: self.finished(key, requests, runs, task))
+
+    def finished(self, key, requests, runs, task):
+        try:
+            replies = dict(zip(runs, task.result()))
+        except Exception as e:
+            replies = dict.fromkeys(runs, {'ok': False, 'error': f'{type(e).__name__}: {e}'})
+        for limits, future in requests:
+            future.set_result(replies[limits])
+
+        with self.lock:
+            waiting = self.waiting.pop(key)
+            if waiting:
+                self.waiting[key] = []
+        if waiting:
+            self.dispatch(key, waiting)
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests, 'batches': self.batches,
+                    'runs': self.runs, 'in_flight': len(self.waiting)}
+
+
+def load_request(request):
+    """ The program image a run request carries """
+
+    if 'image' in request:
+        image = base64.b64decode(request['image'])
+    elif 'program' in request:
+        data = base64.b64decode(request['program'])
+        if data.startswith(ls8b.MAGIC):
+            image, _, _ = ls8b.parse(data)
+        else:
+            image, _, _ = ls8b.from_text(data.decode().split('\n'))
+    elif 'source' in request:
+        image, _, _ = asm.assemble(request['source'])
+    else:
+        raise ValueError('a run needs an image, a program or source')
+
+    if len(image) > 256:
+        raise ValueError(f'image of {len(image)} bytes does not fit in memory')
+    return bytes(image)
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """ One connection: read a request line, write the reply line """
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            reply = self.server.daemon.serve(json.loads(line))
+        except Exception as e:
+            reply = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+        self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+
+class Daemon:
+    """ Request handling, apart from the socket """
+
+    def __init__(self, workers=None, budget=DEFAULT_BUDGET, timeout=DEFAULT_TIMEOUT):
+        self.budget = budget
+        self.timeout = timeout
+        self.executor = ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1,
+                                            initializer=warm)
+        self.batcher = Batcher(self.executor)
+        self.local = 0
+        self.started = time.time()
+
+    def serve(self, request):
+        op = request.get('op')
+        if op == 'stats':
+            return dict(self.batcher.stats(), ok=True, local=self.local,
+                        uptime=time.time() - self.started, pid=os.getpid())
+        if op != 'run':
+            raise ValueError(f'unknown op {op!r}')
+
+        engine = request.get('engine', 'interp')
+        if engine not in ENGINES:
+            raise ValueError(f'unknown engine {engine!r}')
+        threshold = int(request.get('jit_threshold', 50)) if engine == 'jit' else None
+
+        image = load_request(request)
+        if request.get('devices') and uses_interrupts(image):
+            self.local += 1
+            return {'ok': False, 'local': True,
+                    'error': 'the program uses interrupts; run it with its devices'}
+
+        max_instructions = min(int(request.get('max_instructions') or self.budget), self.budget)
+        timeout = min(float(request.get('timeout') or self.timeout), self.timeout)
+        return self.batcher.submit(engine, threshold, image,
+                                   (max_instructions, timeout)).result()
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+
+class Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def claim(path):
+    """ Remove a socket file left behind by a daemon that is gone """
+
+    if not os.path.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+            return
+    raise SystemExit(f'ls8d is already running at {path}')
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='ls8d.py')
+    parser.add_argument('--socket', default=SOCKET,
+                        help='Unix socket to listen on (default: %(default)s, '
+                             'or $LS8_SOCKET)')
+    parser.add_argument('--workers', type=int, default=None, metavar='N',
+                        help='worker processes (default: cores)')
+    parser.add_argument('--budget', type=int, default=DEFAULT_BUDGET, metavar='N',
+                        help='most instructions a run may execute (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, metavar='S',
+                        help='most seconds a run may take (default: %(default)s)')
+    args = parser.parse_args(argv[1:])
+
+    claim(args.socket)
+    daemon = Daemon(args.workers, args.budget, args.timeout)
+    server = Server(args.socket, Handler)
+    server.daemon = daemon
+    os.chmod(args.socket, 0o600)
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop)
+
+    print(f"ls8d: listening on {args.socket}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+        daemon.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,71 @@
+"""
+A pool of warm CPUs, for running many short programs in one process.
+
+    pool = CPUPool()
+    result, output = pool.run(image, max_instructions=100_000)
+
+or, to drive the CPU yourself:
+
+    with pool.cpu() as cpu:
+        cpu.load_file(path)
+        result = cpu.run(deadline=time.monotonic() + 1)
+"""
+
+import threading
+import contextlib
+
+from cpu import *
+from sinks import MemorySink
+
+
+class CPUPool:
+    """
+    Hands out CPUs of one engine and takes them back with `reset()`, so
+    building a CPU (and its branch table) happens once per CPU rather than
+    once per program. At most `size` idle CPUs are kept; None keeps all.
+    """
+
+    def __init__(self, engine=CPU, size=None, **options):
+        self.engine = engine
+        self.options = options
+        self.size = size
+        self.idle = []
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+            self.created += 1
+        return self.engine(**self.options)
+
+    def release(self, cpu):
+        cpu.reset()
+        with self.lock:
+            if self.size is None or len(self.idle) < self.size:
+                self.idle.append(cpu)
+
+    @contextlib.contextmanager
+    def cpu(self):
+        """
+        A reset CPU for the duration of the `with` block. An output sink
+        set in the block is replaced by the CPU's own again afterwards, so
+        the next user doesn't write into it.
+        """
+
+        cpu = self.acquire()
+        output = cpu.output
+        try:
+            yield cpu
+        finally:
+            cpu.output = output
+            self.release(cpu)
+
+    def run(self, image, max_instructions=None, deadline=None):
+        """ Run raw program bytes on a warm CPU; returns (RunResult, output) """
+
+        with self.cpu() as cpu:
+            output = cpu.output = MemorySink()
+            cpu.load_image(image)
+            return cpu.run(max_instructions, deadline), output.getvalue()
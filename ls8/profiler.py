@@ -0,0 +1,212 @@
+"""
+Per-opcode, per-PC and per-function execution profiler.
+
+The profiler drives the CPU with its own copy of the run loop, so the
+normal `CPU.run()` and the other engines carry no profiling code at all.
+
+    profiler = Profiler(cpu, symbols)
+    result = profiler.run()
+    profiler.report()
+
+The report also sums the counts over the basic blocks cfg.py finds in the
+loaded image, and lists the reachable blocks that never ran.
+"""
+
+import sys
+import time
+
+from cpu import *
+from cfg import OPCODE_NAMES, analyze
+import ls8b
+
+
+def load_symbols(path):
+    """
+    Symbol table for a program file: the SYMS section of an .ls8b image, or
+    the label comments asm.py writes into .ls8 text.
+    """
+
+    if ls8b.is_binary(path):
+        return ls8b.read(path)[1]
+    with open(path) as f:
+        return ls8b.from_text(f.read().split('\n'))[1]
+
+
+class Profiler:
+    """
+    Counts executed instructions by opcode, by PC and by call stack.
+
+    `by_opcode` and `by_pc` are preallocated 256-entry lists. Every `CALL`
+    and every interrupt pushes its target as a function on a shadow call
+    stack and every `RET`/`IRET` pops it; the instructions executed under
+    each distinct stack are kept in `stacks`, from which inclusive and
+    exclusive counts per function and the collapsed-stack (flamegraph)
+    output are derived.
+    """
+
+    def __init__(self, cpu, symbols=None):
+        self.cpu = cpu
+        self.by_opcode = [0] * 256
+        self.by_pc = [0] * 256
+        self.stacks = {}
+        self.symbols = symbols
+
+        # Static analysis of the image as it was when profiling started
+        self.program = None
+
+        # Address -> label, for naming functions and PCs
+        self.labels = {}
+        for name, address in (symbols or {}).items():
+            self.labels.setdefault(address, name)
+
+    def name(self, address):
+        """ Function name for an entry address """
+
+        if address in self.labels:
+            return self.labels[address]
+        return f'sub_{address:02x}'
+
+    def location(self, address):
+        """ `LABEL+offset` for any address, using the nearest label below it """
+
+        below = [a for a in self.labels if a <= address]
+        if not below:
+            return f'{address:02x}'
+        base = max(below)
+        offset = address - base
+        return self.labels[base] + (f'+{offset}' if offset else '')
+
+    def run(self, max_instructions=None, deadline=None):
+        """ Profile `CPU.run()`: same arguments, same RunResult """
+
+        if self.program is None:
+            self.program = analyze(self.cpu.memory, self.symbols)
+        return self.cpu.supervise(self.execute, max_instructions, deadline)
+
+    def execute(self, max_instructions, deadline):
+        cpu = self.cpu
+        memory = cpu.memory
+        branchtable = cpu.branchtable
+        by_opcode = self.by_opcode
+        by_pc = self.by_pc
+        stacks = self.stacks
+
+        path = (self.labels.get(cpu.PC, '<main>'),)
+        shadow = []  # paths to go back to on RET
+        pending = 0  # instructions run under `path` not yet added to `stacks`
+        count = 0
+        limit = sys.maxsize if max_instructions is None else max_instructions
+
+        try:
+            while count < limit:
+                if (deadline is not None and count % DEADLINE_CHECK == 0
+                        and time.monotonic() >= deadline):
+                    return DEADLINE
+
+                if cpu.pending:
+                    enabled = cpu.interrupts_enabled
+                    cpu.check_interrupts()
+                    if enabled and not cpu.interrupts_enabled:
+                        # An interrupt handler counts as a call
+                        stacks[path] = stacks.get(path, 0) + pending
+                        pending = 0
+                        shadow.append(path)
+                        path = path + (self.name(cpu.PC),)
+
+                pc = cpu.PC
+                op = memory[pc]
+                by_opcode[op] += 1
+                by_pc[pc] += 1
+                pending += 1
+                count += 1
+
+                branchtable[op]()
+
+                if op == CALL or op == RET or op == IRET:
+                    stacks[path] = stacks.get(path, 0) + pending
+                    pending = 0
+                    if op == CALL:
+                        shadow.append(path)
+                        path = path + (self.name(cpu.PC),)
+                    elif shadow:
+                        path = shadow.pop()
+            return BUDGET
+        finally:
+            stacks[path] = stacks.get(path, 0) + pending
+            cpu.instructions += count
+
+    def functions(self):
+        """ {function: [inclusive, exclusive]} instruction counts """
+
+        totals = {}
+        for path, n in self.stacks.items():
+            for name in set(path):
+                totals.setdefault(name, [0, 0])[0] += n
+            totals.setdefault(path[-1], [0, 0])[1] += n
+        return totals
+
+    def blocks(self):
+        """ {block start: instructions executed in it}, over the static blocks """
+
+        return {start: sum(self.by_pc[address]
+                           for address, _, _, _, _ in block.instructions)
+                for start, block in self.program.blocks.items()}
+
+    def collapsed(self):
+        """ Lines of `frame;frame;frame count`, as flamegraph.pl reads them """
+
+        return [f"{';'.join(path)} {n}"
+                for path, n in sorted(self.stacks.items()) if n]
+
+    def report(self, file=sys.stderr, top=15):
+        total = sum(self.by_opcode)
+        print(f"profile: {total} instructions", file=file)
+
+        print("\nby opcode:", file=file)
+        ranked = sorted(range(256), key=lambda op: -self.by_opcode[op])
+        for op in ranked[:top]:
+            n = self.by_opcode[op]
+            if not n:
+                break
+            name = OPCODE_NAMES.get(op, f'{op:08b}')
+            print(f"  {name:6} {n:12} {n / total:7.1%}", file=file)
+
+        print("\nby PC:", file=file)
+        ranked = sorted(range(256), key=lambda pc: -self.by_pc[pc])
+        for pc in ranked[:top]:
+            n = self.by_pc[pc]
+            if not n:
+                break
+            op = OPCODE_NAMES.get(self.cpu.memory[pc], '?')
+            print(f"  {pc:02x} {self.location(pc):20} {op:6} {n:12} "
+                  f"{n / total:7.1%}", file=file)
+
+        print("\nby function:        inclusive    exclusive", file=file)
+        ranked = sorted(self.functions().items(), key=lambda item: -item[1][0])
+        for name, (inclusive, exclusive) in ranked[:top]:
+            print(f"  {name:16} {inclusive:12} {exclusive:12}", file=file)
+
+        if self.program is None:
+            return
+
+        print("\nby block:", file=file)
+        blocks = self.blocks()
+        ranked = sorted(blocks, key=lambda start: -blocks[start])
+        for start in ranked[:top]:
+            n = blocks[start]
+            if not n:
+                break
+            size = len(self.program.blocks[start].instructions)
+            print(f"  {start:02x} {self.location(start):20} {size:3} ins "
+                  f"{n:12} {n / total:7.1%}", file=file)
+
+        cold = sorted(start for start, n in blocks.items() if not n)
+        print(f"\nreachable blocks never executed: {len(cold)} of {len(blocks)}",
+              file=file)
+        for start in cold[:top]:
+            print(f"  {start:02x} {self.location(start)}", file=file)
+
+    def write_collapsed(self, path):
+        with open(path, 'w') as f:
+            for line in self.collapsed():
+                f.write(line + '\n')
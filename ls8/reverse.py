@@ -0,0 +1,286 @@
+"""
+Reverse execution: record an undo log while running, then step backwards
+or jump to any instruction.
+
+    recorder = Recorder(cpu)
+    result = cpu.run(recorder=recorder)    # e.g. ends in a fault
+    recorder.step_back()                   # the state before the faulting instruction
+    recorder.goto(1_000_000)               # the state after 1,000,000 instructions
+
+Positions are instruction counts, as in `cpu.instructions`.
+
+For every instruction the recorder writes one fixed-size record into a
+preallocated ring buffer, holding only what the instruction may overwrite:
+the old PC and FL, up to two (register, old value) pairs and one (address,
+old value) memory byte. The few things that overwrite
+more than that (IRET, servicing interrupts) store a full snapshot
+instead, as do periodic checkpoints every `snapshot_every` instructions.
+
+Going back within the ring costs one undo per instruction. Going back
+further restores the nearest checkpoint and re-executes forward from it, so
+either way the cost is proportional to the distance, not to the run.
+At most `max_checkpoints` checkpoints are kept: when a long recording
+reaches the limit, every other one is dropped and the interval doubles,
+so memory stays bounded and a jump far back re-executes at most about
+run length / (`max_checkpoints` / 2) instructions.
+Re-execution assumes the program is deterministic: interrupts from devices
+are not replayed.
+"""
+
+import sys
+import time
+import struct
+
+from cpu import *
+from sinks import MemorySink
+
+"""
+Record layout: old PC, old FL, flags, register A and its old value,
+register B and its old value, memory address and its old value
+"""
+RECORD = struct.Struct('9B')
+
+""" Record flags """
+HAS_A = 0x01
+HAS_B = 0x02
+HAS_MEMORY = 0x04
+SNAPSHOT = 0x08  # undo by restoring the snapshot in `Recorder.before`
+
+""" Register specs in WRITES: a register number, or the instruction's operand a """
+OPERAND_A = -1
+
+""" Memory specs in WRITES """
+PUSH_SLOT = 1  # the byte below SP
+ST_ADDRESS = 2  # the address in register a
+
+"""
+What each instruction may overwrite besides PC and FL: (register,
+register, memory)
+"""
+WRITES = {
+    LDI: (OPERAND_A, None, None),
+    LD: (OPERAND_A, None, None),
+    POP: (OPERAND_A, SP, None),
+    PUSH: (SP, None, PUSH_SLOT),
+    CALL: (SP, None, PUSH_SLOT),
+    RET: (SP, None, None),
+    ST: (None, None, ST_ADDRESS),
+    INT: (IS, None, None),
+}
+WRITES.update(dict.fromkeys(BINARY_OPS, (OPERAND_A, None, None)))
+WRITES.update(dict.fromkeys(UNARY_OPS, (OPERAND_A, None, None)))
+
+
+class Recorder:
+    """
+    Undo log for one CPU. `capacity` records are kept in the ring buffer
+    (9 bytes each); `snapshot_every` sets the initial checkpoint interval,
+    and `max_checkpoints` how many checkpoints (about 300 bytes each) are
+    kept before the interval doubles.
+    """
+
+    def __init__(self, cpu, capacity=1 << 16, snapshot_every=1 << 14,
+                 max_checkpoints=1024):
+        self.cpu = cpu
+        self.capacity = capacity
+        self.snapshot_every = snapshot_every
+        self.max_checkpoints = max(max_checkpoints, 2)
+        self.interval = snapshot_every  # between checkpoints, now
+        self.buffer = bytearray(capacity * RECORD.size)
+
+        # Instruction count -> Snapshot: periodic checkpoints, and the
+        # state before each instruction whose record is a SNAPSHOT one
+        self.checkpoints = {}
+        self.before = {}
+
+        # Records were written for instructions start..end-1, and the ring
+        # holds the last `capacity` of them; position is where the CPU is
+        self.start = self.position = self.end = cpu.instructions
+
+    def undoable(self):
+        """ The earliest position `step_back()` can reach with undo records alone """
+
+        return max(self.start, self.end - self.capacity)
+
+    def execute(self, max_instructions, deadline):
+        """ `CPU.execute()` with recording; used through `cpu.run(recorder=...)` """
+
+        cpu = self.cpu
+        memory = cpu.memory
+        registers = cpu.registers
+        branchtable = cpu.branchtable
+        pack = RECORD.pack_into
+        size = RECORD.size
+        buffer = self.buffer
+        capacity = self.capacity
+        every = self.interval
+        checkpoints = self.checkpoints
+        before = self.before
+
+        if cpu.instructions != self.position:
+            # The CPU ran without us; the log no longer leads here
+            self.start = self.position = self.end = cpu.instructions
+            checkpoints.clear()
+            before.clear()
+            every = self.interval = self.snapshot_every
+
+        position = self.position
+        limit = sys.maxsize if max_instructions is None else max_instructions
+        count = 0
+
+        try:
+            while count < limit:
+                if (deadline is not None and count % DEADLINE_CHECK == 0
+                        and time.monotonic() >= deadline):
+                    return DEADLINE
+
+                if position % every == 0:
+                    checkpoints[position] = self.capture(position)
+                    self.prune(max(self.end, position))
+                    if len(checkpoints) > self.max_checkpoints:
+                        every = self.thin()
+
+                flags = 0
+                if cpu.pending:
+                    # Servicing interrupts moves device events into IS and
+                    # may enter a handler, writing 9 bytes of stack
+                    before[position] = self.capture(position)
+                    flags = SNAPSHOT
+                    cpu.check_interrupts()
+
+                pc = cpu.PC
+                op = memory[pc]
+                if op == IRET and not flags & SNAPSHOT:
+                    before[position] = self.capture(position)
+                    flags |= SNAPSHOT
+
+                a = memory[pc + 1] if pc < 255 else 0
+                b = memory[pc + 2] if pc < 254 else 0
+                ra = va = rb = vb = address = old = 0
+                spec = WRITES.get(op)
+
+                if spec is not None:
+                    register_a, register_b, write = spec
+                    if register_a is not None:
+                        ra = a if register_a == OPERAND_A else register_a
+                        if ra < 8:
+                            flags |= HAS_A
+                            va = registers[ra]
+                    if register_b is not None:
+                        flags |= HAS_B
+                        rb = register_b
+                        vb = registers[rb]
+                    if write == PUSH_SLOT:
+                        if registers[SP]:
+                            flags |= HAS_MEMORY
+                            address = registers[SP] - 1
+                            old = memory[address]
+                    elif write == ST_ADDRESS:
+                        if a < 8 and b < 8:
+                            flags |= HAS_MEMORY
+                            address = registers[a]
+                            old = memory[address]
+
+                pack(buffer, (position % capacity) * size, pc, cpu.FL, flags,
+                     ra, va, rb, vb, address, old)
+
+                # Counted before it runs, as in CPU.execute(), so a faulting
+                # instruction has a record too
+                position += 1
+                count += 1
+                branchtable[op]()
+            return BUDGET
+        finally:
+            self.position = position
+            self.end = max(self.end, position)
+            cpu.instructions += count
+
+    def capture(self, position):
+        # cpu.instructions is only brought up to date when execute() returns
+        return self.cpu.snapshot()._replace(instructions=position)
+
+    def thin(self):
+        """ Double the checkpoint interval, dropping the checkpoints off it """
+
+        self.interval *= 2
+        for n in [n for n in self.checkpoints if n % self.interval]:
+            del self.checkpoints[n]
+        return self.interval
+
+    def prune(self, end):
+        """ Forget full snapshots that no record can reach any more """
+
+        horizon = max(self.start, end - self.capacity)
+        for n in [n for n in self.before if n < horizon]:
+            del self.before[n]
+
+    def undo(self):
+        """ Undo the last recorded instruction """
+
+        cpu = self.cpu
+        n = self.position - 1
+        pc, fl, flags, ra, va, rb, vb, address, old = RECORD.unpack_from(
+            self.buffer, (n % self.capacity) * RECORD.size)
+
+        if flags & SNAPSHOT:
+            cpu.restore(self.before[n])
+            self.position = n
+            return
+
+        if flags & HAS_MEMORY:
+            cpu.ram_write(old, address)
+        if flags & HAS_B:
+            cpu.registers[rb] = vb
+        if flags & HAS_A:
+            cpu.registers[ra] = va
+        cpu.PC = pc
+        cpu.FL = fl
+        # Nothing was pending before this instruction (or it would have a
+        # snapshot), so only device events raised since can be now; this
+        # undoes INT
+        with cpu.interrupt_lock:
+            cpu.pending = bool(cpu.raised)
+        cpu.instructions -= 1
+        self.position = n
+
+    def replay(self, instructions):
+        """ Re-execute forward with recording on, discarding the output """
+
+        cpu = self.cpu
+        output, cpu.output = cpu.output, MemorySink()
+        try:
+            return cpu.run(max_instructions=instructions, recorder=self)
+        finally:
+            cpu.output = output
+
+    def goto(self, n):
+        """
+        Bring the CPU to the state after `n` instructions: undo back to it,
+        or restore the nearest checkpoint at or before it and re-execute.
+        """
+
+        if n < self.start and not any(c <= n for c in self.checkpoints):
+            raise ValueError(f"instruction {n} is before the recording")
+
+        if n >= self.position:
+            if n > self.position:
+                self.replay(n - self.position)
+            return
+
+        if n >= self.undoable():
+            while self.position > n:
+                self.undo()
+            return
+
+        checkpoint = max(c for c in self.checkpoints if c <= n)
+        self.cpu.restore(self.checkpoints[checkpoint])
+        # The ring no longer matches the history before the checkpoint
+        self.start = self.position = self.end = checkpoint
+        if n > checkpoint:
+            self.replay(n - checkpoint)
+
+    def step_back(self, k=1):
+        self.goto(self.position - k)
+
+    def step_forward(self, k=1):
+        self.goto(self.position + k)
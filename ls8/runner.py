@@ -0,0 +1,103 @@
+"""Run many .ls8/.ls8b programs on a pool of worker processes."""
+
+import os
+import sys
+import glob
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from cpu import *
+from sinks import MemorySink
+from pool import CPUPool
+
+""" Default per-program instruction budget in multi-program mode """
+DEFAULT_BUDGET = 10_000_000
+
+""" Warm CPUs for this worker process by (engine, options), reused for every program it runs """
+_pools = {}
+
+
+def expand_programs(paths):
+    """ Expand directories and glob patterns into a list of .ls8 files """
+
+    programs = []
+    for path in paths:
+        if os.path.isdir(path):
+            programs.extend(sorted(glob.glob(os.path.join(path, '*.ls8'))
+                                   + glob.glob(os.path.join(path, '*.ls8b'))))
+        elif glob.has_magic(path):
+            programs.extend(sorted(glob.glob(path)))
+        else:
+            programs.append(path)
+    return programs
+
+
+def run_program(path, budget=DEFAULT_BUDGET, engine=CPU, options=()):
+    """
+    Run one program in this worker on an `engine` CPU built with the
+    keyword arguments in `options` ((name, value) pairs), capturing what it
+    prints.
+
+    Returns a dict with the program `path`, its `status` (halted, budget
+    exhausted or fault), `output`, `instructions` executed, `error` for
+    faults and `elapsed` seconds.
+    """
+
+    key = (engine, options)
+    if key not in _pools:
+        _pools[key] = CPUPool(engine, **dict(options))
+
+    result = {'path': path, 'status': FAULT, 'error': None}
+    start = time.perf_counter()
+
+    with _pools[key].cpu() as cpu:
+        output = cpu.output = MemorySink()
+        try:
+            cpu.load_file(path)
+        except Exception as e:
+            result['error'] = f'{type(e).__name__}: {e}'
+            run = None
+        else:
+            run = cpu.run(max_instructions=budget)
+            result['status'] = run.status
+            if run.error is not None:
+                result['error'] = f'{type(run.error).__name__}: {run.error}'
+
+        result['elapsed'] = time.perf_counter() - start
+        result['instructions'] = run.instructions if run else 0
+        result['output'] = output.getvalue()
+
+    return result
+
+
+def run_programs(paths, budget=DEFAULT_BUDGET, jobs=None, engine=CPU, options=()):
+    """ Run every program on a process pool; results come back in order """
+
+    jobs = jobs or os.cpu_count() or 1
+    n = len(paths)
+    with ProcessPoolExecutor(max_workers=min(jobs, n) or 1) as pool:
+        return list(pool.map(run_program, paths, [budget] * n, [engine] * n,
+                             [tuple(options)] * n,
+                             chunksize=max(1, n // (jobs * 4))))
+
+
+def report(results, file=sys.stdout):
+    """ Print each program's output and status, then a summary """
+
+    totals = {HALTED: 0, BUDGET: 0, FAULT: 0}
+    instructions = 0
+
+    for r in results:
+        totals[r['status']] += 1
+        instructions += r['instructions']
+
+        status = r['status'] if r['error'] is None else f"{r['status']}: {r['error']}"
+        print(f"== {r['path']} ({status}, {r['instructions']} instructions, "
+              f"{r['elapsed'] * 1000:.3f} ms)", file=file)
+        file.write(r['output'])
+
+    print(f"{len(results)} programs, {instructions} instructions: "
+          f"{totals[HALTED]} halted, {totals[BUDGET]} budget exhausted, "
+          f"{totals[FAULT]} faulted", file=file)
+
+    return totals
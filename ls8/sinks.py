@@ -0,0 +1,88 @@
+"""
+Output devices for PRN and PRA.
+
+The CPU writes everything it prints to `cpu.output`, which is one of:
+
+* `StreamSink`: buffered writes to a text stream (stdout by default),
+  flushed in large chunks, on HLT, when the CPU goes idle, and at the
+  latest `interval` seconds after the first unflushed write
+* `FileSink`: a `StreamSink` writing to a file it opens itself
+* `MemorySink`: keeps the output in memory, for runners that capture it
+
+Once flushed, the text is exactly what `print()` used to produce.
+"""
+
+import sys
+import threading
+
+
+class MemorySink:
+    """ Collects output in memory; `getvalue()` returns it """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, text):
+        self.chunks.append(text)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+
+class StreamSink:
+    """
+    Buffers output and writes it to `stream` in chunks of about `size`
+    characters. A stream of None means whatever `sys.stdout` is at flush
+    time, so `contextlib.redirect_stdout()` still works.
+    """
+
+    def __init__(self, stream=None, size=8192, interval=0.05):
+        self.stream = stream
+        self.size = size
+        self.interval = interval
+        self.buffer = []
+        self.buffered = 0
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        with self.lock:
+            self.buffer.append(text)
+            self.buffered += len(text)
+            if self.buffered < self.size:
+                if self.timer is None:
+                    # Don't hold output back for long, e.g. from a program
+                    # printing a character per timer interrupt
+                    self.timer = threading.Timer(self.interval, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        # The write happens under the lock too, so a flush from the timer
+        # thread can't overtake one from the CPU thread
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.buffer:
+                stream = self.stream or sys.stdout
+                stream.write(''.join(self.buffer))
+                stream.flush()
+                self.buffer = []
+                self.buffered = 0
+
+
+class FileSink(StreamSink):
+    """ A StreamSink writing to the file at `path` """
+
+    def __init__(self, path, size=65536, interval=0.5):
+        super().__init__(open(path, 'w'), size, interval)
+
+    def close(self):
+        self.flush()
+        self.stream.close()
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+
+"""
+Several LS-8 cores sharing one 256-byte memory.
+
+Each core is a `CPU` with its own registers, PC and FL; only memory is
+shared. Core n starts at address 0 with R0 = n, R1 = the number of cores
+and a stack of its own, SP = 0xF4 - n * `stack_size`.
+
+Two ways to run them:
+
+* `Scheduler`: every core in this process, interleaved one instruction (or
+  one buffered store) at a time in an order drawn from a seeded random
+  generator. The same seed gives the same interleaving, so a race found
+  with one seed can be replayed and studied.
+* `run_parallel()`: one process per core, on a `multiprocessing.shared_memory`
+  block, as fast and as nondeterministic as the host.
+
+Memory ordering, `model`:
+
+* `SC`: sequential consistency. ST writes memory at once.
+* `TSO`: total store order, as on x86. ST goes into the core's FIFO store
+  buffer; the core's own LDs see it at once, other cores only once it has
+  drained to memory, oldest first.
+* `PSO`: partial store order. As TSO, but stores to different addresses
+  may drain in any order.
+
+Buffered stores drain when the scheduler picks them (in parallel, every
+`DRAIN_EVERY` instructions), when the buffer is full, when the core halts
+and before any access to a lock.
+
+Coordination: the bytes at 0xF5-0xF7 are hardware locks. LD from one is an
+atomic test-and-set (it returns the old value and leaves 1 behind) and ST
+to one releases it; both are full fences. Only LD and ST go through the
+store buffer and the locks. Stack operations and instruction fetches use
+memory directly, as each core's stack is its own; cores are interpreted,
+so code written by another core is seen on its next fetch.
+
+    results, memory = Scheduler(image, cores=4, model=TSO, seed=7).run()
+    results, memory = run_parallel(image, cores=4)
+    for result, output in results: ...
+
+Usage: smp.py [--cores N] [--model sc|tso|pso] [--seed N | --parallel]
+              [--budget N] program.ls8
+"""
+
+import sys
+import queue
+import random
+import argparse
+import contextlib
+import multiprocessing
+from multiprocessing import shared_memory
+
+from cpu import *
+from sinks import MemorySink
+
+""" Memory ordering models """
+SC = 'sc'
+TSO = 'tso'
+PSO = 'pso'
+MODELS = (SC, TSO, PSO)
+
+""" Hardware lock addresses, between the key byte and the interrupt vectors """
+LOCKS = range(0xF5, 0xF8)
+
+""" Stack bytes per core """
+STACK_SIZE = 16
+
+""" Stores a core may have buffered before the oldest is forced out """
+STORE_BUFFER_SIZE = 8
+
+""" In parallel, instructions between store buffer drains """
+DRAIN_EVERY = 64
+
+""" Default per-core instruction budget for the command line """
+DEFAULT_BUDGET = 1_000_000
+
+""" Seconds `run_parallel()` waits for a result before checking the cores are alive """
+POLL_INTERVAL = 0.1
+
+""" Scheduler action: execute one instruction (other actions drain a store) """
+STEP = -1
+
+
+class Core(CPU):
+    """
+    One core: a CPU whose `memory` is shared and whose LD and ST go
+    through a store buffer and the lock device. `lock` is the host lock
+    that makes test-and-set atomic across processes.
+    """
+
+    def __init__(self, number, memory, model=SC, lock=None,
+                 buffer_size=STORE_BUFFER_SIZE):
+        super().__init__()
+        self.number = number
+        self.memory = memory
+        self.model = model
+        self.lock = contextlib.nullcontext() if lock is None else lock
+        self.buffer_size = buffer_size
+        """ (address, value) stores not yet in memory, oldest first """
+        self.stores = []
+
+    def power_on(self, cores, stack_size=STACK_SIZE):
+        """ The starting registers described above """
+
+        self.registers[0] = self.number
+        self.registers[1] = cores
+        self.registers[SP] = 0xF4 - self.number * stack_size
+
+    """ Memory ordering """
+
+    def load(self, address):
+        """ The value this core sees at `address`: its own newest store, else memory """
+
+        for buffered, value in reversed(self.stores):
+            if buffered == address:
+                return value
+        return self.memory[address]
+
+    def store(self, address, value):
+        if self.model == SC:
+            self.memory[address] = value
+            return
+        self.stores.append((address, value))
+        if len(self.stores) > self.buffer_size:
+            self.drain()
+
+    def drainable(self):
+        """ Indexes into `stores` that may reach memory next """
+
+        if not self.stores:
+            return []
+        if self.model != PSO:
+            return [0]
+        seen = set()
+        indexes = []
+        for index, (address, _) in enumerate(self.stores):
+            if address not in seen:
+                seen.add(address)
+                indexes.append(index)
+        return indexes
+
+    def drain(self, index=0):
+        """ Write one buffered store to memory """
+
+        address, value = self.stores.pop(index)
+        self.memory[address] = value
+
+    def fence(self):
+        while self.stores:
+            self.drain()
+
+    """ Instructions that differ from `CPU`'s """
+
+    def handle_ld(self):
+        register_a = self.ram_read(self.PC + 1)
+        register_b = self.ram_read(self.PC + 2)
+        address = self.registers[register_b]
+        if address in LOCKS:
+            self.fence()
+            with self.lock:
+                value = self.memory[address]
+                self.memory[address] = 1
+        else:
+            value = self.load(address)
+        self.registers[register_a] = value
+        self.PC += 3
+
+    def handle_st(self):
+        register_a = self.ram_read(self.PC + 1)
+        register_b = self.ram_read(self.PC + 2)
+        address = self.registers[register_a]
+        value = self.registers[register_b]
+        if address in LOCKS:
+            self.fence()
+            with self.lock:
+                self.memory[address] = value
+        else:
+            self.store(address, value)
+        self.PC += 3
+
+    def handle_hlt(self):
+        self.fence()
+        super().handle_hlt()
+
+
+class Scheduler:
+    """
+    Runs `cores` cores in this process, deterministically: every decision
+    (which core executes its next instruction, which buffered store reaches
+    memory) is drawn from `random.Random(seed)`. `schedule` lists the
+    decisions taken as (core, STEP or store buffer index).
+    """
+
+    def __init__(self, image, cores=2, model=SC, seed=0, stack_size=STACK_SIZE):
+        self.memory = bytearray(256)
+        self.memory[:len(image)] = image
+        self.cores = []
+        for number in range(cores):
+            core = Core(number, self.memory, model)
+            core.power_on(cores, stack_size)
+            core.output = MemorySink()
+            self.cores.append(core)
+        self.random = random.Random(seed)
+        """ Each core's RunResult, once it has stopped """
+        self.results = [None] * cores
+        self.schedule = []
+
+    def actions(self):
+        """ The (core, action) decisions possible now """
+
+        actions = []
+        for number, core in enumerate(self.cores):
+            if self.results[number] is None:
+                actions.append((number, STEP))
+            actions.extend((number, index) for index in core.drainable())
+        return actions
+
+    def step(self, max_instructions=None):
+        """ Take one decision; False once every core has stopped and drained """
+
+        actions = self.actions()
+        if not actions:
+            return False
+
+        number, action = self.random.choice(actions)
+        self.schedule.append((number, action))
+        core = self.cores[number]
+        if action != STEP:
+            core.drain(action)
+            return True
+
+        result = core.run(max_instructions=1)
+        if result.status != BUDGET:
+            self.results[number] = RunResult(result.status, core.instructions,
+                                             result.error, result.pc)
+        elif max_instructions is not None and core.instructions >= max_instructions:
+            self.results[number] = RunResult(BUDGET, core.instructions, None, core.PC)
+        return True
+
+    def run(self, max_instructions=None):
+        """
+        Run until every core has halted, faulted or executed
+        `max_instructions`, and every buffered store has drained. Returns
+        ([(RunResult, output)] by core, final memory).
+        """
+
+        while self.step(max_instructions):
+            pass
+        return ([(result, core.output.getvalue())
+                 for result, core in zip(self.results, self.cores)],
+                bytes(self.memory))
+
+
+def run_core(core, max_instructions=None, deadline=None):
+    """
+    Run a core on its own, draining its store buffer every `DRAIN_EVERY`
+    instructions and when it stops
+    """
+
+    if core.model == SC:
+        return core.run(max_instructions, deadline)
+
+    executed = 0
+    while True:
+        chunk = DRAIN_EVERY
+        if max_instructions is not None:
+            chunk = min(chunk, max_instructions - executed)
+        result = core.run(chunk, deadline)
+        executed += result.instructions
+        core.fence()
+        if result.status != BUDGET or executed == max_instructions:
+            return result._replace(instructions=executed)
+
+
+def core_process(name, number, cores, model, lock, results, max_instructions,
+                 deadline, stack_size):
+    """ Body of a core's process in `run_parallel()` """
+
+    block = shared_memory.SharedMemory(name=name)
+    memory = block.buf[:256]
+    try:
+        core = Core(number, memory, model, lock)
+        core.power_on(cores, stack_size)
+        core.output = output = MemorySink()
+        result = run_core(core, max_instructions, deadline)
+        results.put((number, result, output.getvalue()))
+    finally:
+        # The shared block can only be closed once nothing views it
+        core = None
+        memory.release()
+        block.close()
+
+
+def run_parallel(image, cores=2, model=SC, max_instructions=None, deadline=None,
+                 stack_size=STACK_SIZE):
+    """
+    Run `cores` cores in as many processes on one shared memory block.
+    Returns ([(RunResult, output)] by core, final memory).
+    """
+
+    block = shared_memory.SharedMemory(create=True, size=256)
+    processes = []
+    try:
+        block.buf[:256] = bytes(256)
+        block.buf[:len(image)] = image
+        lock = multiprocessing.Lock()
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(
+            target=core_process, name=f'ls8-core{number}',
+            args=(block.name, number, cores, model, lock, results,
+                  max_instructions, deadline, stack_size))
+            for number in range(cores)]
+        for process in processes:
+            process.start()
+
+        by_core = {}
+        silent = set()  # cores found dead without a result at the last poll
+        while len(by_core) < cores:
+            try:
+                number, result, output = results.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                dead = {number for number, process in enumerate(processes)
+                        if process.exitcode is not None and number not in by_core}
+                # A result put just before exiting may still be in the pipe,
+                # so a core counts as lost only when it is silent twice
+                lost = sorted(dead & silent)
+                if lost:
+                    raise RuntimeError(f"core {lost[0]} exited with code "
+                                       f"{processes[lost[0]].exitcode} without a result")
+                silent = dead
+                continue
+            by_core[number] = (result, output)
+        for process in processes:
+            process.join()
+
+        return [by_core[number] for number in range(cores)], bytes(block.buf[:256])
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        block.close()
+        block.unlink()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='smp.py')
+    parser.add_argument('program', help='program to run on every core (.ls8 or .ls8b)')
+    parser.add_argument('--cores', type=int, default=2, help='number of cores (default: 2)')
+    parser.add_argument('--model', choices=MODELS, default=SC,
+                        help='memory ordering (default: sc)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the deterministic schedule (default: 0)')
+    parser.add_argument('--parallel', action='store_true',
+                        help='one process per core instead of the deterministic scheduler')
+    parser.add_argument('--budget', type=int, default=DEFAULT_BUDGET,
+                        help='instructions per core (default: %(default)s)')
+    args = parser.parse_args(argv[1:])
+
+    if not 1 <= args.cores <= (0xF4 + 1) // STACK_SIZE:
+        parser.error(f'--cores must be between 1 and {(0xF4 + 1) // STACK_SIZE}')
+
+    cpu = CPU()
+    cpu.load_file(args.program)
+    image = bytes(cpu.memory)
+
+    if args.parallel:
+        results, _ = run_parallel(image, args.cores, args.model, args.budget)
+    else:
+        results, _ = Scheduler(image, args.cores, args.model, args.seed).run(args.budget)
+
+    failed = False
+    for number, (result, output) in enumerate(results):
+        sys.stdout.write(output)
+        if result.status == FAULT:
+            failed = True
+            print(f"core {number}: fault at PC {result.pc:02x}: "
+                  f"{type(result.error).__name__}: {result.error}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
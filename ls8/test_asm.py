@@ -0,0 +1,44 @@
+"""Tests for asm.py's assemble(): the image pass1/pass2 build, and its errors."""
+
+import io
+import os
+import sys
+import glob
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'asm'))
+
+import asm
+import ls8b
+
+SOURCES = sorted(glob.glob(os.path.join(HERE, '..', 'asm', '*.asm')))
+
+
+class AssemblerTest(unittest.TestCase):
+
+    def test_assemble_matches_passes(self):
+        for path in SOURCES:
+            with self.subTest(source=os.path.basename(path)):
+                with open(path) as f:
+                    source = f.read()
+                image, symbols, _ = asm.assemble(source)
+
+                sym, code = {}, []
+                asm.pass1(io.StringIO(source), sym, code)
+                text = io.StringIO()
+                asm.pass2(text, sym, code)
+                expected, _, _ = ls8b.from_text(text.getvalue().split('\n'))
+
+                self.assertEqual(image, expected)
+                self.assertEqual(symbols, sym)
+
+    def test_label_past_memory(self):
+        source = 'LDI R0,END\n' + 'DB 0\n' * 253 + 'END:\n'
+        with self.assertRaises(asm.OperandError) as raised:
+            asm.assemble(source)
+        self.assertEqual(raised.exception.line_num, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
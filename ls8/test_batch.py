@@ -0,0 +1,31 @@
+"""Tests for batch.py: every lane ends where the scalar CPU does."""
+
+import unittest
+
+import fuzz
+from cpu import *
+
+
+@unittest.skipIf(fuzz.BatchCPU is None, 'needs NumPy')
+class BatchTest(unittest.TestCase):
+
+    def test_call_at_end_of_memory(self):
+        # The push faults before the operand is read, with SP decremented
+        cpus = {}
+        for pc in (0xFD, 0xFE, 0xFF):
+            for sp in (0xF4, 1, 0):
+                memory = bytearray(256)
+                memory[pc] = CALL
+                if pc < 0xFF:
+                    memory[pc + 1] = 2
+                registers = bytearray(8)
+                registers[SP] = sp
+                case = Snapshot(bytes(registers), bytes(memory), pc, 0, True, False, 0, (), 0)
+                with self.subTest(pc=pc, sp=sp):
+                    expected, = fuzz.run_all('interp', [case], 10, cpus)
+                    outcome, = fuzz.run_all('batch', [case], 10, cpus)
+                    self.assertEqual(outcome, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+"""Tests for asm/build.py: the examples it builds, and the errors it reports."""
+
+import io
+import os
+import sys
+import glob
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'asm'))
+
+import build
+import ls8b
+
+SOURCES = sorted(glob.glob(os.path.join(HERE, '..', 'asm', '*.asm')))
+
+""" Broken sources, and the error each one must fail with """
+BROKEN = {
+    'LDI R9,3': 'OperandError: line 1: unknown register R9',
+    'LDI R0,300': 'OperandError: line 1: immediate 300 out of range',
+    'FOO R0': 'UnknownOpcodeError: line 1: unknown opcode FOO',
+    'NOP\nDB zz': 'OperandError: line 2: invalid integer argument to DB',
+    'LDI R0,X': 'UnknownSymbolError: unknown symbol: X',
+    'DB 0\n' * 257: 'ProgramTooLargeError: program is 257 bytes, more than fits in memory',
+}
+
+
+class BuildTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dir = directory.name
+
+    def test_examples(self):
+        # The checked-in examples are build.py's output, give or take comments
+        self.assertEqual(build.build(SOURCES, self.dir, jobs=1, log=io.StringIO()), 0)
+        for source in SOURCES:
+            name = os.path.splitext(os.path.basename(source))[0] + '.ls8'
+            with self.subTest(example=name):
+                with open(os.path.join(self.dir, name)) as built, \
+                        open(os.path.join(HERE, 'examples', name)) as example:
+                    self.assertEqual(ls8b.from_text(built.read().split('\n'))[:2],
+                                     ls8b.from_text(example.read().split('\n'))[:2])
+
+    def test_errors(self):
+        for text, error in BROKEN.items():
+            with self.subTest(error=error):
+                source = os.path.join(self.dir, 'broken.asm')
+                with open(source, 'w') as f:
+                    f.write(text)
+                _, ok, _, detail = build.build_one(source, os.path.join(self.dir, 'broken.ls8'))
+                self.assertFalse(ok)
+                self.assertEqual(detail, error)
+
+
+if __name__ == '__main__':
+    unittest.main()
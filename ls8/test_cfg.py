@@ -0,0 +1,56 @@
+"""Tests for cfg.py: blocks, edges, handlers and stack depth of the examples."""
+
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'asm'))
+
+import asm
+import cfg
+from cpu import *
+
+
+def analyze(name):
+    cpu = CPU()
+    cpu.load_file(os.path.join(HERE, 'examples', name))
+    return cfg.analyze(cpu.memory)
+
+
+class CfgTest(unittest.TestCase):
+
+    def test_opcode_names(self):
+        # asm.py also knows NOP, which the CPU doesn't run
+        names = {int(info['code'], 2): name for name, info in asm.OPCODES.items()}
+        for op, name in OPCODE_NAMES.items():
+            self.assertEqual(names.get(op), name)
+
+    def test_calls(self):
+        # Each CALL through R1, loaded with 0x18 in the first block, ends a block
+        program = analyze('call.ls8')
+        self.assertEqual(sorted(program.blocks), [0x00, 0x08, 0x0d, 0x12, 0x17, 0x18])
+        for start, after in ((0x00, 0x08), (0x08, 0x0d), (0x0d, 0x12), (0x12, 0x17)):
+            with self.subTest(block=start):
+                self.assertEqual(program.blocks[start].successors,
+                                 [(cfg.CALLS, 0x18), (cfg.FALLTHROUGH, after)])
+        self.assertEqual(program.blocks[0x17].successors, [])
+        self.assertEqual(program.blocks[0x18].successors, [])
+        self.assertEqual([address for address, *_ in program.blocks[0x18].instructions],
+                         [0x18, 0x1b, 0x1d])
+        self.assertTrue(program.complete)
+        self.assertEqual(program.max_stack_depth, 1)
+        self.assertFalse(cfg.uses_interrupts(program.memory))
+
+    def test_handler(self):
+        program = analyze('interrupts.ls8')
+        self.assertEqual(program.handlers, {0x11})
+        self.assertEqual(sorted(program.blocks), [0x00, 0x0f, 0x11])
+        self.assertEqual(program.blocks[0x00].successors, [(cfg.FALLTHROUGH, 0x0f)])
+        self.assertEqual(program.blocks[0x0f].successors, [(cfg.JUMP, 0x0f)])
+        self.assertEqual(program.max_stack_depth, cfg.INTERRUPT_FRAME)
+        self.assertTrue(cfg.uses_interrupts(program.memory))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+"""Tests for events.py: a replayed session ends where the recorded one did."""
+
+import os
+import tempfile
+import unittest
+
+import fuzz
+from cpu import *
+from events import EventLogError, EventRecorder, EventReplayer
+from sinks import MemorySink
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+KEYBOARD = os.path.join(HERE, 'examples', 'keyboard.ls8')
+
+""" Keys typed, each after this many instructions of the session """
+KEYS = b'Hello\r\n'
+GAP = 37
+
+
+def fresh(name='interp'):
+    cpu = fuzz.build(name)
+    cpu.output = MemorySink()
+    cpu.load_file(KEYBOARD)
+    return cpu
+
+
+class EventsTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'session.ls8e')
+
+    def record(self):
+        """ Type KEYS at keyboard.ls8, with a timer tick now and then; returns the CPU """
+
+        cpu = fresh()
+        recorder = EventRecorder(cpu, self.path)
+        try:
+            for n, key in enumerate(KEYS):
+                recorder.run(max_instructions=GAP + n)
+                cpu.raise_interrupt(1, (KEY_ADDRESS, key))
+                if n % 3 == 0:
+                    cpu.raise_interrupt(0)  # masked: keyboard.ls8 only takes I1
+            recorder.run(max_instructions=GAP)
+        finally:
+            recorder.close()
+        self.assertEqual(recorder.events, len(KEYS) + (len(KEYS) + 2) // 3)
+        return cpu
+
+    def test_round_trip(self):
+        recorded = self.record()
+        self.assertEqual(recorded.output.getvalue(), KEYS.decode())
+
+        for name in ['interp', *fuzz.ENGINES]:
+            if name == 'batch':
+                continue  # runs many machines at once, not a CPU to replay on
+            with self.subTest(engine=name):
+                cpu = fresh(name)
+                result = EventReplayer(cpu, self.path).run()
+                self.assertEqual(result.status, BUDGET)
+                self.assertEqual(cpu.output.getvalue(), recorded.output.getvalue())
+                self.assertEqual(cpu.snapshot(), recorded.snapshot())
+
+    def test_other_program(self):
+        self.record()
+        cpu = CPU()
+        cpu.load_file(os.path.join(HERE, 'examples', 'interrupts.ls8'))
+        with self.assertRaises(EventLogError):
+            EventReplayer(cpu, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
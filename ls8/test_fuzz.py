@@ -0,0 +1,44 @@
+"""Tests for fuzz.py's engines: each ends where the interpreter does."""
+
+import os
+import glob
+import unittest
+
+import fuzz
+from cpu import *
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EXAMPLES = sorted(glob.glob(os.path.join(HERE, 'examples', '*.ls8')))
+
+""" Instructions each example may run; some loop waiting for interrupts """
+BUDGET = 20_000
+
+
+def power_on(path):
+    """ The power-on Snapshot of the program at `path` """
+
+    cpu = CPU()
+    cpu.load_file(path)
+    return cpu.snapshot()
+
+
+class EngineTest(unittest.TestCase):
+    """ Every engine ends each example exactly where the interpreter does """
+
+    def test_examples(self):
+        cpus = {}
+        for path in EXAMPLES:
+            case = power_on(path)
+            expected, = fuzz.run_all('interp', [case], BUDGET, cpus)
+            for name in fuzz.ENGINES:
+                with self.subTest(example=os.path.basename(path), engine=name):
+                    outcome, = fuzz.run_all(name, [case], BUDGET, cpus)
+                    self.assertEqual(outcome, expected)
+
+    def test_fuzz_cases(self):
+        self.assertEqual(fuzz.fuzz_range(0, 200, list(fuzz.ENGINES),
+                                         fuzz.DEFAULT_BUDGET, fuzz.DEFAULT_LENGTH), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+"""Tests for ls8b.py: images survive a round trip, and bad files are refused."""
+
+import io
+import os
+import sys
+import glob
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'asm'))
+
+import asm
+import ls8b
+from cpu import *
+
+SOURCES = sorted(glob.glob(os.path.join(HERE, '..', 'asm', '*.asm')))
+
+
+class ImageTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for path in SOURCES:
+            with self.subTest(source=os.path.basename(path)):
+                with open(path) as f:
+                    image, symbols, source_map = asm.assemble(f.read())
+                data = io.BytesIO()
+                ls8b.write(data, image, symbols, source_map)
+                self.assertEqual(ls8b.parse(data.getvalue()), (image, symbols, source_map))
+
+    def test_truncated(self):
+        data = io.BytesIO()
+        ls8b.write(data, bytes([HLT]), {'start': 0})
+        for length in range(len(data.getvalue())):
+            with self.assertRaises(ls8b.ImageError):
+                ls8b.parse(data.getvalue()[:length])
+
+    def test_end_label(self):
+        data = io.BytesIO()
+        ls8b.write(data, bytes(256), {'start': 0, 'end': 256})
+        self.assertEqual(ls8b.parse(data.getvalue()), (bytes(256), {'start': 0}, {}))
+
+    def test_too_long(self):
+        data = io.BytesIO()
+        ls8b.write(data, bytes(257))
+        with self.assertRaises(ls8b.ImageError):
+            ls8b.parse(data.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+"""Tests for ls8d.py: replies match a local run, and identical requests share runs."""
+
+import os
+import base64
+import tempfile
+import threading
+import unittest
+
+import ls8d
+from cpu import *
+from ls8client import call
+from sinks import MemorySink
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+""" Instructions for the run the concurrent requests share """
+SPIN = 2_000_000
+
+""" Concurrent requests for it """
+CLIENTS = 6
+
+
+def program(name):
+    with open(os.path.join(HERE, 'examples', name), 'rb') as f:
+        return base64.b64encode(f.read()).decode()
+
+
+def local(name, max_instructions):
+    cpu = CPU()
+    cpu.output = output = MemorySink()
+    cpu.load_file(os.path.join(HERE, 'examples', name))
+    result = cpu.run(max_instructions)
+    return {'status': result.status, 'instructions': result.instructions,
+            'output': output.getvalue(), 'pc': result.pc, 'fl': cpu.FL,
+            'registers': list(cpu.registers), 'memory': bytes(cpu.memory).hex()}
+
+
+class DaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'ls8.sock')
+
+        daemon = ls8d.Daemon(workers=2)
+        self.addCleanup(daemon.close)
+        server = ls8d.Server(self.path, ls8d.Handler)
+        server.daemon = daemon
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+    def run_remote(self, name, **request):
+        reply = call(dict(request, op='run', program=program(name)), self.path)
+        self.assertTrue(reply.pop('ok'), reply)
+        return reply
+
+    def test_results(self):
+        for name in ('call.ls8', 'printstr.ls8', 'stackoverflow.ls8'):
+            for engine in ('interp', 'compiled'):
+                with self.subTest(example=name, engine=engine):
+                    reply = self.run_remote(name, engine=engine, max_instructions=20_000)
+                    error_type = reply.pop('error_type')
+                    reply.pop('error')
+                    reply.pop('elapsed')
+                    self.assertEqual(reply, local(name, 20_000))
+                    self.assertEqual(error_type, 'IndexError' if name == 'stackoverflow.ls8' else None)
+
+    def test_devices(self):
+        reply = call({'op': 'run', 'program': program('keyboard.ls8'), 'devices': True},
+                     self.path)
+        self.assertEqual((reply['ok'], reply['local']), (False, True))
+        self.assertEqual(self.run_remote('keyboard.ls8', max_instructions=1000)['status'],
+                         BUDGET)
+
+    def test_batching(self):
+        # interrupts.ls8 spins; requests made while the first run is going
+        # wait for it and then share a single second run
+        replies = [None] * CLIENTS
+
+        def client(n):
+            replies[n] = self.run_remote('interrupts.ls8', max_instructions=SPIN)
+
+        threads = [threading.Thread(target=client, args=(n,)) for n in range(CLIENTS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        expected = local('interrupts.ls8', SPIN)
+        for reply in replies:
+            self.assertEqual({key: reply[key] for key in expected}, expected)
+
+        stats = call({'op': 'stats'}, self.path)
+        self.assertEqual(stats['requests'], CLIENTS)
+        self.assertEqual((stats['batches'], stats['runs'], stats['in_flight']), (2, 2, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+"""Tests for asm.py -O: optimized programs run as the originals do."""
+
+import io
+import os
+import sys
+import glob
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'asm'))
+
+import asm
+import ls8b
+from cpu import *
+from sinks import MemorySink
+
+SOURCES = sorted(glob.glob(os.path.join(HERE, '..', 'asm', '*.asm')))
+
+""" Instructions each program may run; some loop waiting for interrupts """
+BUDGET = 20_000
+
+
+def build(path, optimize):
+    """ The image and symbols asm.py builds from `path`, with or without -O """
+
+    sym, code = {}, []
+    with open(path) as f:
+        asm.pass1(f, sym, code)
+    if optimize:
+        asm.optimize(sym, code)
+    text = io.StringIO()
+    asm.pass2(text, sym, code)
+    image, _, _ = ls8b.from_text(text.getvalue().split('\n'))
+    return image, sym
+
+
+def run(image, sym):
+    """
+    What a run of `image` shows: status, fault, output, registers and FL.
+    -O moves labels, so a register holding a label's address is given as
+    its name.
+    """
+
+    labels = {address: name for name, address in sym.items()}
+    cpu = CPU()
+    cpu.output = output = MemorySink()
+    cpu.load_image(image)
+    result = cpu.run(max_instructions=BUDGET)
+    return (result.status, type(result.error), output.getvalue(),
+            [labels.get(value, value) for value in cpu.registers], cpu.FL)
+
+
+class PeepholeTest(unittest.TestCase):
+
+    def test_sources(self):
+        saved = 0
+        for path in SOURCES:
+            with self.subTest(source=os.path.basename(path)):
+                optimized, original = build(path, True), build(path, False)
+                self.assertEqual(run(*optimized), run(*original))
+                saved += len(original[0]) - len(optimized[0])
+        # Or the comparison above proves little
+        self.assertGreater(saved, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
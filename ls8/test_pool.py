@@ -0,0 +1,31 @@
+"""Tests for pool.py: warm CPUs come back as good as new."""
+
+import unittest
+
+from cpu import *
+from pool import CPUPool
+from sinks import StreamSink
+
+""" PRN R0 with R0 = 7, then HLT """
+PROGRAM = bytes([LDI, 0, 7, PRN, 0, HLT])
+
+
+class PoolTest(unittest.TestCase):
+
+    def test_run(self):
+        pool = CPUPool()
+        for _ in range(3):
+            result, output = pool.run(PROGRAM)
+            self.assertEqual((result.status, output), (HALTED, '7\n'))
+        self.assertEqual(pool.created, 1)
+
+    def test_output_is_restored(self):
+        pool = CPUPool()
+        pool.run(PROGRAM)
+        with pool.cpu() as cpu:
+            self.assertIsInstance(cpu.output, StreamSink)
+            self.assertEqual(cpu.registers[0], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
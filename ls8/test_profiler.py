@@ -0,0 +1,69 @@
+"""Tests for profiler.py: its counts add up to what actually ran."""
+
+import os
+import glob
+import unittest
+from collections import Counter
+
+from cpu import *
+from profiler import Profiler, load_symbols
+from sinks import MemorySink
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EXAMPLES = sorted(glob.glob(os.path.join(HERE, 'examples', '*.ls8')))
+
+""" Instructions profiled per example """
+STEPS = 2000
+
+
+def fresh(path):
+    cpu = CPU()
+    cpu.output = MemorySink()
+    cpu.load_file(path)
+    return cpu
+
+
+def profile(path, n=STEPS):
+    profiler = Profiler(fresh(path), load_symbols(path))
+    return profiler, profiler.run(max_instructions=n)
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def test_counts(self):
+        # By PC and by opcode, as stepping the interpreter sees them
+        for path in EXAMPLES:
+            with self.subTest(example=os.path.basename(path)):
+                cpu = fresh(path)
+                pcs, ops = Counter(), Counter()
+                for _ in range(STEPS):
+                    if cpu.pending:
+                        cpu.check_interrupts()
+                    pc = cpu.PC
+                    op = cpu.memory[pc] if pc < 256 else None
+                    result = cpu.run(max_instructions=1)
+                    if result.instructions:
+                        pcs[pc] += 1
+                        ops[op] += 1
+                    if result.status != BUDGET:
+                        break
+
+                profiler, result = profile(path)
+                self.assertEqual(result.instructions, sum(pcs.values()))
+                self.assertEqual({pc: n for pc, n in enumerate(profiler.by_pc) if n}, pcs)
+                self.assertEqual({op: n for op, n in enumerate(profiler.by_opcode) if n}, ops)
+                self.assertEqual(sum(n for _, n in profiler.functions().values()),
+                                 result.instructions)
+
+    def test_calls(self):
+        # Four calls to MULT2PRINT, of three instructions each
+        profiler, result = profile(os.path.join(HERE, 'examples', 'call.ls8'))
+        self.assertEqual(result.status, HALTED)
+        self.assertEqual(profiler.functions(), {'<main>': [22, 10], 'MULT2PRINT': [12, 12]})
+        self.assertEqual(profiler.collapsed(), ['<main> 10', '<main>;MULT2PRINT 12'])
+        self.assertEqual(profiler.blocks(),
+                         {0x00: 3, 0x08: 2, 0x0d: 2, 0x12: 2, 0x17: 1, 0x18: 12})
+
+
+if __name__ == '__main__':
+    unittest.main()
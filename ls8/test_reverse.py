@@ -0,0 +1,55 @@
+"""Tests for reverse.py: going back lands where a fresh run stops."""
+
+import os
+import glob
+import unittest
+
+from cpu import *
+from reverse import Recorder
+from sinks import MemorySink
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EXAMPLES = sorted(glob.glob(os.path.join(HERE, 'examples', '*.ls8')))
+
+
+class ReverseTest(unittest.TestCase):
+    """ `goto()` reaches the state a fresh run stopped at that count has """
+
+    def fresh(self, path, n):
+        cpu = CPU()
+        cpu.output = MemorySink()
+        cpu.load_file(path)
+        cpu.run(max_instructions=n)
+        return cpu.snapshot()
+
+    def test_goto(self):
+        for path in EXAMPLES:
+            cpu = CPU()
+            cpu.output = MemorySink()
+            cpu.load_file(path)
+            # A small ring and close checkpoints, so both ways back are taken
+            recorder = Recorder(cpu, capacity=16, snapshot_every=32)
+            end = cpu.run(max_instructions=200, recorder=recorder).instructions
+            for n in sorted({end, end - 1, end - 10, end // 2, 3, 0}, reverse=True):
+                if n < 0:
+                    continue
+                with self.subTest(example=os.path.basename(path), n=n):
+                    recorder.goto(n)
+                    self.assertEqual(cpu.snapshot(), self.fresh(path, n))
+
+    def test_checkpoints_are_capped(self):
+        path = os.path.join(HERE, 'examples', 'interrupts.ls8')  # loops without devices
+        cpu = CPU()
+        cpu.output = MemorySink()
+        cpu.load_file(path)
+        recorder = Recorder(cpu, capacity=64, snapshot_every=16, max_checkpoints=8)
+        cpu.run(max_instructions=5000, recorder=recorder)
+        self.assertLessEqual(len(recorder.checkpoints), 8)
+        for n in (4999, 3000, 1234, 7):
+            with self.subTest(n=n):
+                recorder.goto(n)
+                self.assertEqual(cpu.snapshot(), self.fresh(path, n))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+"""Tests for sinks.py: buffered output is exactly the unbuffered output."""
+
+import io
+import os
+import glob
+import time
+import tempfile
+import unittest
+import contextlib
+
+from cpu import *
+from sinks import FileSink, MemorySink, StreamSink
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EXAMPLES = sorted(glob.glob(os.path.join(HERE, 'examples', '*.ls8')))
+
+""" Instructions each example may run; some loop waiting for interrupts """
+BUDGET = 20_000
+
+""" What print() showed for some of the examples """
+PRINTED = {
+    'call.ls8': '20\n30\n36\n60\n',
+    'print8.ls8': '8\n',
+    'printstr.ls8': 'Hello, world!\n',
+}
+
+
+class Unbuffered:
+    """ Writes straight through, as print() did """
+
+    def __init__(self, stream):
+        self.write = stream.write
+
+    def flush(self):
+        pass
+
+
+def run(path, sink):
+    cpu = CPU()
+    cpu.output = sink
+    cpu.load_file(path)
+    cpu.run(max_instructions=BUDGET)
+
+
+class SinkTest(unittest.TestCase):
+
+    def test_examples(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        for path in EXAMPLES:
+            name = os.path.basename(path)
+            expected = io.StringIO()
+            run(path, Unbuffered(expected))
+            expected = expected.getvalue()
+            if name in PRINTED:
+                self.assertEqual(expected, PRINTED[name])
+
+            outputs = {}
+            memory = MemorySink()
+            run(path, memory)
+            outputs['memory'] = memory.getvalue()
+
+            for size in (1, 7, 8192):
+                stream = io.StringIO()
+                run(path, StreamSink(stream, size=size))
+                outputs[f'stream {size}'] = stream.getvalue()
+
+            stdout = io.StringIO()
+            with contextlib.redirect_stdout(stdout):
+                run(path, StreamSink())
+            outputs['stdout'] = stdout.getvalue()
+
+            file = os.path.join(directory.name, 'out.txt')
+            sink = FileSink(file)
+            run(path, sink)
+            sink.close()
+            with open(file, 'rb') as f:
+                outputs['file'] = f.read().decode()
+
+            for kind, output in outputs.items():
+                with self.subTest(example=name, sink=kind):
+                    self.assertEqual(output, expected)
+
+    def test_interval(self):
+        # Output is held back at most `interval` seconds, even without a flush
+        stream = io.StringIO()
+        sink = StreamSink(stream, interval=0.01)
+        sink.write('A')
+        self.assertEqual(stream.getvalue(), '')
+        deadline = time.monotonic() + 5
+        while not stream.getvalue() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(stream.getvalue(), 'A')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+"""Tests for smp.py: a locked counter comes out right on every model and schedule."""
+
+import os
+import unittest
+
+import smp
+from cpu import *
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+""" Most instructions a core may run """
+BUDGET = 100_000
+
+
+def image():
+    cpu = CPU()
+    cpu.load_file(os.path.join(HERE, 'examples', 'smpcount.ls8'))
+    return bytes(cpu.memory)
+
+
+class SmpTest(unittest.TestCase):
+
+    def check(self, results, cores):
+        # Every core halts, and the last to finish prints the total
+        self.assertEqual([result.status for result, _ in results], [HALTED] * cores)
+        self.assertEqual(''.join(output for _, output in results), f'{20 * cores}\n')
+
+    def test_scheduler(self):
+        for model in smp.MODELS:
+            for cores in (1, 2, 3):
+                for seed in range(4):
+                    with self.subTest(model=model, cores=cores, seed=seed):
+                        results, _ = smp.Scheduler(image(), cores, model, seed).run(BUDGET)
+                        self.check(results, cores)
+
+    def test_seed_replays(self):
+        runs = []
+        for _ in range(2):
+            scheduler = smp.Scheduler(image(), 3, smp.PSO, seed=11)
+            runs.append((scheduler.run(BUDGET), scheduler.schedule))
+        self.assertEqual(runs[0], runs[1])
+
+    def test_parallel(self):
+        for model in smp.MODELS:
+            with self.subTest(model=model):
+                results, _ = smp.run_parallel(image(), 2, model, BUDGET)
+                self.check(results, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
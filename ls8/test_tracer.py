@@ -0,0 +1,96 @@
+"""Tests for tracer.py: a trace holds what stepping the interpreter sees."""
+
+import os
+import glob
+import tempfile
+import unittest
+
+import tracer
+from cpu import *
+from sinks import MemorySink
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EXAMPLES = sorted(glob.glob(os.path.join(HERE, 'examples', '*.ls8')))
+
+""" Instructions traced per example """
+STEPS = 300
+
+
+def fresh(path=None):
+    cpu = CPU()
+    cpu.output = MemorySink()
+    if path:
+        cpu.load_file(path)
+    return cpu
+
+
+def stepped(cpu, n):
+    """ The records of `n` instructions, run one at a time on `cpu` """
+
+    records = []
+    for _ in range(n):
+        if cpu.pending:
+            cpu.check_interrupts()
+        pc = cpu.PC
+        code = bytes(cpu.memory[pc:pc + 3]).ljust(3, b'\0')
+        state = (pc, code[0], code[1], code[2], bytes(cpu.registers), cpu.FL)
+        result = cpu.run(max_instructions=1)
+        if result.instructions:
+            records.append(state)
+        if result.status != BUDGET:
+            break
+    return records
+
+
+class TracerTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'run.ls8t')
+
+    def trace(self, cpu, n, **options):
+        tracing = tracer.Tracer(cpu, self.path, **options)
+        try:
+            result = tracing.run(max_instructions=n)
+        finally:
+            tracing.close()
+        return result, tracer.read(self.path)
+
+    def test_round_trip(self):
+        for path in EXAMPLES:
+            with self.subTest(example=os.path.basename(path)):
+                expected = stepped(fresh(path), STEPS)
+                # A small buffer, so it spills several times
+                result, (first, records) = self.trace(fresh(path), STEPS, capacity=7)
+                self.assertEqual(first, 0)
+                self.assertEqual(records, expected)
+                self.assertEqual(result.instructions, len(expected))
+
+    def test_last(self):
+        for path in EXAMPLES:
+            with self.subTest(example=os.path.basename(path)):
+                expected = stepped(fresh(path), STEPS)
+                _, (first, records) = self.trace(fresh(path), STEPS, last=50)
+                self.assertEqual(records, expected[-50:])
+                self.assertEqual(first, len(expected) - len(records))
+
+    def test_fetch_past_memory(self):
+        # PRN at 0xFE leaves PC at 256, where the next fetch faults
+        def at_end():
+            cpu = fresh()
+            cpu.memory[0xFE] = PRN
+            cpu.PC = 0xFE
+            return cpu
+
+        expected = at_end().run(max_instructions=10)
+        result, (_, records) = self.trace(at_end(), 10)
+        self.assertIsInstance(result.error, IndexError)
+        self.assertEqual(type(result.error), type(expected.error))
+        self.assertEqual((result.status, result.instructions, result.pc),
+                         (expected.status, expected.instructions, expected.pc))
+        self.assertEqual(len(records), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
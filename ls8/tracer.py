@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+"""
+Binary instruction traces, written while running and decoded offline.
+
+    tracer = Tracer(cpu, 'run.ls8t')             # everything
+    tracer = Tracer(cpu, 'run.ls8t', last=1000)  # flight recorder
+    try:
+        tracer.run()
+    finally:
+        tracer.close()
+
+For every instruction the tracer packs one fixed-size record into a
+preallocated buffer: the state `CPU.trace()` prints, taken before the
+instruction executes. Nothing is formatted while the program runs. When
+the buffer is full it is copied to the end of the trace file through a
+memory mapping and reused; with `last`, the buffer is a ring instead and
+only the last `last` records reach the file, on `close()`.
+
+File layout (all integers little-endian):
+
+    offset  size
+    0       4     magic b"LS8T"
+    4       1     format version (1)
+    5       3     unused
+    8       8     instruction number of the first record (instructions
+                  run before it)
+    16      8     number of records
+
+followed by the 13-byte records: u8 PC, the 3 bytes at PC (IR and the
+operands; zeros past the end of memory), R0-R7, u8 FL.
+
+Usage: tracer.py [--disassemble] [--symbols program.ls8] trace.ls8t
+"""
+
+import sys
+import mmap
+import time
+import struct
+import argparse
+
+from cpu import *
+from cfg import OPCODE_NAMES, SIZES
+from profiler import load_symbols
+
+MAGIC = b'LS8T'
+VERSION = 1
+
+HEADER = struct.Struct('<4sB3xQQ')
+RECORD = struct.Struct('<B3s8sB')
+
+""" Records in the buffer between spills """
+DEFAULT_CAPACITY = 65536
+
+""" Instructions whose first operand holds a jump or call target """
+TRANSFERS = {JMP, CALL} | set(BRANCH_OPS)
+
+
+class TraceError(Exception):
+    """Raised for files that are not traces."""
+
+
+class Tracer:
+    """
+    Runs the CPU like `CPU.run()`, interpreting, and writes a trace of every
+    instruction to `path`. `close()` writes what is still buffered and the
+    header; a trace is only complete after it.
+    """
+
+    def __init__(self, cpu, path, capacity=DEFAULT_CAPACITY, last=None):
+        self.cpu = cpu
+        self.ring = last is not None
+        self.capacity = last if self.ring else capacity
+        self.buffer = bytearray(self.capacity * RECORD.size)
+        self.offset = 0  # where the next record goes in `buffer`
+        self.wrapped = False
+        self.first = cpu.instructions
+        self.records = 0  # records traced, spilled or not
+        self.spilled = 0  # records in the file
+        self.file = open(path, 'w+b')
+        self.file.write(HEADER.pack(MAGIC, VERSION, self.first, 0))
+
+    def run(self, max_instructions=None, deadline=None):
+        """ Trace `CPU.run()`: same arguments, same RunResult """
+
+        return self.cpu.supervise(self.execute, max_instructions, deadline)
+
+    def execute(self, max_instructions, deadline):
+        cpu = self.cpu
+        memory = cpu.memory
+        registers = cpu.registers
+        branchtable = cpu.branchtable
+        pack = RECORD.pack_into
+        size = RECORD.size
+        buffer = self.buffer
+        end = len(buffer)
+        offset = self.offset
+        count = 0
+        limit = sys.maxsize if max_instructions is None else max_instructions
+
+        try:
+            while count < limit:
+                if (deadline is not None and count % DEADLINE_CHECK == 0
+                        and time.monotonic() >= deadline):
+                    return DEADLINE
+
+                if cpu.pending:
+                    cpu.check_interrupts()
+
+                if offset == end:
+                    if self.ring:
+                        self.wrapped = True
+                    else:
+                        self.spill(memoryview(buffer))
+                    offset = 0
+
+                # Fetch first: at PC 256 this faults as `CPU.execute()`
+                # does, with nothing recorded or counted
+                pc = cpu.PC
+                op = memory[pc]
+                pack(buffer, offset, pc, memory[pc:pc + 3], registers, cpu.FL)
+                offset += size
+                count += 1
+                branchtable[op]()
+            return BUDGET
+        finally:
+            self.offset = offset
+            self.records += count
+            cpu.instructions += count
+
+    def spill(self, data):
+        """ Append `data` to the file through a fresh mapping of it """
+
+        if not data:
+            return
+        start = HEADER.size + self.spilled * RECORD.size
+        self.file.truncate(start + len(data))
+        with mmap.mmap(self.file.fileno(), 0) as mapped:
+            mapped[start:start + len(data)] = data
+        self.spilled += len(data) // RECORD.size
+
+    def close(self):
+        """ Write the buffered records and the header, and close the file """
+
+        if self.file.closed:
+            return
+
+        buffer = memoryview(self.buffer)
+        if self.wrapped:
+            # Oldest first: the ring continues after `offset`
+            self.spill(bytes(buffer[self.offset:]) + bytes(buffer[:self.offset]))
+        else:
+            self.spill(buffer[:self.offset])
+
+        first = self.first + self.records - self.spilled
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, VERSION, first, self.spilled))
+        self.file.close()
+
+
+def read(path):
+    """ Read a trace; returns (first instruction number, [(pc, ir, a, b, registers, fl)]) """
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if len(data) < HEADER.size:
+        raise TraceError('truncated header')
+    magic, version, first, count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise TraceError('not a trace')
+    if version != VERSION:
+        raise TraceError(f'unsupported trace version {version}')
+    if len(data) < HEADER.size + count * RECORD.size:
+        raise TraceError('truncated trace')
+
+    records = [(pc, code[0], code[1], code[2], registers, fl)
+               for pc, code, registers, fl in RECORD.iter_unpack(
+                   memoryview(data)[HEADER.size:HEADER.size + count * RECORD.size])]
+    return first, records
+
+
+def format_trace(record):
+    """ A record as the line `CPU.trace()` prints """
+
+    pc, ir, a, b, registers, _ = record
+    return (f"TRACE: %02X | %02X %02X %02X |" % (pc, ir, a, b)
+            + ''.join(" %02X" % r for r in registers))
+
+
+def disassemble(record, labels):
+    """ A record as an instruction, with `labels` ({address: name}) for PCs and targets """
+
+    pc, ir, a, b, registers, fl = record
+    if ir not in SIZES:
+        return f"{pc:02x}  {labels.get(pc, ''):12} .byte {ir:#04x}"
+
+    operands = [f"R{a}", f"R{b}"][:SIZES[ir] - 1]
+    if ir == LDI:
+        operands[1] = str(b)
+    text = f"{pc:02x}  {labels.get(pc, ''):12} {OPCODE_NAMES[ir]:5} {','.join(operands)}".rstrip()
+    if ir in TRANSFERS and a < 8:
+        target = registers[a]
+        text += f"  -> {labels.get(target, f'{target:02x}')}"
+    return text
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='tracer.py',
+                                     description='Decode a trace written by ls8.py --trace.')
+    parser.add_argument('trace', help='trace file (.ls8t)')
+    parser.add_argument('--disassemble', action='store_true',
+                        help='print instructions instead of TRACE: lines')
+    parser.add_argument('--symbols', metavar='PROGRAM',
+                        help='program the trace was made from, for labels')
+    args = parser.parse_args(argv[1:])
+
+    first, records = read(args.trace)
+    if not args.disassemble:
+        for record in records:
+            print(format_trace(record))
+        return 0
+
+    symbols = load_symbols(args.symbols) if args.symbols else {}
+    labels = {address: name for name, address in symbols.items()}
+    for n, record in enumerate(records, first):
+        print(f"{n:>10}  {disassemble(record, labels)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))